@@ -0,0 +1,63 @@
+""" Measures broadcasting of one public message to all local connections, comparing
+encoding and framing per connection against a single pre-encoded frame.
+
+Connections are web socket protocol objects writing to a stream stub, so the
+numbers cover the Python work done per broadcast, not the socket writes.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import time
+from tornado.websocket import WebSocketProtocol13, PreparedMessage
+from protocol import ClientMessage, MessageType
+
+
+class StreamStub:
+    def __init__(self):
+        self.bytesWritten = 0
+
+    def write(self, data):
+        self.bytesWritten += len(data)
+
+
+class HandlerStub:
+    def __init__(self):
+        self.request = None
+        self.stream = StreamStub()
+
+
+def broadcast_per_connection(msg, connections):
+    for connection in connections:
+        connection.write_message(ClientMessage.to_json(msg))
+
+
+def broadcast_prepared(msg, connections):
+    preparedMsg = PreparedMessage(ClientMessage.to_json(msg))
+    for connection in connections:
+        connection.write_prepared_message(preparedMsg)
+
+
+def messages_per_sec(broadcast, msg, connections, minDurationSec=1.0):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        broadcast(msg, connections)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= minDurationSec:
+            return count / elapsed
+
+
+def main():
+    msg = ClientMessage(MessageType.PUBLIC_MESSAGE, 'some_user', 'a typical chat line of moderate length')
+    print('%12s %22s %22s %8s' % ('connections', 'per connection msg/s', 'prepared msg/s', 'speedup'))
+    for connectionCount in [1000, 10000, 50000]:
+        connections = [WebSocketProtocol13(HandlerStub()) for _ in range(connectionCount)]
+        perConnection = messages_per_sec(broadcast_per_connection, msg, connections)
+        prepared = messages_per_sec(broadcast_prepared, msg, connections)
+        print('%12d %22.1f %22.1f %7.1fx' % (connectionCount, perConnection, prepared, prepared / perConnection))
+
+
+if __name__ == "__main__":
+    main()
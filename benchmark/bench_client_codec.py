@@ -0,0 +1,72 @@
+""" Measures encoding and decoding of client messages, comparing the previous codec, which
+encoded every field of the message dict with json.dumps, against the client codec in
+protocol, which leaves out empty fields and uses a shared compact encoder.
+
+Encoding includes the conversion to UTF-8 bytes done before writing a web socket frame.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import json
+import time
+from protocol import ClientMessage, MessageType
+
+
+def previous_to_json_bytes(message):
+    return json.dumps({'messageType': MessageType.to_name(message.messageType),
+                       'senderUserName': message.senderUserName,
+                       'messageText': message.messageText,
+                       'receiverUserName': message.receiverUserName,
+                       'allUsers': message.allUsers or []}).encode('utf-8')
+
+
+def previous_from_json(message):
+    dict = json.loads(message)
+    messageType = MessageType.from_name(dict['messageType'])
+    senderUserName = dict['senderUserName']
+    messageText = ''
+    receiverUserName = ''
+    listAllUsers = None
+    if 'messageText' in dict:
+        messageText = dict['messageText']
+    if 'receiverUserName' in dict:
+        receiverUserName = dict['receiverUserName']
+    if 'allUsers' in dict:
+        listAllUsers = dict['allUsers']
+    return ClientMessage(messageType, senderUserName, messageText, receiverUserName, listAllUsers)
+
+
+def create_messages():
+    return [
+        ('login', ClientMessage(MessageType.LOGIN, 'some_user')),
+        ('public', ClientMessage(MessageType.PUBLIC_MESSAGE, 'some_user', 'a typical chat line of moderate length')),
+        ('private', ClientMessage(MessageType.PRIVATE_MESSAGE, 'some_user', 'see you at lunch?', 'other_user')),
+        ('list 100 users', ClientMessage(MessageType.LIST_ALL_USERS, allUsers=['user_%d' % i for i in range(100)]))
+    ]
+
+
+def messages_per_sec(function, message, minDurationSec=0.5):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(1000):
+            function(message)
+        count += 1000
+        elapsed = time.perf_counter() - start
+        if elapsed >= minDurationSec:
+            return count / elapsed
+
+
+def main():
+    print('%16s %10s %8s %14s %14s' % ('message', 'codec', 'bytes', 'encode msg/s', 'decode msg/s'))
+    for name, message in create_messages():
+        for codecName, encode, decode in [('previous', previous_to_json_bytes, previous_from_json),
+                                          ('compact', ClientMessage.to_json_bytes, ClientMessage.from_json)]:
+            encoded = encode(message).decode('utf-8')
+            print('%16s %10s %8d %14.0f %14.0f' % (name, codecName, len(encoded), messages_per_sec(encode, message),
+                                                   messages_per_sec(decode, encoded)))
+
+
+if __name__ == "__main__":
+    main()
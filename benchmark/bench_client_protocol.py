@@ -0,0 +1,64 @@
+""" Measures the client protocols: the bytes of the web socket frame of a client message, and the server
+CPU time per message, comparing JSON text frames against the binary subprotocol.
+
+Encoding includes building the frame, as for a message prepared for broadcast. Decoding starts from the
+payload of a received frame, so for JSON includes the UTF-8 decoding of the text frame.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import time
+from tornado.websocket import PreparedMessage
+from protocol import ClientMessage, MessageType
+
+
+def encode_json(message):
+    return PreparedMessage(ClientMessage.to_json_bytes(message)).frame
+
+
+def decode_json(data):
+    return ClientMessage.from_json(data.decode('utf-8'))
+
+
+def encode_binary(message):
+    return PreparedMessage(ClientMessage.to_binary(message), binary=True).frame
+
+
+def create_messages():
+    return [
+        ('login', ClientMessage(MessageType.LOGIN, 'some_user')),
+        ('public', ClientMessage(MessageType.PUBLIC_MESSAGE, 'some_user', 'a typical chat line of moderate length')),
+        ('private', ClientMessage(MessageType.PRIVATE_MESSAGE, 'some_user', 'see you at lunch?', 'other_user')),
+        ('room', ClientMessage(MessageType.ROOM_MESSAGE, 'some_user', 'anyone here?', roomName='lobby')),
+        ('list 1000 users', ClientMessage(MessageType.LIST_ALL_USERS, allUsers=['user_%d' % i for i in range(1000)],
+                                          cursor='user_999'))
+    ]
+
+
+def usec_per_message(function, message, minDurationSec=0.5):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(100):
+            function(message)
+        count += 100
+        elapsed = time.perf_counter() - start
+        if elapsed >= minDurationSec:
+            return elapsed / count * 1e6
+
+
+def main():
+    print('%16s %8s %10s %12s %12s' % ('message', 'protocol', 'frame B', 'encode us', 'decode us'))
+    for name, message in create_messages():
+        for protocolName, encode, to_payload, decode in [
+                ('json', encode_json, ClientMessage.to_json_bytes, decode_json),
+                ('binary', encode_binary, ClientMessage.to_binary, ClientMessage.from_binary)]:
+            payload = to_payload(message)
+            print('%16s %8s %10d %12.2f %12.2f' % (name, protocolName, len(encode(message)),
+                                                    usec_per_message(encode, message),
+                                                    usec_per_message(decode, payload)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+""" Measures reading a stream of small frames from an IOStream, the way the web socket protocol
+reads them: the 2 bytes of the frame header, then the payload. A thread writes the frames to the
+other end of a socket pair.
+
+Each read consumes a few bytes from the front of the read buffer, so the cost of consuming them
+while many more frames are buffered decides the throughput, more so with large read chunks.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import socket
+import struct
+import threading
+import time
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+
+def frames_per_sec(frameSize, readChunkSize, frameCount):
+    ioLoop = IOLoop()
+    readerSocket, writerSocket = socket.socketpair()
+    stream = IOStream(readerSocket, io_loop=ioLoop, read_chunk_size=readChunkSize)
+    frame = struct.pack('!H', frameSize) + b'x' * frameSize
+    writer = threading.Thread(target=writerSocket.sendall, args=(frame * frameCount, ))
+    readCounts = [0]
+
+    def read_header():
+        stream.read_bytes(2, read_payload)
+
+    def read_payload(header):
+        stream.read_bytes(struct.unpack('!H', header)[0], on_payload)
+
+    def on_payload(payload):
+        readCounts[0] += 1
+        if readCounts[0] == frameCount:
+            ioLoop.stop()
+        else:
+            read_header()
+    start = time.perf_counter()
+    writer.start()
+    read_header()
+    ioLoop.start()
+    elapsedSec = time.perf_counter() - start
+    writer.join()
+    stream.close()
+    writerSocket.close()
+    ioLoop.close()
+    return frameCount / elapsedSec
+
+
+def main():
+    print('%10s %10s %12s' % ('frame', 'chunk', 'frames/s'))
+    for frameSize in [20, 100, 1000]:
+        for readChunkSize in [4096, 64 * 1024]:
+            print('%8d B %8d B %12.0f' % (frameSize, readChunkSize,
+                                        frames_per_sec(frameSize, readChunkSize, 100000)))
+
+
+if __name__ == "__main__":
+    main()
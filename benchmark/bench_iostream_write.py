@@ -0,0 +1,113 @@
+""" Measures the throughput of frames written to an IOStream over a socket pair, with a thread
+reading the other end, comparing the write buffer merged into one string per send against the
+vectored write, which hands the buffered frames to one sendmsg call without copying large ones.
+
+Frames are written in batches, as the web socket handlers do when they broadcast, and the IOLoop
+runs until each batch is written, so the frames of a batch pile up in the write buffer whenever
+the socket is full.
+
+A slow reader keeps the socket full while thousands of frames are buffered, so most writes are
+partial. For that case the CPU time of the writing thread per frame is measured.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import resource
+import socket
+import threading
+import time
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+
+def drain(sock, totalBytes):
+    receivedBytes = 0
+    while receivedBytes < totalBytes:
+        receivedBytes += len(sock.recv(1024 * 1024))
+
+
+def drain_slowly(sock, totalBytes):
+    receivedBytes = 0
+    while receivedBytes < totalBytes:
+        receivedBytes += len(sock.recv(16 * 1024))
+        time.sleep(0.0002)
+
+
+def thread_cpu_sec():
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def writer_usec_per_frame(vectored, frameSize, frameCount):
+    ioLoop = IOLoop()
+    writerSocket, readerSocket = socket.socketpair()
+    writerSocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
+    readerSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+    stream = IOStream(writerSocket, io_loop=ioLoop)
+    if not vectored:
+        stream.supports_vectored_write = lambda: False
+    frame = b'x' * frameSize
+    reader = threading.Thread(target=drain_slowly, args=(readerSocket, frameSize * frameCount))
+    reader.start()
+    start = thread_cpu_sec()
+    for _ in range(frameCount):
+        stream.write(frame)
+    stream.write(b'', ioLoop.stop)
+    ioLoop.start()
+    elapsedSec = thread_cpu_sec() - start
+    reader.join()
+    stream.close()
+    readerSocket.close()
+    ioLoop.close()
+    return elapsedSec / frameCount * 1e6
+
+
+def frames_per_sec(vectored, frameSize, batchSize, batchCount):
+    ioLoop = IOLoop()
+    writerSocket, readerSocket = socket.socketpair()
+    stream = IOStream(writerSocket, io_loop=ioLoop)
+    if not vectored:
+        stream.supports_vectored_write = lambda: False
+    frame = b'x' * frameSize
+    reader = threading.Thread(target=drain, args=(readerSocket, frameSize * batchSize * batchCount))
+    reader.start()
+    start = time.perf_counter()
+    for _ in range(batchCount):
+        for _ in range(batchSize):
+            stream.write(frame)
+        if stream.writing():
+            stream.write(b'', ioLoop.stop)
+            ioLoop.start()
+    reader.join()
+    elapsedSec = time.perf_counter() - start
+    stream.close()
+    readerSocket.close()
+    ioLoop.close()
+    return batchSize * batchCount / elapsedSec
+
+
+def main():
+    if not hasattr(socket.socket, 'sendmsg'):
+        print('socket.sendmsg is not available')
+        return
+    print('%10s %8s %16s %16s %8s' % ('frame', 'batch', 'merge frames/s', 'sendmsg frames/s', 'speedup'))
+    for frameSize in [100, 1000, 16 * 1024, 128 * 1024]:
+        for batchSize in [10, 100]:
+            batchCount = 20000 * 1024 // frameSize // batchSize + 1
+            merged = frames_per_sec(False, frameSize, batchSize, batchCount)
+            vectored = frames_per_sec(True, frameSize, batchSize, batchCount)
+            print('%8d B %8d %16.0f %16.0f %7.1fx' % (frameSize, batchSize, merged, vectored, vectored / merged))
+
+    print()
+    print('slow reader, writer CPU per frame')
+    print('%10s %16s %16s' % ('frame', 'merge us', 'sendmsg us'))
+    for frameSize in [100, 1000, 16 * 1024]:
+        frameCount = 4 * 1024 * 1024 // frameSize
+        merged = writer_usec_per_frame(False, frameSize, frameCount)
+        vectored = writer_usec_per_frame(True, frameSize, frameCount)
+        print('%8d B %16.2f %16.2f' % (frameSize, merged, vectored))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+""" Measures the memory used by one million queued server messages, each carrying a public
+chat message, comparing dict backed messages with string message types against slot based
+messages with integer message types and interned user names.
+
+User names and message texts are created per message, as when decoded from the network.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import collections
+import time
+import tracemalloc
+from protocol import ClientMessage, MessageType, ServerMessage
+
+
+class DictClientMessage:
+    """ Client message as before, with an instance dict and a string message type
+    """
+    def __init__(self, messageType, senderUserName='', messageText='', receiverUserName='', allUsers=[]):
+        self.messageType = messageType
+        self.senderUserName = senderUserName
+        self.messageText = messageText
+        self.receiverUserName = receiverUserName
+        self.allUsers = allUsers
+
+
+class DictServerMessage:
+    """ Server message as before, with an instance dict and a string message type
+    """
+    def __init__(self, messageType, senderMailboxUri, data):
+        self.messageType = messageType
+        self.senderMailboxUri = senderMailboxUri
+        self.data = data
+
+
+def queue_dict_messages(count, userCount):
+    queue = collections.deque()
+    for i in range(count):
+        clientMsg = DictClientMessage('public_message', 'user_%d' % (i % userCount), 'message %d' % i)
+        queue.append(DictServerMessage('forward_message_to_all_clients', None, clientMsg))
+    return queue
+
+
+def queue_slot_messages(count, userCount):
+    queue = collections.deque()
+    for i in range(count):
+        clientMsg = ClientMessage(MessageType.PUBLIC_MESSAGE, 'user_%d' % (i % userCount), 'message %d' % i)
+        queue.append(ServerMessage(MessageType.FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS, None, clientMsg))
+    return queue
+
+
+def measure(queueMessages, count, userCount):
+    tracemalloc.start()
+    start = time.perf_counter()
+    queue = queueMessages(count, userCount)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del queue
+    return size, elapsed
+
+
+def main():
+    count = 1000000
+    userCount = 1000
+    print('%16s %14s %14s %16s' % ('class', 'MB', 'bytes/msg', 'create ns/msg'))
+    for name, queueMessages in [('dict', queue_dict_messages), ('slots', queue_slot_messages)]:
+        size, elapsed = measure(queueMessages, count, userCount)
+        print('%16s %14.1f %14.1f %16.0f' % (name, size / 2**20, size / count, elapsed / count * 1e9))
+
+
+if __name__ == "__main__":
+    main()
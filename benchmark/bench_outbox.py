@@ -0,0 +1,51 @@
+""" Measures delivery of messages to a remote mailbox over Pyro on localhost, comparing
+one oneway put per message against batches delivered with put_many.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import time
+from mailbox import Mailbox
+from outbox import Outbox
+from protocol import ClientMessage, MessageType
+
+
+def deliver_one_by_one(mailboxProxy, msgs):
+    for msg in msgs:
+        mailboxProxy.put(msg)
+
+
+def deliver_batched(mailboxProxy, msgs, batchSize):
+    outbox = Outbox(mailboxProxy, batchSize, lambda: None)
+    for msg in msgs:
+        outbox.put(msg)
+    outbox.flush()
+
+
+def messages_per_sec(deliver, mailbox, msgs):
+    start = time.perf_counter()
+    deliver(msgs)
+    for _ in msgs:
+        mailbox.get()  # Wait until all messages have arrived
+    return len(msgs) / (time.perf_counter() - start)
+
+
+def main():
+    mailbox = Mailbox.create_mailbox()
+    mailboxProxy = mailbox.get_mailbox_proxy(mailbox.uri)
+    clientMsg = ClientMessage(MessageType.PUBLIC_MESSAGE, 'some_user', 'a typical chat line of moderate length')
+    msgs = [mailbox.create_message(MessageType.FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS, clientMsg) for _ in range(900)]
+    try:
+        print('%12s %14s' % ('batch size', 'messages/s'))
+        print('%12d %14.1f' % (1, messages_per_sec(lambda m: deliver_one_by_one(mailboxProxy, m), mailbox, msgs)))
+        for batchSize in [8, 64, 256]:
+            rate = messages_per_sec(lambda m: deliver_batched(mailboxProxy, m, batchSize), mailbox, msgs)
+            print('%12d %14.1f' % (batchSize, rate))
+    finally:
+        mailboxProxy._pyroRelease()
+        mailbox.daemon.shutdown()
+
+
+if __name__ == "__main__":
+    main()
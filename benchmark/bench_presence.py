@@ -0,0 +1,99 @@
+""" Measures replicating the users of a message router to another message router, for 10k to 1M users.
+Compares one NEW_USER message per login, kept in a dict from user name to the outbox of the user's
+router, against presence deltas of many logins, kept in the presence index. Reports the memory of the
+index per user, excluding the user names themselves, the bytes sent per login in the compact wire
+format, and how many logins per second the receiving router decodes and applies.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import time
+import tracemalloc
+import wire_format
+from presence import PresenceIndex
+from protocol import MessageType, ServerMessage
+
+
+ROUTER_URI = 'PYRO:obj_0123456789abcdef@localhost:40001'
+OUTBOX_BATCH_SIZE = 64  # Messages per remote call, as config.OUTBOX_MAX_BATCH_SIZE
+DELTA_SIZE = 1000  # Logins per delta, as in a reconnect storm
+
+
+def encode_per_user_messages(userNames):
+    msgs = [ServerMessage(MessageType.NEW_USER, ROUTER_URI, userName) for userName in userNames]
+    return [wire_format.encode_messages(msgs[i:i + OUTBOX_BATCH_SIZE]) for i in range(0, len(msgs), OUTBOX_BATCH_SIZE)]
+
+
+def encode_deltas(userNames):
+    batches = []
+    for sequence, i in enumerate(range(0, len(userNames), DELTA_SIZE)):
+        msg = ServerMessage(MessageType.PRESENCE_DELTA, ROUTER_URI, (sequence + 1, userNames[i:i + DELTA_SIZE], []))
+        batches.append(wire_format.encode_messages([msg]))
+    return batches
+
+
+def apply_per_user_messages(batches):
+    routerOutbox = object()  # Stands for the outbox shared by all users of a router
+    userToRouterMailbox = {}
+    for data in batches:
+        for msg in wire_format.decode_messages(data):
+            if msg.data not in userToRouterMailbox:
+                userToRouterMailbox[msg.data] = routerOutbox
+    return userToRouterMailbox
+
+
+def apply_deltas(batches):
+    presence = PresenceIndex()
+    for data in batches:
+        for msg in wire_format.decode_messages(data):
+            routerId = presence.get_router_id(str(msg.senderMailboxUri))
+            sequence, addedUsers, removedUsers = msg.data
+            for userName in addedUsers:
+                presence.add_user(userName, routerId)
+    return presence
+
+
+def build_presence(userNames):
+    presence = PresenceIndex()
+    routerId = presence.get_router_id(ROUTER_URI)
+    for userName in userNames:
+        presence.add_user(userName, routerId)
+    return presence
+
+
+def index_bytes_per_user(userNames, build):
+    """ Memory allocated by build for an index of userNames, which are allocated beforehand
+    """
+    tracemalloc.start()
+    index = build(userNames)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del index
+    return size / len(userNames)
+
+
+def measure(userNames, encode, apply):
+    batches = encode(userNames)
+    wireBytes = sum(len(data) for data in batches)
+    start = time.perf_counter()
+    apply(batches)
+    elapsedSec = time.perf_counter() - start
+    return wireBytes / len(userNames), len(userNames) / elapsedSec
+
+
+def main():
+    print('%10s %12s %14s %12s %14s' % ('users', 'method', 'index B/user', 'wire B/user', 'logins/s'))
+    for userCount in [10000, 100000, 1000000]:
+        userNames = [sys.intern('user_%d' % i) for i in range(userCount)]
+        for method, encode, apply, build in [
+                ('per user', encode_per_user_messages, apply_per_user_messages,
+                 lambda names: {userName: ROUTER_URI for userName in names}),
+                ('delta', encode_deltas, apply_deltas, build_presence)]:
+            wireBytesPerUser, loginsPerSec = measure(userNames, encode, apply)
+            print('%10d %12s %14.1f %12.1f %14.0f' % (userCount, method, index_bytes_per_user(userNames, build),
+                                                      wireBytesPerUser, loginsPerSec))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+""" Measures a reconnect storm: logins of many users at once, sent to a user registry over Pyro
+on localhost. Compares one request and response per user against batched requests, each
+carrying the user names of up to a batch size of logins.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import time
+from mailbox import Mailbox
+from protocol import MessageType
+from user_registry import UserRegistry
+
+
+def login_one_by_one(routerMailbox, registryProxy, userNames):
+    for userName in userNames:
+        registryProxy.put(routerMailbox.create_message(MessageType.USER_REGISTRY_NEW_USER, userName))
+    return len(userNames)
+
+
+def login_batched(routerMailbox, registryProxy, userNames, batchSize):
+    batches = [userNames[i:i + batchSize] for i in range(0, len(userNames), batchSize)]
+    for batch in batches:
+        registryProxy.put(routerMailbox.create_message(MessageType.USER_REGISTRY_NEW_USERS, batch))
+    return len(batches)
+
+
+def logins_per_sec(login, routerMailbox, userNames):
+    start = time.perf_counter()
+    responseCount = login(userNames)
+    for _ in range(responseCount):
+        routerMailbox.get()  # Wait until all logins have been answered
+    return len(userNames) / (time.perf_counter() - start)
+
+
+def main():
+    userCount = 20000
+    registryMailbox = Mailbox.create_mailbox()
+    routerMailbox = Mailbox.create_mailbox()
+    registryProxy = routerMailbox.get_mailbox_proxy(registryMailbox.uri)
+    userRegistry = UserRegistry(registryMailbox, 0.01)
+    userRegistry.start()
+    try:
+        print('%12s %14s' % ('batch size', 'logins/s'))
+        userNames = ['user_%d' % i for i in range(userCount)]
+        rate = logins_per_sec(lambda names: login_one_by_one(routerMailbox, registryProxy, names), routerMailbox, userNames)
+        print('%12d %14.0f' % (1, rate))
+        for batchSize in [16, 64, 256]:
+            userNames = ['user_%d_%d' % (batchSize, i) for i in range(userCount)]
+            rate = logins_per_sec(lambda names: login_batched(routerMailbox, registryProxy, names, batchSize),
+                                  routerMailbox, userNames)
+            print('%12d %14.0f' % (batchSize, rate))
+    finally:
+        userRegistry.stop()
+        userRegistry.join()
+        registryProxy._pyroRelease()
+        for mailbox in [registryMailbox, routerMailbox]:
+            mailbox.daemon.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+""" Measures sustained user registrations per second with the user registry log, committing
+every registration on its own (one fsync each) against group commits of a batch of registrations,
+as done for each batch the registry takes from its mailbox. Also measures replay on startup.
+
+The log is written to a temporary directory, so the numbers depend on the disk behind it.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import shutil
+import tempfile
+import time
+from registry_log import RegistryLog
+
+ROUTER_URI = 'PYRO:obj_0123456789abcdef@localhost:40001'
+
+
+def registrations_per_sec(directory, batchSize, minDurationSec=2.0):
+    registryLog = RegistryLog(directory, 'user_registry_0', snapshotInterval=10**9)
+    users = registryLog.replay()
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(batchSize):
+            userName = 'user_%d' % count
+            users[userName] = ROUTER_URI
+            registryLog.append_register(userName, ROUTER_URI)
+            count += 1
+        registryLog.commit(users)
+        elapsed = time.perf_counter() - start
+        if elapsed >= minDurationSec:
+            registryLog.close()
+            return count / elapsed
+
+
+def replay_sec(directory, userCount):
+    registryLog = RegistryLog(directory, 'user_registry_0', snapshotInterval=10**9)
+    users = registryLog.replay()
+    for i in range(userCount):
+        registryLog.append_register('user_%d' % i, ROUTER_URI)
+    registryLog.commit(users)
+    registryLog.close()
+
+    registryLog = RegistryLog(directory, 'user_registry_0', snapshotInterval=10**9)
+    start = time.perf_counter()
+    users = registryLog.replay()
+    elapsed = time.perf_counter() - start
+    registryLog.close()
+    return elapsed, len(users)
+
+
+def main():
+    print('%12s %22s' % ('batch size', 'registrations/s'))
+    for batchSize in [1, 16, 256]:
+        directory = tempfile.mkdtemp()
+        try:
+            print('%12d %22.0f' % (batchSize, registrations_per_sec(directory, batchSize)))
+        finally:
+            shutil.rmtree(directory)
+
+    directory = tempfile.mkdtemp()
+    try:
+        elapsed, userCount = replay_sec(directory, 1000000)
+        print('replayed %d users in %.2f s' % (userCount, elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+""" Load test of many small rooms: message routers in one process, delivering to each other's
+mailboxes directly instead of over Pyro, with users spread over all routers and joined to rooms
+of a few users each. Compares sending every message as a public message to all users against
+room messages, which only reach the routers and users in the room.
+
+Reports the messages between routers and the messages to clients per message sent, and the
+messages sent per second by the whole cluster.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import random
+import time
+import config
+from chat_server import MessageRouter
+from mailbox import Mailbox
+from protocol import ClientMessage, MessageType
+
+
+class SinkProxy:
+    """ Stands for the load balancer and the user registry, which are not part of the test
+    """
+    def put(self, msg):
+        pass
+
+
+class ClusterMailbox(Mailbox):
+    """ Mailbox of a message router, reaching the mailboxes of the other routers in the cluster directly
+    """
+    def __init__(self, cluster, uri):
+        super().__init__(capacity=10 ** 8)
+        self.cluster = cluster
+        self.uri = uri
+        self.receivedCount = 0
+
+    def get_mailbox_proxy(self, nameOrUri):
+        return self.cluster.get(str(nameOrUri), SinkProxy())
+
+    def put_many(self, msgs):
+        self.receivedCount += len(msgs)
+        super().put_many(msgs)
+
+
+class ConnectionCounter:
+    def __init__(self):
+        self.sentCount = 0
+
+    def send_message(self, message):
+        self.sentCount += 1
+
+    def send_prepared_message(self, preparedMessage):
+        self.sentCount += 1
+
+
+def create_cluster(routerCount, usersPerRouter, roomSize):
+    cluster = {}
+    routers = []
+    for routerIndex in range(routerCount):
+        mailbox = ClusterMailbox(cluster, 'PYRO:router_%d@localhost:%d' % (routerIndex, 40000 + routerIndex))
+        cluster[mailbox.uri] = mailbox
+        routers.append(MessageRouter(mailbox, 8000 + routerIndex))
+    userToRouter = {}
+    for router in routers:
+        router.handle_server_message(router.mailbox.create_message(MessageType.NEW_MESSAGE_ROUTER, list(cluster)))
+        for i in range(usersPerRouter):
+            userName = 'user_%d_%d' % (router.httpPort, i)
+            router.userToWebSocketConnection[userName] = ConnectionCounter()
+            userToRouter[userName] = router
+
+    # Rooms of users picked from all routers
+    userNames = list(userToRouter)
+    random.shuffle(userNames)
+    rooms = {}
+    for roomIndex, i in enumerate(range(0, len(userNames), roomSize)):
+        roomName = 'room_%d' % roomIndex
+        rooms[roomName] = userNames[i:i + roomSize]
+        for userName in rooms[roomName]:
+            userToRouter[userName].handle_client_message(
+                ClientMessage(MessageType.JOIN_ROOM, userName, roomName=roomName), ConnectionCounter())
+    deliver_all(routers)
+    return routers, userToRouter, rooms
+
+
+def deliver_all(routers):
+    """ Handles messages until no router has messages pending
+    """
+    while True:
+        for router in routers:
+            router._flush_outboxes()
+        msgs = [(router, router.mailbox.drain(10 ** 8, 0)) for router in routers]
+        if not any(routerMsgs for router, routerMsgs in msgs):
+            return
+        for router, routerMsgs in msgs:
+            router._dispatch_batch(routerMsgs)
+
+
+def measure(routers, userToRouter, clientMsgs):
+    routerMsgCount = sum(router.mailbox.receivedCount for router in routers)
+    clientMsgCount = sum(connection.sentCount for router in routers
+                         for connection in router.userToWebSocketConnection.values())
+    start = time.perf_counter()
+    for clientMsg in clientMsgs:
+        userToRouter[clientMsg.senderUserName].handle_client_message(clientMsg, ConnectionCounter())
+        deliver_all(routers)
+    elapsedSec = time.perf_counter() - start
+    routerMsgCount = sum(router.mailbox.receivedCount for router in routers) - routerMsgCount
+    clientMsgCount = sum(connection.sentCount for router in routers
+                         for connection in router.userToWebSocketConnection.values()) - clientMsgCount
+    return routerMsgCount / len(clientMsgs), clientMsgCount / len(clientMsgs), len(clientMsgs) / elapsedSec
+
+
+def main():
+    random.seed(1)
+    config.MAILBOX_WIRE_FORMAT = 'pickle'  # Mailboxes are passed messages directly, nothing is encoded
+    routerCount, usersPerRouter, roomSize = 8, 2500, 5
+    routers, userToRouter, rooms = create_cluster(routerCount, usersPerRouter, roomSize)
+    print('%d routers, %d users, %d rooms of %d users' % (routerCount, len(userToRouter), len(rooms), roomSize))
+    print('%10s %14s %14s %12s' % ('method', 'router msgs', 'client msgs', 'msgs/s'))
+
+    userNames = list(userToRouter)
+    publicMsgs = [ClientMessage(MessageType.PUBLIC_MESSAGE, random.choice(userNames), 'hello') for _ in range(100)]
+    print('%10s %14.1f %14.1f %12.0f' % (('public', ) + measure(routers, userToRouter, publicMsgs)))
+
+    roomMsgs = []
+    for _ in range(10000):
+        roomName = random.choice(list(rooms))
+        roomMsgs.append(ClientMessage(MessageType.ROOM_MESSAGE, random.choice(rooms[roomName]), 'hello',
+                                      roomName=roomName))
+    print('%10s %14.1f %14.1f %12.0f' % (('room', ) + measure(routers, userToRouter, roomMsgs)))
+
+
+if __name__ == "__main__":
+    main()
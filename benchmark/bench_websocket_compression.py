@@ -0,0 +1,75 @@
+""" Measures permessage-deflate compression of chat messages broadcast to the users of a room:
+the bytes sent per message to each client, and the time to prepare the frames of one message for
+all clients. Compares uncompressed frames, one frame compressed once and shared by all clients
+without context takeover, and frames compressed per client with context takeover.
+
+Messages are public messages and user lists as the chat server sends them.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import random
+import time
+import zlib
+from tornado.websocket import PreparedMessage, WebSocketProtocol13, _PerMessageDeflateCompressor
+from protocol import ClientMessage, MessageType
+
+WORDS = ('the a to and of is in it you that he was for on are with as I his they be at one have this from '
+         'hello chat room message server today meeting lunch later thanks yes no maybe tomorrow').split()
+
+
+def create_messages(count, userCount):
+    random.seed(1)
+    userNames = ['user_%d' % i for i in range(userCount)]
+    messages = []
+    for _ in range(count):
+        text = ' '.join(random.choice(WORDS) for _ in range(random.randint(3, 20)))
+        messages.append(ClientMessage.to_json_bytes(
+            ClientMessage(MessageType.PUBLIC_MESSAGE, random.choice(userNames), text)))
+    return messages
+
+
+def measure(messages, clientCount):
+    uncompressedBytes = sharedBytes = perClientBytes = 0
+    compressor = _PerMessageDeflateCompressor(True, zlib.MAX_WBITS, 6)
+    sharedSec = perClientSec = 0.0
+    for message in messages:
+        uncompressedBytes += len(PreparedMessage(message).frame)
+
+        start = time.perf_counter()
+        prepared = PreparedMessage(message)
+        for _ in range(clientCount):
+            frame = prepared.compressed_frame(zlib.MAX_WBITS, 6)
+        sharedSec += time.perf_counter() - start
+        sharedBytes += len(frame)
+
+        # Every client's compressor has seen the same messages, so one stands for all in size,
+        # and the time of one compression is counted once per client
+        start = time.perf_counter()
+        frame = WebSocketProtocol13._build_frame(True, 0x1, compressor.compress(message), flags=0x40)
+        perClientSec += (time.perf_counter() - start) * clientCount
+        perClientBytes += len(frame)
+    count = len(messages)
+    return [('uncompressed', uncompressedBytes / count, 0.0),
+            ('shared', sharedBytes / count, sharedSec / count * 1e3),
+            ('per client', perClientBytes / count, perClientSec / count * 1e3)]
+
+
+def main():
+    clientCount = 1000
+    messages = create_messages(2000, 500)
+    print('%d clients, %d public messages of %.0f bytes on average' %
+          (clientCount, len(messages), sum(map(len, messages)) / len(messages)))
+    print('%14s %16s %20s' % ('frames', 'bytes/client', 'ms per broadcast'))
+    for name, bytesPerClient, msPerBroadcast in measure(messages, clientCount):
+        print('%14s %16.1f %20.3f' % (name, bytesPerClient, msPerBroadcast))
+
+    userList = ClientMessage.to_json_bytes(ClientMessage(MessageType.LIST_ALL_USERS,
+                                                         allUsers=['user_%d' % i for i in range(1000)]))
+    prepared = PreparedMessage(userList)
+    print('user list of 1000 users: %d bytes, %d compressed' % (len(prepared.frame), len(prepared.compressed_frame())))
+
+
+if __name__ == "__main__":
+    main()
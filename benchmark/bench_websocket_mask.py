@@ -0,0 +1,35 @@
+""" Measures unmasking of web socket frames from clients, which are all masked, comparing the
+XOR of one byte at a time over arrays against the XOR of the whole payload as two large integers.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import time
+from tornado.websocket import _websocket_mask_array, _websocket_mask_int
+
+
+def megabytes_per_sec(mask_function, mask, data, minDurationSec=0.5):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        mask_function(mask, data)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= minDurationSec:
+            return count * len(data) / elapsed / 1e6
+
+
+def main():
+    mask = os.urandom(4)
+    print('%10s %16s %16s %8s' % ('frame', 'array MB/s', 'int MB/s', 'speedup'))
+    for frameSize, label in [(100, '100 B'), (4096, '4 KB'), (1024 * 1024, '1 MB')]:
+        data = os.urandom(frameSize)
+        assert _websocket_mask_array(mask, data) == _websocket_mask_int(mask, data)
+        array = megabytes_per_sec(_websocket_mask_array, mask, data)
+        integer = megabytes_per_sec(_websocket_mask_int, mask, data)
+        print('%10s %16.1f %16.1f %7.1fx' % (label, array, integer, integer / array))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+""" Measures how fast the web socket protocol decodes the frames of a chatty client: a thread
+writes many small masked frames to one end of a socket pair, and the protocol reads them from an
+IOStream on the other end, handing the messages to a handler that only counts them.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import socket
+import threading
+import time
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.websocket import WebSocketProtocol13
+
+
+class CountingHandler:
+    """ Stands for the web socket handler, stopping the IOLoop when all messages are received
+    """
+    def __init__(self, stream, messageCount):
+        self.request = None
+        self.stream = stream
+        self.messageCount = messageCount
+        self.receivedCount = 0
+
+    def on_message(self, message):
+        self.receivedCount += 1
+        if self.receivedCount == self.messageCount:
+            self.stream.io_loop.stop()
+
+    def on_message_batch(self, messages):
+        self.receivedCount += len(messages)
+        if self.receivedCount == self.messageCount:
+            self.stream.io_loop.stop()
+
+
+def messages_per_sec(messageSize, messageCount):
+    ioLoop = IOLoop()
+    readerSocket, writerSocket = socket.socketpair()
+    handler = CountingHandler(IOStream(readerSocket, io_loop=ioLoop), messageCount)
+    protocol = WebSocketProtocol13(handler)
+    message = b'x' * messageSize
+    frames = b''.join(WebSocketProtocol13._build_frame(True, 0x1, message, True) for _ in range(messageCount))
+    writer = threading.Thread(target=writerSocket.sendall, args=(frames, ))
+    start = time.perf_counter()
+    writer.start()
+    protocol._receive_frame()
+    ioLoop.start()
+    elapsedSec = time.perf_counter() - start
+    writer.join()
+    handler.stream.close()
+    writerSocket.close()
+    ioLoop.close()
+    return messageCount / elapsedSec
+
+
+def main():
+    print('%10s %12s' % ('message', 'messages/s'))
+    for messageSize in [20, 100, 1000]:
+        print('%8d B %12.0f' % (messageSize, messages_per_sec(messageSize, 100000)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+""" Measures the size and the encoding and decoding time of server messages, comparing
+pickle with the compact wire format used between mailboxes.
+
+Messages are encoded one at a time and in batches, as sent by an outbox.
+"""
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import pickle
+import time
+import Pyro4.core
+import wire_format
+from protocol import ClientMessage, MessageType, ServerMessage
+
+
+def pickle_encode(msgs):
+    return pickle.dumps(msgs, pickle.HIGHEST_PROTOCOL)
+
+
+def create_messages(count):
+    routerUri = Pyro4.core.URI('PYRO:obj_0123456789abcdef@localhost:40001')
+    msgs = []
+    for i in range(count):
+        clientMsg = ClientMessage(MessageType.PUBLIC_MESSAGE, 'user_%d' % i, 'a typical chat line of moderate length')
+        msgs.append(ServerMessage(MessageType.FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS, routerUri, clientMsg))
+    return msgs
+
+
+def ns_per_message(function, data, messageCount, minDurationSec=0.5):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        function(data)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= minDurationSec:
+            return elapsed / (count * messageCount) * 1e9
+
+
+def main():
+    print('%10s %10s %14s %14s %14s' % ('batch', 'format', 'bytes/msg', 'encode ns/msg', 'decode ns/msg'))
+    for batchSize in [1, 64]:
+        msgs = create_messages(batchSize)
+        for formatName, encode, decode in [('pickle', pickle_encode, pickle.loads),
+                                           ('compact', wire_format.encode_messages, wire_format.decode_messages)]:
+            encoded = encode(msgs)
+            print('%10d %10s %14.1f %14.0f %14.0f' % (batchSize, formatName, len(encoded) / batchSize,
+                                                      ns_per_message(encode, msgs, batchSize),
+                                                      ns_per_message(decode, encoded, batchSize)))
+
+
+if __name__ == "__main__":
+    main()
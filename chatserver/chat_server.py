@@ -1,12 +1,25 @@
+import logging
 import os
 import sys
 import config
 sys.path.insert(0, config.LIBRARY_ABSOLUTE_PATH)
+import tornado.ioloop
 import tornado.web
 import tornado.websocket
+import time
+import Pyro4.errors
 from mailbox import Mailbox
+from outbound_queue import OutboundQueue, OutboundQueueStats
+from outbox import Outbox
+from presence import PresenceIndex
 from threading import Thread
-from protocol import ClientMessage, MessageType
+from protocol import BINARY_SUBPROTOCOL, ClientMessage, MessageType
+import logutil
+import user_registry
+
+
+log = logging.getLogger('chat_server')
+message_trace_log = logutil.get_message_trace_logger('chat_server')
 
 
 class MessageRouter(Thread):
@@ -17,69 +30,160 @@ class MessageRouter(Thread):
 
     A message router hosts arbitrary many client connections, and has knowledge
     about all other message router in the system.
+
+    If an IOLoop is provided, the router thread only hands mailbox deliveries over
+    to the loop, and all message handling and web socket writes happen on the IOLoop
+    thread. Otherwise messages are handled on the router thread itself.
+
+    Every message router knows the users of all message routers from a presence index. Logins and
+    logouts are sent to the other routers as numbered deltas, batched within the outbox flush interval,
+    and a periodic digest of each router's users lets the others detect a lost delta and request the
+    full list of the router's users.
+
+    Room messages are only sent to the message routers hosting users in the room. Each router tells
+    the others which rooms have local users, in batches like the presence deltas.
     """
-    def __init__(self, httpPort):
+    def __init__(self, mailbox, httpPort, ioLoop=None, mailboxTimeoutSec=1):
         super().__init__()
-        self.mailbox = Mailbox.create_mailbox()
-        self.messageRouterMailboxes = []  # Contains all message routers in system
-        self.userToRouterMailbox = {}  # Maps a user name to residing message router. Used for private messages
+        self.mailbox = mailbox
+        self.httpPort = httpPort
+        self.ioLoop = ioLoop
+        self.mailboxTimeoutSec = mailboxTimeoutSec
+        self.running = True
+        self.messageRouterMailboxes = []  # Contains outboxes for all message routers in system
+        self.peerRouterMailboxes = []  # Contains outboxes for all other message routers in system
+        self.messageRouterUris = []  # Mailbox uris of all message routers in system, as last announced by load balancer
+        self.routerOutboxes = {}  # Maps a message router mailbox uri to the outbox batching messages for it
+        self.outboxFlushDeadline = None  # Time when pending outbox messages must be sent, if any
+        self.loadReportDeadline = None  # Time when the next load report to the load balancer is due
+        self.presenceDigestDeadline = None  # Time when the next presence digest to the other message routers is due
+        self.presence = PresenceIndex()  # Maps a user name to its message router. Used for private messages
+        self.localRouterUri = str(self.mailbox.uri)
+        self.localRouterId = self.presence.get_router_id(self.localRouterUri)
+        self.presenceSequence = 0  # Sequence number of the last presence delta sent
+        self.pendingPresenceChanges = {}  # Maps a local user name to whether it was added or removed since the last delta
+        self.routerPresenceSequences = {}  # Maps a router id to the sequence number of the last delta received from it
+        self.presenceSyncPending = set()  # Ids of routers asked for a full list of their users
+        self.userPageCache = {}  # Maps (prefix, cursor) to the encoded page of users listed for it
+        self.userPageCacheVersion = 0  # Presence index version of the cached pages
+        self.roomToLocalUsers = {}  # Maps a room name to the set of local users in the room
+        self.userToRooms = {}  # Maps a local user name to the set of rooms it has joined
+        self.roomToRouterUris = {}  # Maps a room name to the set of uris of other message routers with users in the room
+        self.pendingRoomSubscriptions = {}  # Maps a room name to whether it got or lost local users since the last notification
         self.userToWebSocketConnection = {}  # Holds local web sockets connections
+        self.webSocketConnectionToUser = {}  # Maps a local connection to its user, for logging out closed connections
         self.pendingUserLoginToWebSocketConnection = {}  # Holds connections for users that are requesting login at user registry
+        self.closedPendingLogins = set()  # User names of pending logins whose connection closed before the registry response
+        self.pendingRegistryRequests = {}  # Maps (message type, registry shard name) to user names not yet sent to the shard
         self.clientMessageHandlers = {
             MessageType.LOGIN: self.login_handler,
             MessageType.LOGOUT: self.logout_handler,
             MessageType.PUBLIC_MESSAGE: self.public_message_handler,
             MessageType.PRIVATE_MESSAGE: self.private_message_handler,
-            MessageType.LIST_ALL_USERS: self.list_all_users_handler
+            MessageType.LIST_ALL_USERS: self.list_all_users_handler,
+            MessageType.JOIN_ROOM: self.join_room_handler,
+            MessageType.LEAVE_ROOM: self.leave_room_handler,
+            MessageType.ROOM_MESSAGE: self.room_message_handler
         }
         self.serverMessageHandlers = {
             MessageType.USER_REGISTRY_NEW_USER: self.user_registry_new_user_handler,
             MessageType.USER_REGISTRY_REMOVE_USER: self.user_registry_remove_user_handler,
+            MessageType.USER_REGISTRY_NEW_USERS: self.user_registry_new_users_handler,
+            MessageType.USER_REGISTRY_REMOVE_USERS: self.user_registry_remove_users_handler,
             MessageType.NEW_USER: self.new_user_handler,
             MessageType.REMOVE_USER: self.remove_user_handler,
             MessageType.NEW_MESSAGE_ROUTER: self.new_message_router_handler,
             MessageType.FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS: self.forward_public_message_to_all_clients_handler,
-            MessageType.FORWARD_PRIVATE_MESSAGE_TO_CLIENT: self.forward_private_message_to_client
+            MessageType.FORWARD_PRIVATE_MESSAGE_TO_CLIENT: self.forward_private_message_to_client,
+            MessageType.PRESENCE_DELTA: self.presence_delta_handler,
+            MessageType.PRESENCE_DIGEST: self.presence_digest_handler,
+            MessageType.PRESENCE_SYNC_REQUEST: self.presence_sync_request_handler,
+            MessageType.PRESENCE_SYNC: self.presence_sync_handler,
+            MessageType.ROOM_SUBSCRIPTIONS: self.room_subscriptions_handler,
+            MessageType.FORWARD_ROOM_MESSAGE: self.forward_room_message_handler
         }
 
-        self.userRegistryMailbox = self.mailbox.get_mailbox_proxy('user_registry')
+        self.userRegistryMailboxes = {name: self.mailbox.get_mailbox_proxy(name) for name in user_registry.get_all_shard_names()}
         self.loadBalancerMailbox = self.mailbox.get_mailbox_proxy('load_balancer')
 
         # Notify load balancer about this message router
         msg = self.mailbox.create_message(MessageType.REGISTER_CHAT_SERVER, httpPort)
         self.loadBalancerMailbox.put(msg)
+        self._schedule_load_report()
+        self._schedule_presence_digest()
+
+    def receive_client_message(self, msg, senderConnection):
+        """ Entry point for messages from local web socket connections.
+        Must be called from the IOLoop thread
+        """
+        if self.ioLoop is None:
+            self.mailbox.put((msg, senderConnection))  # Handled by router thread
+        else:
+            self.handle_client_message(msg, senderConnection)  # Already on the IOLoop thread
+
+    def receive_client_messages(self, msgs, senderConnection):
+        """ Entry point for messages received together from a local web socket connection.
+        Must be called from the IOLoop thread
+        """
+        if self.ioLoop is None:
+            self.mailbox.put_many([(msg, senderConnection) for msg in msgs])  # One lock and wakeup for all
+        else:
+            for msg in msgs:
+                self.handle_client_message(msg, senderConnection)
+
+    def receive_connection_closed(self, connection):
+        """ Entry point for closed local web socket connections. Logs out the user of the connection.
+        Must be called from the IOLoop thread
+        """
+        self.receive_client_message(ClientMessage(MessageType.LOGOUT), connection)
 
     def handle_client_message(self, msg, senderConnection):
         """ Invokes handler for client message type
         """
         if msg.messageType in self.clientMessageHandlers:
-            print('handling client message: ' + msg.messageType)
+            message_trace_log.debug('handling client message: %s', MessageType.to_name(msg.messageType))
             self.clientMessageHandlers[msg.messageType](msg, senderConnection)
         else:
-            print('unknown client message: ' + msg.messageType)  # Discard message
+            log.warning('unknown client message: %s', MessageType.to_name(msg.messageType))  # Discard message
 
     def handle_server_message(self, msg):
         """ Invokes handler for server message type
         """
         if msg.messageType in self.serverMessageHandlers:
-            print('handling server message: ' + msg.messageType)
+            message_trace_log.debug('handling server message: %s', MessageType.to_name(msg.messageType))
             self.serverMessageHandlers[msg.messageType](msg)
         else:
-            print('unknown server message: ' + msg.messageType)  # Discard message
+            log.warning('unknown server message: %s', MessageType.to_name(msg.messageType))  # Discard message
 
     ### Client message handlers ###
 
     def login_handler(self, clientMsg, senderConnection):
+        if clientMsg.senderUserName in self.pendingUserLoginToWebSocketConnection:
+            # Only one login per user name can wait for the registry, which would refuse the second anyway
+            senderConnection.send_message(ClientMessage(MessageType.LOGIN_FAILED, messageText='user name already taken'))
+            return
         self.pendingUserLoginToWebSocketConnection[clientMsg.senderUserName] = senderConnection  # Connection stored locally
-        requestMsg = self.mailbox.create_message(MessageType.USER_REGISTRY_NEW_USER, clientMsg.senderUserName)
-        self.userRegistryMailbox.put(requestMsg)
+        self._request_from_user_registry(MessageType.USER_REGISTRY_NEW_USERS, clientMsg.senderUserName)
 
     def logout_handler(self, clientMsg, senderConnection):
-        if clientMsg.senderUserName not in self.userToWebSocketConnection:
-            print('user should have a connection on logout')  # Log error. Discard message.
+        """ Logs out the user of a logout request, or of a closed connection, which has no user name set
+        """
+        userName = clientMsg.senderUserName or self.webSocketConnectionToUser.get(senderConnection)
+        if not userName:
+            self._close_pending_login(senderConnection)
+            return  # Closed connection without a logged in user
+        if userName not in self.userToWebSocketConnection:
+            log.error('user should have a connection on logout: %s', userName)  # Discard message
         else:
-            requestMsg = self.mailbox.create_message(MessageType.USER_REGISTRY_REMOVE_USER, clientMsg.senderUserName)
-            self.userRegistryMailbox.put(requestMsg)
+            self._request_from_user_registry(MessageType.USER_REGISTRY_REMOVE_USERS, userName)
+
+    def _close_pending_login(self, connection):
+        """ Marks the pending login of a closed connection, if any, to be undone once the registry responds
+        """
+        for userName, pendingConnection in self.pendingUserLoginToWebSocketConnection.items():
+            if pendingConnection is connection:
+                self.closedPendingLogins.add(userName)
+                return
 
     def public_message_handler(self, clientMsg, senderConnection):
         serverMsg = self.mailbox.create_message(MessageType.FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS, clientMsg)
@@ -89,19 +193,66 @@ class MessageRouter(Thread):
         """ Sends a private message to specified and requesting user
         If user does not exist, message is dropped
         """
-        if clientMsg.receiverUserName in self.userToRouterMailbox:
+        routerUri = self.presence.get_router_uri(clientMsg.receiverUserName)
+        if routerUri is not None:
             # Lookup message router hosting client, possibly this instance
-            routerMailbox = self.userToRouterMailbox[clientMsg.receiverUserName]
+            routerMailbox = self._get_router_outbox(routerUri)
             serverMsg = self.mailbox.create_message(MessageType.FORWARD_PRIVATE_MESSAGE_TO_CLIENT, clientMsg)
             routerMailbox.put(serverMsg)
             senderConnection.send_message(clientMsg)  # Notification to sender
         else:
             # Target user does not exist, discard message
-            print('user does not exist: ' + clientMsg.receiverUserName)
+            log.info('user does not exist: %s', clientMsg.receiverUserName)
 
     def list_all_users_handler(self, msg, senderConnection):
-        newMsg = ClientMessage(MessageType.LIST_ALL_USERS, allUsers=list(self.userToRouterMailbox.keys()))
-        senderConnection.send_message(newMsg)
+        """ Sends a page of users. Pages are encoded once, and cached until users log in or out
+        """
+        if self.userPageCacheVersion != self.presence.version:
+            self.userPageCache = {}
+            self.userPageCacheVersion = self.presence.version
+        pageKey = (msg.messageText, msg.cursor)
+        preparedMsg = self.userPageCache.get(pageKey)
+        if preparedMsg is None:
+            page, cursor = self.presence.get_user_page(msg.messageText, msg.cursor, config.LIST_ALL_USERS_PAGE_SIZE)
+            preparedMsg = WebSocketHandler.prepare_message(ClientMessage(MessageType.LIST_ALL_USERS, allUsers=page,
+                                                                         cursor=cursor))
+            if len(self.userPageCache) >= config.LIST_ALL_USERS_CACHED_PAGES:
+                self.userPageCache = {}  # Cursors come from clients, so the cache is bounded
+            self.userPageCache[pageKey] = preparedMsg
+        senderConnection.send_prepared_message(preparedMsg)
+
+    def join_room_handler(self, clientMsg, senderConnection):
+        userName, roomName = clientMsg.senderUserName, clientMsg.roomName
+        if userName not in self.userToWebSocketConnection or not roomName:
+            log.warning('user must be logged in to join room: %s', userName)  # Discard message
+            return
+        localUsers = self.roomToLocalUsers.setdefault(roomName, set())
+        if not localUsers:
+            self._queue_room_subscription(roomName, True)
+        localUsers.add(userName)
+        self.userToRooms.setdefault(userName, set()).add(roomName)
+        senderConnection.send_message(ClientMessage(MessageType.JOIN_ROOM, userName, roomName=roomName))
+
+    def leave_room_handler(self, clientMsg, senderConnection):
+        if self._leave_room(clientMsg.senderUserName, clientMsg.roomName):
+            senderConnection.send_message(ClientMessage(MessageType.LEAVE_ROOM, clientMsg.senderUserName,
+                                                        roomName=clientMsg.roomName))
+        else:
+            log.info('user is not in room: %s', clientMsg.senderUserName)  # Discard message
+
+    def room_message_handler(self, clientMsg, senderConnection):
+        """ Sends a room message to the users in the room, only involving message routers with users in the room.
+        If the sender is not in the room, message is dropped
+        """
+        if clientMsg.senderUserName not in self.roomToLocalUsers.get(clientMsg.roomName, ()):
+            log.info('user is not in room: %s', clientMsg.senderUserName)  # Discard message
+            return
+        routerUris = self.roomToRouterUris.get(clientMsg.roomName)
+        if routerUris:
+            serverMsg = self.mailbox.create_message(MessageType.FORWARD_ROOM_MESSAGE, clientMsg)
+            for routerUri in routerUris:
+                self._get_router_outbox(routerUri).put(serverMsg)
+        self._send_to_local_room_users(clientMsg)
 
     ### Server message handlers ###
 
@@ -109,53 +260,137 @@ class MessageRouter(Thread):
         """ Handles response from user registry whether login was successful or not
         """
         userName, successfullyRegistered = msg.data
+        self._complete_login(userName, successfullyRegistered)
 
+    def user_registry_new_users_handler(self, msg):
+        for userName, successfullyRegistered in msg.data:
+            self._complete_login(userName, successfullyRegistered)
+
+    def _complete_login(self, userName, successfullyRegistered):
         # Removed user from temporary storage for waiting for user registry response
-        connection = self.pendingUserLoginToWebSocketConnection[userName]
-        del self.pendingUserLoginToWebSocketConnection[userName]
+        connection = self.pendingUserLoginToWebSocketConnection.pop(userName, None)
+        if connection is None:
+            log.warning('user should have a pending login: %s', userName)  # Discard response
+            return
+        if userName in self.closedPendingLogins:
+            self.closedPendingLogins.discard(userName)
+            if successfullyRegistered:
+                # Connection is gone, so the name is released at the registry instead of registered locally
+                self._request_from_user_registry(MessageType.USER_REGISTRY_REMOVE_USERS, userName)
+            return
 
         if successfullyRegistered:
             self.userToWebSocketConnection[userName] = connection  # Permanently store connection
-            serverMsg = self.mailbox.create_message(MessageType.NEW_USER, userName)
-            self._send_to_all_message_routers(serverMsg)
+            self.webSocketConnectionToUser[connection] = userName
+            self.presence.remove_user(userName)  # The registry is authoritative over a stale entry of another router
+            self.presence.add_user(userName, self.localRouterId)
+            self._send_to_all_local_clients(ClientMessage(MessageType.LOGIN, userName))
+            self._queue_presence_change(userName, True)
         else:
             newMsg = ClientMessage(MessageType.LOGIN_FAILED, messageText='user name already taken')
             connection.send_message(newMsg)
 
     def user_registry_remove_user_handler(self, msg):
         userName, successfullyRemoved = msg.data
+        self._complete_logout(userName, successfullyRemoved)
+
+    def user_registry_remove_users_handler(self, msg):
+        for userName, successfullyRemoved in msg.data:
+            self._complete_logout(userName, successfullyRemoved)
+
+    def _complete_logout(self, userName, successfullyRemoved):
         if successfullyRemoved:
-            serverMsg = self.mailbox.create_message(MessageType.REMOVE_USER, userName)
-            self._send_to_all_message_routers(serverMsg)
+            if userName not in self.userToWebSocketConnection:
+                return  # Login of a connection closed while pending, never registered locally
+            self.presence.remove_user(userName)
+            self._send_to_all_local_clients(ClientMessage(MessageType.LOGOUT, userName))
+            for roomName in list(self.userToRooms.get(userName, ())):
+                self._leave_room(userName, roomName)
+            connection = self.userToWebSocketConnection.pop(userName)
+            self.webSocketConnectionToUser.pop(connection, None)
+            self._queue_presence_change(userName, False)
         else:
-            connection = self.userToWebSocketConnection[userName]
-            responseMsg = ClientMessage(MessageType.LOGOUT_FAILED, messageText='user does not exist')
-            connection.send_message(responseMsg)
+            connection = self.userToWebSocketConnection.get(userName)
+            if connection is not None:  # Else logged out already, by a logout racing with the closing connection
+                responseMsg = ClientMessage(MessageType.LOGOUT_FAILED, messageText='user does not exist')
+                connection.send_message(responseMsg)
 
     def new_user_handler(self, msg):
+        """ Login of a single user at another message router. Message routers send presence deltas instead
+        """
         userName = msg.data
-        if userName in self.userToRouterMailbox:
+        if not self.presence.add_user(userName, self._get_router_id(msg.senderMailboxUri)):
             # User should not already be registered. Log error, and discard message. Let client time out and retry.
-            print('warning: user should not already be registered')
+            log.warning('user should not already be registered: %s', userName)
         else:
-            self.userToRouterMailbox[userName] = self.mailbox.get_mailbox_proxy(msg.senderMailboxUri)
             clientMsg = ClientMessage(MessageType.LOGIN, userName)
             self._send_to_all_local_clients(clientMsg)
 
     def remove_user_handler(self, msg):
+        """ Logout of a single user at another message router. Message routers send presence deltas instead
+        """
         userName = msg.data
-        if userName not in self.userToRouterMailbox:
+        if not self.presence.remove_user(userName):
             # Should be registered. Log error, and discard message
-            print('warning: user should be registered')
+            log.warning('user should be registered: %s', userName)
         else:
             clientMsg = ClientMessage(MessageType.LOGOUT, userName)
             self._send_to_all_local_clients(clientMsg)
 
-            if userName in self.userToWebSocketConnection:
-                # This instance is hosting the user to be removed
-                # Remove book-keeping about client
-                del self.userToWebSocketConnection[userName]
-                del self.userToRouterMailbox[userName]
+    def presence_delta_handler(self, msg):
+        """ Applies the logins and logouts of another message router, unless a delta from it was lost
+        """
+        routerId = self._get_router_id(msg.senderMailboxUri)
+        sequence, addedUsers, removedUsers = msg.data
+        lastSequence = self.routerPresenceSequences.get(routerId, 0)
+        if sequence != lastSequence + 1 and routerId not in self.presenceSyncPending:
+            log.warning('lost presence delta from message router, expected %d, got %d', lastSequence + 1, sequence)
+            self._request_presence_sync(routerId)
+        self.routerPresenceSequences[routerId] = sequence
+        addedUsers = [userName for userName in addedUsers if self.presence.add_user(userName, routerId)]
+        removedUsers = [userName for userName in removedUsers if self.presence.remove_user(userName)]
+        self._apply_presence_changes(addedUsers, removedUsers)
+
+    def presence_digest_handler(self, msg):
+        """ Compares the users of another message router with its digest, and requests its full list of users
+        if they differ or a delta was lost
+        """
+        routerId = self._get_router_id(msg.senderMailboxUri)
+        sequence, userCount, digest = msg.data
+        if routerId in self.presenceSyncPending:
+            return
+        if sequence != self.routerPresenceSequences.get(routerId, 0):
+            log.warning('lost presence delta from message router, last %d', sequence)
+            self._request_presence_sync(routerId)
+        elif (userCount, digest) != self.presence.get_digest(routerId):
+            log.warning('presence digest mismatch for message router with %d users', userCount)
+            self._request_presence_sync(routerId)
+
+    def presence_sync_request_handler(self, msg):
+        self._send_presence_sync(self._get_router_outbox(msg.senderMailboxUri))
+
+    def presence_sync_handler(self, msg):
+        """ Replaces the users of another message router with its full list of users
+        """
+        routerId = self._get_router_id(msg.senderMailboxUri)
+        sequence, userNames = msg.data
+        self.presenceSyncPending.discard(routerId)
+        self.routerPresenceSequences[routerId] = sequence
+        addedUsers, removedUsers = self.presence.replace_router_users(routerId, userNames)
+        self._apply_presence_changes(addedUsers, removedUsers)
+
+    def room_subscriptions_handler(self, msg):
+        """ Notification from message router about rooms that got or lost its users
+        """
+        routerUri = str(msg.senderMailboxUri)
+        addedRooms, removedRooms = msg.data
+        for roomName in addedRooms:
+            self.roomToRouterUris.setdefault(roomName, set()).add(routerUri)
+        for roomName in removedRooms:
+            self._remove_room_router(roomName, routerUri)
+
+    def forward_room_message_handler(self, msg):
+        self._send_to_local_room_users(msg.data)
 
     def forward_public_message_to_all_clients_handler(self, msg):
         """ Request from message router to send attached message to all users of this message router
@@ -170,12 +405,208 @@ class MessageRouter(Thread):
             connection.send_message(clientMsg)
         else:
             # Routing error. Discard message
-            print('can not find connection for private message')
+            log.warning('can not find connection for private message to: %s', clientMsg.receiverUserName)
 
     def new_message_router_handler(self, msg):
         """ Notification from load balancer about message routers.
+        New message routers are sent the users of this router, and users of message routers removed
+        by the load balancer are logged out
+        """
+        knownRouterUris = set(str(uri) for uri in self.messageRouterUris)
+        currentRouterUris = set(str(uri) for uri in msg.data)
+        self.messageRouterUris = msg.data
+        self.messageRouterMailboxes = [self._get_router_outbox(uri) for uri in msg.data]
+        self.peerRouterMailboxes = [self._get_router_outbox(uri) for uri in msg.data if str(uri) != self.localRouterUri]
+        for routerUri in msg.data:
+            if str(routerUri) not in knownRouterUris and str(routerUri) != self.localRouterUri:
+                routerMailbox = self._get_router_outbox(routerUri)
+                if self.presenceSequence > 0 or self.userToWebSocketConnection:
+                    # A router that never had users has nothing to announce, its first delta will do
+                    self._send_presence_sync(routerMailbox)
+                if self.roomToLocalUsers:
+                    roomSubscriptions = (list(self.roomToLocalUsers), [])
+                    routerMailbox.put(self.mailbox.create_message(MessageType.ROOM_SUBSCRIPTIONS, roomSubscriptions))
+        for routerUri in knownRouterUris - currentRouterUris:
+            self._remove_message_router(routerUri)
+
+    def _get_router_outbox(self, routerMailboxUri):
+        """ Returns the outbox for a message router. Messages to a router share one outbox, which keeps them in order
+        """
+        routerUri = str(routerMailboxUri)  # Uris arrive as strings in the compact wire format
+        if routerUri not in self.routerOutboxes:
+            routerMailbox = self.mailbox.get_mailbox_proxy(routerMailboxUri)
+            self.routerOutboxes[routerUri] = Outbox(routerMailbox, config.OUTBOX_MAX_BATCH_SIZE,
+                                                    self._schedule_outbox_flush)
+        return self.routerOutboxes[routerUri]
+
+    def _get_router_id(self, routerMailboxUri):
+        return self.presence.get_router_id(str(routerMailboxUri))
+
+    def _schedule_outbox_flush(self):
+        """ Makes sure pending outbox messages are sent within the batching interval
+        """
+        if self.outboxFlushDeadline is None:
+            self.outboxFlushDeadline = time.time() + config.OUTBOX_FLUSH_INTERVAL_SEC
+            if self.ioLoop is not None:
+                self.ioLoop.add_timeout(self.outboxFlushDeadline, self._flush_outboxes)
+
+    def _flush_outboxes(self):
+        self.outboxFlushDeadline = None
+        self._send_presence_delta()
+        self._send_room_subscriptions()
+        for outbox in self.routerOutboxes.values():
+            outbox.flush()
+        for messageType, shardName in list(self.pendingRegistryRequests):
+            self._send_registry_request(messageType, shardName)
+
+    def _request_from_user_registry(self, messageType, userName):
+        """ Queues a user for the next batched request of the message type to the user's registry shard
+        """
+        shardName = user_registry.get_shard_name(userName)
+        userNames = self.pendingRegistryRequests.setdefault((messageType, shardName), [])
+        userNames.append(userName)
+        if len(userNames) >= config.USER_REGISTRY_MAX_BATCH_SIZE:
+            self._send_registry_request(messageType, shardName)
+        else:
+            self._schedule_outbox_flush()
+
+    def _send_registry_request(self, messageType, shardName):
+        userNames = self.pendingRegistryRequests.pop((messageType, shardName))
+        try:
+            self.userRegistryMailboxes[shardName].put(self.mailbox.create_message(messageType, userNames))
+        except Pyro4.errors.CommunicationError as e:
+            log.warning('failed to send request for %d users to user registry shard %s: %s', len(userNames),
+                        shardName, e)
+            if messageType == MessageType.USER_REGISTRY_NEW_USERS:
+                # No response will come, so the pending logins are answered here
+                for userName in userNames:
+                    connection = self.pendingUserLoginToWebSocketConnection.pop(userName, None)
+                    self.closedPendingLogins.discard(userName)
+                    if connection is not None:
+                        connection.send_message(ClientMessage(MessageType.LOGIN_FAILED,
+                                                              messageText='user registry unavailable'))
+
+    def _schedule_load_report(self):
+        self.loadReportDeadline = time.time() + config.LOAD_REPORT_INTERVAL_SEC
+        if self.ioLoop is not None:
+            self.ioLoop.add_timeout(self.loadReportDeadline, self._report_load)
+
+    def _report_load(self):
+        """ Sends the number of connections, mailbox depth and router loop latency to the load balancer.
+        The loop latency is how late the report is sent compared to when it was due
+        """
+        if not self.running:
+            return
+        loopLatencySec = max(0.0, time.time() - self.loadReportDeadline)
+        connectionCount = len(self.userToWebSocketConnection) + len(self.pendingUserLoginToWebSocketConnection)
+        load = (self.httpPort, connectionCount, self.mailbox.qsize(), loopLatencySec)
+        self.loadBalancerMailbox.put(self.mailbox.create_message(MessageType.CHAT_SERVER_LOAD_REPORT, load))
+        self._schedule_load_report()
+
+    def _queue_presence_change(self, userName, isAdded):
+        """ Queues a login or logout of a local user for the next presence delta.
+        Only the last change of a user within a delta is sent
+        """
+        self.pendingPresenceChanges[userName] = isAdded
+        self._schedule_outbox_flush()
+
+    def _send_presence_delta(self):
+        if self.pendingPresenceChanges:
+            self.presenceSequence += 1
+            addedUsers = [userName for userName, isAdded in self.pendingPresenceChanges.items() if isAdded]
+            removedUsers = [userName for userName, isAdded in self.pendingPresenceChanges.items() if not isAdded]
+            self.pendingPresenceChanges = {}
+            msg = self.mailbox.create_message(MessageType.PRESENCE_DELTA, (self.presenceSequence, addedUsers, removedUsers))
+            for routerMailbox in self.peerRouterMailboxes:
+                routerMailbox.put(msg)
+
+    def _send_presence_sync(self, routerMailbox):
+        """ Sends the list of local users. Includes changes not yet sent in a delta, which are
+        sent again by the delta with the next sequence number
+        """
+        data = (self.presenceSequence, list(self.userToWebSocketConnection))
+        routerMailbox.put(self.mailbox.create_message(MessageType.PRESENCE_SYNC, data))
+
+    def _request_presence_sync(self, routerId):
+        self.presenceSyncPending.add(routerId)
+        routerMailbox = self._get_router_outbox(self.presence.routerUris[routerId])
+        routerMailbox.put(self.mailbox.create_message(MessageType.PRESENCE_SYNC_REQUEST, None))
+
+    def _apply_presence_changes(self, addedUsers, removedUsers):
+        """ Notifies local clients about users added to and removed from the presence index
         """
-        self.messageRouterMailboxes = [self.mailbox.get_mailbox_proxy(uri) for uri in msg.data]
+        for userName in addedUsers:
+            self._send_to_all_local_clients(ClientMessage(MessageType.LOGIN, userName))
+        for userName in removedUsers:
+            self._send_to_all_local_clients(ClientMessage(MessageType.LOGOUT, userName))
+
+    def _leave_room(self, userName, roomName):
+        """ Returns False if the local user is not in the room
+        """
+        localUsers = self.roomToLocalUsers.get(roomName)
+        if not localUsers or userName not in localUsers:
+            return False
+        localUsers.remove(userName)
+        if not localUsers:
+            del self.roomToLocalUsers[roomName]
+            self._queue_room_subscription(roomName, False)
+        userRooms = self.userToRooms[userName]
+        userRooms.remove(roomName)
+        if not userRooms:
+            del self.userToRooms[userName]
+        return True
+
+    def _queue_room_subscription(self, roomName, isAdded):
+        """ Queues a room that got its first or lost its last local user, for the next notification of
+        the other message routers. Only the last change of a room within a notification is sent
+        """
+        self.pendingRoomSubscriptions[roomName] = isAdded
+        self._schedule_outbox_flush()
+
+    def _send_room_subscriptions(self):
+        if self.pendingRoomSubscriptions:
+            addedRooms = [roomName for roomName, isAdded in self.pendingRoomSubscriptions.items() if isAdded]
+            removedRooms = [roomName for roomName, isAdded in self.pendingRoomSubscriptions.items() if not isAdded]
+            self.pendingRoomSubscriptions = {}
+            msg = self.mailbox.create_message(MessageType.ROOM_SUBSCRIPTIONS, (addedRooms, removedRooms))
+            for routerMailbox in self.peerRouterMailboxes:
+                routerMailbox.put(msg)
+
+    def _remove_room_router(self, roomName, routerUri):
+        routerUris = self.roomToRouterUris.get(roomName)
+        if routerUris is not None:
+            routerUris.discard(routerUri)
+            if not routerUris:
+                del self.roomToRouterUris[roomName]
+
+    def _schedule_presence_digest(self):
+        self.presenceDigestDeadline = time.time() + config.PRESENCE_DIGEST_INTERVAL_SEC
+        if self.ioLoop is not None:
+            self.ioLoop.add_timeout(self.presenceDigestDeadline, self._send_presence_digest)
+
+    def _send_presence_digest(self):
+        """ Sends the count and digest of local users to the other message routers, after the pending delta
+        """
+        if not self.running:
+            return
+        self._send_presence_delta()
+        userCount, digest = self.presence.get_digest(self.localRouterId)
+        msg = self.mailbox.create_message(MessageType.PRESENCE_DIGEST, (self.presenceSequence, userCount, digest))
+        for routerMailbox in self.peerRouterMailboxes:
+            routerMailbox.put(msg)
+        self._schedule_presence_digest()
+
+    def _remove_message_router(self, routerUri):
+        self.routerOutboxes.pop(routerUri, None)
+        routerId = self.presence.routerUriToId.get(routerUri)
+        self.routerPresenceSequences.pop(routerId, None)
+        self.presenceSyncPending.discard(routerId)
+        removedUsers = self.presence.remove_router(routerUri)
+        for roomName in list(self.roomToRouterUris):
+            self._remove_room_router(roomName, routerUri)
+        log.warning('message router removed with %d users', len(removedUsers))
+        for userName in removedUsers:
+            self._send_to_all_local_clients(ClientMessage(MessageType.LOGOUT, userName))
 
     def _send_to_all_message_routers(self, msg):
         """ Helper method for broadcasting to all message routers in system, including current instance
@@ -184,52 +615,201 @@ class MessageRouter(Thread):
             routerMailbox.put(msg)
 
     def _send_to_all_local_clients(self, msg):
-        """ Helper method for broadcasting to all local clients
+        """ Helper method for broadcasting to all local clients.
+        The message is serialized and framed once per client protocol, and the same frame is written to every
+        connection of that protocol
         """
-        for userName, connection in self.userToWebSocketConnection.items():
-            connection.send_message(msg)
+        preparedMsg = WebSocketHandler.prepare_message(msg)
+        message_trace_log.debug('broadcasting client message: %s', MessageType.to_name(msg.messageType))
+        for connection in self.userToWebSocketConnection.values():
+            connection.send_prepared_message(preparedMsg)
 
-    def _handle_messages_forever(self):
+    def _send_to_local_room_users(self, msg):
+        """ Helper method for sending a room message to the local users in the room, serialized once
+        """
+        localUsers = self.roomToLocalUsers.get(msg.roomName)
+        if localUsers:
+            preparedMsg = WebSocketHandler.prepare_message(msg)
+            for userName in localUsers:
+                self.userToWebSocketConnection[userName].send_prepared_message(preparedMsg)
+
+    def _dispatch(self, msg):
         def is_client_msg(msg):
             return isinstance(msg, tuple)
 
-        while True:
-            msg = self.mailbox.get()  # Blocks
-            if is_client_msg(msg):
-                # Client message in mailbox is a tuple of the client's message and connection
-                msg, connection = msg
-                self.handle_client_message(msg, connection)
-            else:
-                # Server message is just the message
-                self.handle_server_message(msg)
+        if is_client_msg(msg):
+            # Client message in mailbox is a tuple of the client's message and connection
+            msg, connection = msg
+            self.handle_client_message(msg, connection)
+        else:
+            # Server message is just the message
+            self.handle_server_message(msg)
+
+    def _dispatch_batch(self, msgs):
+        for msg in msgs:
+            self._dispatch(msg)
+
+    def _handle_messages_forever(self):
+        while self.running:
+            timeout = self.mailboxTimeoutSec
+            if self.ioLoop is None:
+                # Wake up in time for sending pending outbox messages, the load report and the presence digest
+                for deadline in (self.outboxFlushDeadline, self.loadReportDeadline, self.presenceDigestDeadline):
+                    if deadline is not None:
+                        timeout = max(0, min(timeout, deadline - time.time()))
+            msgs = self.mailbox.drain(config.MAILBOX_DRAIN_BATCH_SIZE, timeout)  # Blocks
+            if self.ioLoop is None:
+                self._dispatch_batch(msgs)
+                if self.outboxFlushDeadline is not None and time.time() >= self.outboxFlushDeadline:
+                    self._flush_outboxes()
+                if time.time() >= self.loadReportDeadline:
+                    self._report_load()
+                if time.time() >= self.presenceDigestDeadline:
+                    self._send_presence_digest()
+            elif msgs:
+                # Thread-safe hand-off of the whole batch to the IOLoop thread
+                self.ioLoop.add_callback(self._dispatch_batch, msgs)
+
+    def stop(self):
+        self.running = False
 
     def run(self):
         self._handle_messages_forever()
 
 
-global_message_router_mailbox = None
+global_message_router = None
+outbound_queue_stats = OutboundQueueStats()
+
+
+class PreparedClientMessage:
+    """ A client message serialized at most once per client protocol, for sending to many connections.
+    Each encoding is serialized and framed on first use
+    """
+    __slots__ = ('message', '_jsonMessage', '_binaryMessage')
+
+    def __init__(self, message):
+        self.message = message
+        self._jsonMessage = None
+        self._binaryMessage = None
+
+    def json_message(self):
+        if self._jsonMessage is None:
+            self._jsonMessage = tornado.websocket.PreparedMessage(ClientMessage.to_json_bytes(self.message))
+        return self._jsonMessage
+
+    def binary_message(self):
+        if self._binaryMessage is None:
+            self._binaryMessage = tornado.websocket.PreparedMessage(ClientMessage.to_binary(self.message),
+                                                                    binary=True)
+        return self._binaryMessage
 
 
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
     """ Accepts web socket connections
+
+    Messages to the client go through a bounded outbound queue, which drops messages for a slow
+    reader and evicts a client that stays slow, instead of buffering without limit.
+
+    Clients offering the binary subprotocol exchange binary frames, see ClientMessage.to_binary,
+    and other clients exchange JSON text frames.
     """
     def __init__(self, *request, **kwargs):
         super().__init__(request[0], request[1])
+        self.binaryProtocol = False
+        self.outboundQueue = OutboundQueue(self, outbound_queue_stats, config.CONNECTION_QUEUE_HIGH_WATERMARK,
+                                           config.CONNECTION_QUEUE_LOW_WATERMARK,
+                                           config.CONNECTION_QUEUE_OVERFLOW_POLICY,
+                                           config.CONNECTION_SLOW_READER_EVICT_SEC)
+
+    def get_compression_options(self):
+        if not config.WEBSOCKET_COMPRESSION:
+            return None
+        return {'compression_level': config.WEBSOCKET_COMPRESSION_LEVEL,
+                'no_context_takeover': config.WEBSOCKET_COMPRESSION_NO_CONTEXT_TAKEOVER}
+
+    def select_subprotocol(self, subprotocols):
+        # Binary frames are not supported by the draft 76 protocol
+        if BINARY_SUBPROTOCOL in subprotocols and isinstance(self.ws_connection,
+                                                             tornado.websocket.WebSocketProtocol13):
+            self.binaryProtocol = True
+            return BINARY_SUBPROTOCOL
+        return None
+
+    @staticmethod
+    def decode_message(message):
+        """ Binary frames arrive as bytes and text frames as str
+        """
+        if isinstance(message, bytes):
+            return ClientMessage.from_binary(message)
+        return ClientMessage.from_json(message)
 
     def on_message(self, message):
         """ Wraps de-serialization of message object
         """
-        print('received client message:')
-        print(message)
-        msg = ClientMessage.from_json(message)
-        global_message_router_mailbox.put((msg, self))
+        message_trace_log.debug('received client message: %s', message)
+        msg = self.decode_message(message)
+        global_message_router.receive_client_message(msg, self)
+
+    def on_message_batch(self, messages):
+        """ Hands the messages decoded from one read to the router together
+        """
+        for message in messages:
+            message_trace_log.debug('received client message: %s', message)
+        msgs = [self.decode_message(message) for message in messages]
+        global_message_router.receive_client_messages(msgs, self)
 
     def send_message(self, message):
         """ Wraps serialization of message object
         """
-        print('sending client message:')
-        print(ClientMessage.to_json(message))
-        self.write_message(ClientMessage.to_json(message))
+        if self.binaryProtocol:
+            data = ClientMessage.to_binary(message)
+        else:
+            data = ClientMessage.to_json_bytes(message)
+        message_trace_log.debug('sending client message: %s', data)
+        self.outboundQueue.put(tornado.websocket.PreparedMessage(data, binary=self.binaryProtocol))
+
+    def send_prepared_message(self, preparedMessage):
+        """ Sends a message serialized by prepare_message, in the protocol of the client
+        """
+        if self.binaryProtocol:
+            self.outboundQueue.put(preparedMessage.binary_message())
+        else:
+            self.outboundQueue.put(preparedMessage.json_message())
+
+    def write_prepared_messages(self, preparedMessages, callback=None):
+        if not self.stream.closed():  # The connection may be closed before on_close is invoked
+            super().write_prepared_messages(preparedMessages, callback)
+
+    def is_writing(self):
+        return self.stream.writing()
+
+    def evict(self):
+        log.warning('evicting slow reader with %d messages dropped', self.outboundQueue.droppedCount)
+        self.stream.close()  # Invokes on_close
+
+    def on_close(self):
+        self.outboundQueue.close()
+        global_message_router.receive_connection_closed(self)
+
+    @staticmethod
+    def prepare_message(message):
+        """ Serializes a message once per client protocol, for sending the same frame to many connections
+        """
+        return PreparedClientMessage(message)
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    """ Serves counters of the chat server as JSON, for monitoring
+    """
+    def __init__(self, *request, **kwargs):
+        super().__init__(request[0], request[1])
+
+    def get(self):
+        self.write({
+            'connections': len(global_message_router.userToWebSocketConnection),
+            'outboundQueues': outbound_queue_stats.as_dict(),
+            'mailbox': global_message_router.mailbox.stats()
+        })
 
 
 class MainHandler(tornado.web.RequestHandler):
@@ -246,21 +826,25 @@ class MainHandler(tornado.web.RequestHandler):
 
 
 def main(httpPort):
-    messageRouter = MessageRouter(httpPort)
-    global global_message_router_mailbox
-    global_message_router_mailbox = messageRouter.mailbox
+    logutil.setup()
+    ioLoop = tornado.ioloop.IOLoop.instance() if config.MESSAGE_ROUTER_ON_IOLOOP else None
+    messageRouter = MessageRouter(Mailbox.create_mailbox(), httpPort, ioLoop)
+    global global_message_router
+    global_message_router = messageRouter
     messageRouter.start()
 
     application = tornado.web.Application(
         [
             (r"/", MainHandler),
-            (r"/websocket", WebSocketHandler)
+            (r"/websocket", WebSocketHandler),
+            (r"/stats", StatsHandler)
         ],
         template_path=os.path.join(os.path.dirname(__file__), "templates"),
-        static_path=os.path.join(os.path.dirname(__file__), "static")
+        static_path=os.path.join(os.path.dirname(__file__), "static"),
+        websocket_max_message_size=config.WEBSOCKET_MAX_MESSAGE_SIZE
     )
     application.listen(httpPort)
-    print('chat server running on port ' + str(httpPort))
+    log.info('chat server running on port %d', httpPort)
     tornado.ioloop.IOLoop.instance().start()  # Blocks
 
 
@@ -5,3 +5,98 @@ LIBRARY_ABSOLUTE_PATH = os.getcwd() + os.sep + os.pardir + os.sep + 'lib'
 LOAD_BALANCER_PORT = 8000
 CHAT_SERVER_PORT_LIST = [8001, 8002, 8003]
 
+# Number of user registry processes. Users are spread over them by a hash of the user name.
+USER_REGISTRY_SHARD_COUNT = 4
+
+# Directory of the user registry write-ahead logs and snapshots, or None for keeping users in memory only.
+# A snapshot is taken, and the log emptied, after this many logged operations.
+USER_REGISTRY_LOG_DIRECTORY = 'registry_log'
+USER_REGISTRY_SNAPSHOT_INTERVAL = 100000
+
+# Policy of the load balancer for choosing the chat server of a new client: 'power_of_two_choices' picks
+# the less loaded of two random chat servers, 'round_robin' picks the chat servers in turn
+LOAD_BALANCER_POLICY = 'power_of_two_choices'
+
+# The load of a chat server is its number of connections, plus these weights times its number of
+# queued mailbox messages and its router loop latency in seconds
+LOAD_BALANCER_MAILBOX_DEPTH_WEIGHT = 0.1
+LOAD_BALANCER_LOOP_LATENCY_WEIGHT = 1000
+
+# How often each chat server reports its load to the load balancer
+LOAD_REPORT_INTERVAL_SEC = 1.0
+
+# The load balancer pings the message router of each chat server at this interval, and removes a chat
+# server after this many pings in a row failed or took longer than the timeout
+HEALTH_CHECK_INTERVAL_SEC = 1.0
+HEALTH_CHECK_TIMEOUT_SEC = 0.5
+HEALTH_CHECK_MAX_MISSES = 3
+
+# Handle router messages on the Tornado IOLoop thread instead of the router thread
+MESSAGE_ROUTER_ON_IOLOOP = True
+
+# Messages to another message router are sent in batches of at most this many messages,
+# or after this interval has passed since the first message of the batch was queued
+OUTBOX_MAX_BATCH_SIZE = 64
+OUTBOX_FLUSH_INTERVAL_SEC = 0.001
+
+# How often each message router sends the digest of its users to the other message routers,
+# which request a full list of its users if their view of them differs
+PRESENCE_DIGEST_INTERVAL_SEC = 5.0
+
+# Messages to a web socket client wait in a queue while earlier messages are being written. A client
+# with this many bytes waiting is a slow reader, until it is down to the low watermark. Messages to
+# a slow reader are dropped, either the new messages ('drop_new') or the oldest waiting messages
+# ('drop_oldest'). A client that stays a slow reader for this long is disconnected.
+CONNECTION_QUEUE_HIGH_WATERMARK = 1024 * 1024
+CONNECTION_QUEUE_LOW_WATERMARK = 256 * 1024
+CONNECTION_QUEUE_OVERFLOW_POLICY = 'drop_oldest'
+CONNECTION_SLOW_READER_EVICT_SEC = 10.0
+
+# permessage-deflate compression of web socket messages, for clients that offer it, as browsers do.
+# Without context takeover, a message sent to many clients is compressed once and the same bytes go to
+# all of them. With context takeover, each connection compresses its messages against the earlier ones,
+# which compresses small messages far better, at the cost of compressing every message once per client
+# and of a compressor of a few hundred KB per connection.
+WEBSOCKET_COMPRESSION = True
+WEBSOCKET_COMPRESSION_LEVEL = 6
+WEBSOCKET_COMPRESSION_NO_CONTEXT_TAKEOVER = True
+
+# Largest message accepted from a client, in bytes, after decompression. A client sending a longer message
+# or frame is disconnected before the message is buffered or inflated past the limit.
+WEBSOCKET_MAX_MESSAGE_SIZE = 64 * 1024
+
+# Users are listed to clients in pages of this many users. This many encoded pages are cached
+# until the next login or logout
+LIST_ALL_USERS_PAGE_SIZE = 1000
+LIST_ALL_USERS_CACHED_PAGES = 1024
+
+# Logins and logouts are sent to each user registry shard in batches of at most this many users,
+# within the outbox flush interval
+USER_REGISTRY_MAX_BATCH_SIZE = 256
+
+# Encoding of message batches between mailboxes: 'pickle', or 'compact' (see wire_format.py), which sends
+# about a quarter fewer bytes but costs more CPU to encode and decode
+MAILBOX_WIRE_FORMAT = 'pickle'
+
+# Maximum number of remote mailbox proxies, and thereby connections, kept open by each mailbox
+MAILBOX_PROXY_CACHE_SIZE = 256
+
+# Maximum number of messages held by a mailbox, and what a put does when the mailbox is full:
+# 'block' waits for free space, 'drop_oldest' discards the oldest message, 'reject' discards the new message
+MAILBOX_CAPACITY = 10000
+MAILBOX_OVERFLOW_POLICY = 'block'
+
+# Maximum number of messages the message router takes from its mailbox per wakeup
+MAILBOX_DRAIN_BATCH_SIZE = 256
+
+# Log level of all loggers, and of specific loggers by name. Loggers are named after their module.
+# Each module traces every message it handles at DEBUG level to its '<module>.messages' logger,
+# e.g. 'chat_server.messages': 'DEBUG' enables the message trace of the chat server.
+LOG_LEVEL = 'INFO'
+LOG_MODULE_LEVELS = {}
+
+# One of every this many message trace records is logged
+LOG_MESSAGE_TRACE_SAMPLE_INTERVAL = 100
+
+# Maximum number of log records waiting to be written. Further records are dropped.
+LOG_QUEUE_SIZE = 10000
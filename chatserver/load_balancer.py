@@ -1,50 +1,197 @@
+import logging
+import random
 import sys
 import config
 sys.path.insert(0, config.LIBRARY_ABSOLUTE_PATH)
 import tornado.web
 import threading
+import time
+import Pyro4.errors
 from mailbox import Mailbox
 from protocol import MessageType
+import logutil
+import user_registry
+
+
+log = logging.getLogger('load_balancer')
+
+
+class ChatServerLoad:
+    """ A registered chat server, and the load it last reported
+    """
+    def __init__(self, httpPort, messageRouterUri):
+        self.httpPort = httpPort
+        self.messageRouterUri = messageRouterUri
+        self.connectionCount = 0
+        self.mailboxDepth = 0
+        self.loopLatencySec = 0.0
+        self.assignedClientCount = 0  # Clients sent to the chat server since its last load report
+        self.missedHealthChecks = 0  # Health checks failed in a row
+        self.healthCheckProxy = None  # Created by the first health check
+
+    def load(self):
+        """ Returns the estimated load, in number of connections
+        """
+        return (self.connectionCount + self.assignedClientCount +
+                config.LOAD_BALANCER_MAILBOX_DEPTH_WEIGHT * self.mailboxDepth +
+                config.LOAD_BALANCER_LOOP_LATENCY_WEIGHT * self.loopLatencySec)
 
 
 class LoadBalancer(threading.Thread):
-    """ Access point for clients. Round robin scheduling of front-end servers.
+    """ Access point for clients. Sends each new client to a chat server chosen by the
+    selection policy, using the load periodically reported by the chat servers.
 
-    TODO: Detect front-end server failure and broadcast notification
+    Chat servers are health checked by pinging their message router's mailbox. A chat server
+    failing HEALTH_CHECK_MAX_MISSES health checks in a row is removed, and the remaining
+    message routers and the user registry are notified.
     """
-    def __init__(self):
+    POLICY_POWER_OF_TWO_CHOICES = 'power_of_two_choices'  # The less loaded of two random chat servers
+    POLICY_ROUND_ROBIN = 'round_robin'  # Chat servers in turn, regardless of load
+
+    def __init__(self, mailbox, policy=None):
         super().__init__()
-        self.serverList = []
+        self.serverList = []  # Holds a ChatServerLoad for each registered chat server
+        self.routerUriToServer = {}  # Maps a message router mailbox uri to its chat server
         self.serverListLock = threading.Lock()
-        self.mailbox = Mailbox.create_mailbox('load_balancer')
+        # Held from changing the server list until the routers are sent the new list, so the routers receive
+        # the lists in the order of the changes. Sending does not hold serverListLock, which clients wait for.
+        self.routerListLock = threading.Lock()
+        self.nextServerIndex = 0  # Used by round robin
+        self.policy = policy if policy is not None else config.LOAD_BALANCER_POLICY
+        self.mailbox = mailbox
+        self.userRegistryMailboxes = [self.mailbox.get_mailbox_proxy(name) for name in user_registry.get_all_shard_names()]
 
     def get_next_server_address(self):
-        """ Returns the next chat server address using round robin scheduling.
-        Thread-safe, can be called externally
+        """ Returns the address of the chat server chosen for a new client, or None if no
+        chat server is registered. Thread-safe, can be called externally
         """
         with self.serverListLock:
-            server = self.serverList.pop()
-            self.serverList.insert(0, server)
-            httpPort, messageRouterUri = server
-            return 'http://localhost' + ':' + str(httpPort)
+            if not self.serverList:
+                return None
+            server = self._select_server()
+            server.assignedClientCount += 1
+            return 'http://localhost' + ':' + str(server.httpPort)
+
+    def _select_server(self):
+        if self.policy == LoadBalancer.POLICY_ROUND_ROBIN:
+            server = self.serverList[self.nextServerIndex % len(self.serverList)]
+            self.nextServerIndex += 1
+            return server
+        if len(self.serverList) == 1:
+            return self.serverList[0]
+        server, otherServer = random.sample(self.serverList, 2)
+        return server if server.load() <= otherServer.load() else otherServer
 
     def register_chat_server(self, msg):
         """ Returns the current registered message routers, including provided router
         """
         chatServerHttpPort = msg.data
+        with self.routerListLock:
+            with self.serverListLock:
+                server = ChatServerLoad(chatServerHttpPort, msg.senderMailboxUri)
+                self.serverList.append(server)
+                self.routerUriToServer[msg.senderMailboxUri] = server
+                messageRouters = [registeredServer.messageRouterUri for registeredServer in self.serverList]
+            self._send_message_routers(messageRouters)
+
+    def remove_chat_servers(self, servers):
+        """ Stops sending clients to the chat servers, and notifies the remaining message routers and
+        the user registry
+        """
+        with self.routerListLock:
+            with self.serverListLock:
+                for server in servers:
+                    self.serverList.remove(server)
+                    del self.routerUriToServer[server.messageRouterUri]
+                messageRouters = [registeredServer.messageRouterUri for registeredServer in self.serverList]
+            for server in servers:
+                log.warning('removed chat server on port %d', server.httpPort)
+                msg = self.mailbox.create_message(MessageType.USER_REGISTRY_REMOVE_MESSAGE_ROUTER,
+                                                  server.messageRouterUri)
+                for userRegistryMailbox in self.userRegistryMailboxes:
+                    try:
+                        userRegistryMailbox.put(msg)
+                    except Pyro4.errors.CommunicationError as e:
+                        log.warning('failed to notify user registry of removed chat server on port %d: %s',
+                                    server.httpPort, e)
+            self._send_message_routers(messageRouters)
+
+    def check_chat_servers(self):
+        """ Pings the message router of every chat server, and removes the chat servers
+        that missed too many health checks
+        """
         with self.serverListLock:
-            self.serverList.append((chatServerHttpPort, msg.senderMailboxUri))
-            messageRouters = [server[1] for server in self.serverList]
+            servers = list(self.serverList)
+        failedServers = []
+        for server in servers:
+            if self._ping(server):
+                server.missedHealthChecks = 0
+            else:
+                server.missedHealthChecks += 1
+                log.warning('chat server on port %d missed %d health checks', server.httpPort, server.missedHealthChecks)
+                if server.missedHealthChecks >= config.HEALTH_CHECK_MAX_MISSES:
+                    failedServers.append(server)
+        if failedServers:
+            self.remove_chat_servers(failedServers)
+
+    def _ping(self, server):
+        if server.healthCheckProxy is None:
+            server.healthCheckProxy = self.mailbox.get_health_check_proxy(server.messageRouterUri)
+        try:
+            server.healthCheckProxy.ping()
+            return True
+        except Pyro4.errors.CommunicationError:  # Includes timeouts
+            return False
+
+    def _send_message_routers(self, messageRouters):
+        """ Sends the list to every message router. A router that cannot be reached, such as a failed
+        one not removed yet, does not keep the others from being notified
+        """
         for routerUri in messageRouters:
             routerMailbox = self.mailbox.get_mailbox_proxy(routerUri)
             msg = self.mailbox.create_message(MessageType.NEW_MESSAGE_ROUTER, messageRouters)
-            routerMailbox.put(msg)
+            try:
+                routerMailbox.put(msg)
+            except Pyro4.errors.CommunicationError as e:
+                log.warning('failed to send message routers to %s: %s', routerUri, e)
+
+    def update_chat_server_load(self, msg):
+        httpPort, connectionCount, mailboxDepth, loopLatencySec = msg.data
+        with self.serverListLock:
+            server = self.routerUriToServer.get(msg.senderMailboxUri)
+            if server is None:
+                log.warning('load report from unregistered chat server on port %d', httpPort)
+                return
+            server.connectionCount = connectionCount
+            server.mailboxDepth = mailboxDepth
+            server.loopLatencySec = loopLatencySec
+            server.assignedClientCount = 0  # Now part of the reported connection count
 
     def run(self):
         while True:
             msg = self.mailbox.get()
             if msg.messageType == MessageType.REGISTER_CHAT_SERVER:
                     self.register_chat_server(msg)
+            elif msg.messageType == MessageType.CHAT_SERVER_LOAD_REPORT:
+                self.update_chat_server_load(msg)
+
+
+class HealthChecker(threading.Thread):
+    """ Health checks the chat servers of a load balancer at a fixed interval
+    """
+    def __init__(self, loadBalancer, intervalSec):
+        super().__init__()
+        self.loadBalancer = loadBalancer
+        self.intervalSec = intervalSec
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            time.sleep(self.intervalSec)
+            self.loadBalancer.check_chat_servers()
 
 
 global_load_balancer = None
@@ -55,16 +202,20 @@ class MainHttpHandler(tornado.web.RequestHandler):
     """
     def get(self):
         server = global_load_balancer.get_next_server_address()
+        if server is None:
+            raise tornado.web.HTTPError(503)  # No chat server registered yet
         self.redirect(server)
 
 
 def main():
+    logutil.setup()
     global global_load_balancer
-    global_load_balancer = LoadBalancer()
+    global_load_balancer = LoadBalancer(Mailbox.create_mailbox('load_balancer'))
     global_load_balancer.start()
+    HealthChecker(global_load_balancer, config.HEALTH_CHECK_INTERVAL_SEC).start()
     application = tornado.web.Application([
         (r"/", MainHttpHandler),
         ])
     application.listen(config.LOAD_BALANCER_PORT)
-    print('load balancer running')
+    log.info('load balancer running on port %d', config.LOAD_BALANCER_PORT)
     tornado.ioloop.IOLoop.instance().start()  # Blocks
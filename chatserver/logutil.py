@@ -0,0 +1,74 @@
+""" Logging setup for the server processes.
+
+Log records are handed to a bounded queue and written by a listener thread, so that no thread
+handling messages ever waits for a terminal, pipe or file. Records that do not fit in the queue
+are dropped. Levels are set per logger in config, and message traces, logged by each module at
+DEBUG level to its '<module>.messages' logger, are sampled.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import config
+
+
+LOG_FORMAT = '%(asctime)s %(process)d %(name)s %(levelname)s %(message)s'
+
+
+class SamplingFilter(logging.Filter):
+    """ Passes the first of every sampleInterval records
+    """
+    def __init__(self, sampleInterval):
+        super().__init__()
+        self.sampleInterval = sampleInterval
+        self.recordCount = 0  # Not locked, a racing increment only shifts the sample
+
+    def filter(self, record):
+        self.recordCount += 1
+        return self.sampleInterval <= 1 or self.recordCount % self.sampleInterval == 1
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Queues records without blocking, dropping records when the queue is full
+    """
+    def __init__(self, recordQueue):
+        super().__init__(recordQueue)
+        self.droppedCount = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.droppedCount += 1
+
+
+def get_message_trace_logger(moduleName):
+    """ Returns the sampled logger for tracing every message handled by a module
+    """
+    logger = logging.getLogger(moduleName + '.messages')
+    if not any(isinstance(f, SamplingFilter) for f in logger.filters):
+        logger.addFilter(SamplingFilter(config.LOG_MESSAGE_TRACE_SAMPLE_INTERVAL))
+    return logger
+
+
+def setup():
+    """ Configures logging for the current process, starting the listener thread writing to stderr.
+    Called once by each server process.
+    """
+    recordQueue = queue.Queue(config.LOG_QUEUE_SIZE)
+    streamHandler = logging.StreamHandler(sys.stderr)
+    streamHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(recordQueue, streamHandler)
+
+    rootLogger = logging.getLogger()
+    for handler in list(rootLogger.handlers):
+        rootLogger.removeHandler(handler)
+    rootLogger.addHandler(DroppingQueueHandler(recordQueue))
+    rootLogger.setLevel(config.LOG_LEVEL)
+    for loggerName, level in config.LOG_MODULE_LEVELS.items():
+        logging.getLogger(loggerName).setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)  # Writes the records still queued
+    return listener
@@ -1,17 +1,211 @@
+import collections
 import queue
+import threading
+import time
+import config
 import pyrocomm
 import Pyro4
+import Pyro4.errors
+import wire_format
 from protocol import ServerMessage
 
+# Oneway calls are executed by the daemon's worker thread for the calling connection,
+# instead of in a new thread per call. This also keeps oneway puts from a proxy in order.
+Pyro4.config.ONEWAY_THREADED = False
 
-class Mailbox(queue.Queue):
+
+class MailboxProxy(Pyro4.Proxy):
+    """ Proxy for a remote mailbox that reconnects if its connection was lost.
+    A call failing on a closed connection is retried once on a new connection,
+    for example after the remote side restarted. Names are looked up again on reconnect.
+    """
+    def _pyroInvoke(self, methodname, vargs, kwargs, flags=0):
+        try:
+            return super()._pyroInvoke(methodname, vargs, kwargs, flags)
+        except Pyro4.errors.ConnectionClosedError:
+            # Pyro released the broken connection, the retry creates a new one
+            return super()._pyroInvoke(methodname, vargs, kwargs, flags)
+
+
+class MailboxProxyCache:
+    """ Bounded, thread-safe cache of mailbox proxies keyed by name or uri.
+    Reusing a proxy reuses its connection. The least recently used proxy is evicted when the cache is full;
+    its connection is closed when the last holder lets go of it.
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.proxies = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, nameOrUri):
+        with self.lock:
+            if nameOrUri in self.proxies:
+                self.hits += 1
+                self.proxies.move_to_end(nameOrUri)
+                return self.proxies[nameOrUri]
+            self.misses += 1
+            proxy = self._create_proxy(nameOrUri)
+            self.proxies[nameOrUri] = proxy
+            if len(self.proxies) > self.maxSize:
+                self.proxies.popitem(last=False)
+                self.evictions += 1
+            return proxy
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.proxies), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    @staticmethod
+    def _create_proxy(nameOrUri):
+        if isinstance(nameOrUri, str):
+            proxy = MailboxProxy('PYRONAME:' + nameOrUri)
+        else:
+            proxy = MailboxProxy(nameOrUri)
+        proxy._pyroOneway.update(['put', 'put_many', 'put_encoded'])
+        return proxy
+
+
+class Mailbox:
     """ A thread-safe mailbox abstraction that is intended to be wrapped
     as a remote object
+
+    Holds at most 'capacity' messages, and a consumer can take a whole batch of messages
+    per wakeup with drain. The overflow policy decides what a put does when the mailbox is full:
+    OVERFLOW_BLOCK waits for free space, OVERFLOW_DROP_OLDEST discards the oldest message, and
+    OVERFLOW_REJECT discards the new message. Blocked puts and discarded messages are counted.
     """
-    def __init__(self):
-        super().__init__(1000)  # Maximum 1000 messages hard-coded
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_REJECT = 'reject'
+
+    def __init__(self, capacity=None, overflowPolicy=None):
+        self.capacity = capacity or config.MAILBOX_CAPACITY
+        self.overflowPolicy = overflowPolicy or config.MAILBOX_OVERFLOW_POLICY
+        self.messages = collections.deque()
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+        self.waitingConsumers = 0  # Conditions are only notified if someone is waiting
+        self.waitingProducers = 0
+        self.blockedCount = 0
+        self.droppedCount = 0
+        self.rejectedCount = 0
         self.uri = None
         self.daemon = None
+        self.proxyCache = MailboxProxyCache(config.MAILBOX_PROXY_CACHE_SIZE)
+
+    def put(self, msg):
+        """ Puts a message. Returns False if the message was rejected because the mailbox is full
+        """
+        with self.lock:
+            isAccepted = self._put(msg)
+            self._notify_consumer()
+            return isAccepted
+
+    def put_many(self, msgs):
+        """ Puts a batch of messages in order. Lets remote senders deliver several messages in one call
+        """
+        with self.lock:
+            for msg in msgs:
+                self._put(msg)
+            self._notify_consumer()
+
+    def put_encoded(self, data):
+        """ Puts a batch of messages encoded with wire_format.encode_messages
+        """
+        self.put_many(wire_format.decode_messages(data))
+
+    def get(self, block=True, timeout=None):
+        """ Removes and returns the oldest message.
+        Like queue.Queue, raises queue.Empty if no message is available in time
+        """
+        with self.lock:
+            if not self._wait_for_messages(block, timeout):
+                raise queue.Empty
+            msg = self.messages.popleft()
+            self._notify_producers(1)
+            self._notify_consumer()
+            return msg
+
+    def drain(self, maxCount, timeout=None):
+        """ Removes and returns up to maxCount of the oldest messages, after waiting for at least one.
+        Returns an empty list if no message is available in time
+        """
+        with self.lock:
+            if not self._wait_for_messages(True, timeout):
+                return []
+            msgs = [self.messages.popleft() for _ in range(min(maxCount, len(self.messages)))]
+            self._notify_producers(len(msgs))
+            self._notify_consumer()
+            return msgs
+
+    def qsize(self):
+        return len(self.messages)
+
+    def empty(self):
+        return not self.messages
+
+    def ping(self):
+        """ Answers a health check, without touching the queued messages
+        """
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.messages), 'blocked': self.blockedCount, 'dropped': self.droppedCount,
+                    'rejected': self.rejectedCount}
+
+    def _put(self, msg):
+        """ Appends a message, applying the overflow policy if the mailbox is full. Lock must be held
+        """
+        if len(self.messages) >= self.capacity:
+            if self.overflowPolicy == Mailbox.OVERFLOW_DROP_OLDEST:
+                self.messages.popleft()
+                self.droppedCount += 1
+            elif self.overflowPolicy == Mailbox.OVERFLOW_REJECT:
+                self.rejectedCount += 1
+                return False
+            else:
+                self.blockedCount += 1
+                self._notify_consumer()  # Consumers must see messages already put by a batch before we wait
+                self.waitingProducers += 1
+                try:
+                    while len(self.messages) >= self.capacity:
+                        self.notFull.wait()
+                finally:
+                    self.waitingProducers -= 1
+        self.messages.append(msg)
+        return True
+
+    def _wait_for_messages(self, block, timeout):
+        """ Returns True when there are messages to take. Lock must be held
+        """
+        if not self.messages and block:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            self.waitingConsumers += 1
+            try:
+                while not self.messages:
+                    if deadline is None:
+                        self.notEmpty.wait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.notEmpty.wait(remaining)
+            finally:
+                self.waitingConsumers -= 1
+        return bool(self.messages)
+
+    def _notify_consumer(self):
+        if self.waitingConsumers and self.messages:
+            self.notEmpty.notify()
+
+    def _notify_producers(self, freedCount):
+        if self.waitingProducers and freedCount:
+            self.notFull.notify(freedCount)
 
     def create_message(self, messageType, data):
         """ Wraps creation of server messages, and adds this mailbox's uri to the message
@@ -23,11 +217,22 @@ class Mailbox(queue.Queue):
         Look up a mailbox in global naming registry if a name is provided.
         If a uri is provided, the naming registry is not accessed.
         Instance method for testability
+
+        Put, put_many and put_encoded are oneway calls on the returned proxy: the messages are sent without
+        waiting for a reply, and remote errors are not reported back to the caller.
+
+        Proxies are cached, so callers asking for the same mailbox share one proxy and connection.
+        """
+        return self.proxyCache.get(nameOrUri)
+
+    def get_health_check_proxy(self, uri):
+        """ Returns a new proxy for pinging the mailbox at uri, whose calls fail after config.HEALTH_CHECK_TIMEOUT_SEC.
+        Not shared, so the timeout does not apply to other calls, and a slow ping does not hold up other callers.
+        Instance method for testability
         """
-        if isinstance(nameOrUri, str):
-            return Pyro4.Proxy('PYRONAME:' + nameOrUri)
-        else:
-            return Pyro4.Proxy(nameOrUri)
+        proxy = MailboxProxy(uri)
+        proxy._pyroTimeout = config.HEALTH_CHECK_TIMEOUT_SEC
+        return proxy
 
     @staticmethod
     def create_mailbox(name=None):
@@ -0,0 +1,117 @@
+""" Bounded queue of the messages waiting to be written to a web socket client.
+
+Messages are handed to the connection's stream one batch at a time: while a batch is being
+written, new messages wait in the queue, and when the batch is written, all waiting messages are
+written together as the next batch. The bytes waiting in the queue and in the batch being written
+are the client's backlog. A client whose backlog reaches the high watermark is a slow reader, and
+has messages dropped until its backlog is down to the low watermark. A client that stays a slow
+reader for too long is evicted.
+"""
+import collections
+import time
+
+
+DROP_NEW = 'drop_new'  # Drops messages sent to a slow reader
+DROP_OLDEST = 'drop_oldest'  # Drops the oldest waiting messages of a slow reader to make room for new ones
+
+
+class OutboundQueueStats:
+    """ Counters summed over the outbound queues of a process, for monitoring
+    """
+    def __init__(self):
+        self.sentCount = 0
+        self.droppedCount = 0
+        self.slowReaderCount = 0  # Times a client became a slow reader
+        self.evictedCount = 0
+
+    def as_dict(self):
+        return {'sent': self.sentCount, 'dropped': self.droppedCount, 'slowReaders': self.slowReaderCount,
+                'evicted': self.evictedCount}
+
+
+class OutboundQueue:
+    """ Queue of prepared messages for one connection. Not thread-safe, used on the IOLoop thread.
+
+    The connection must provide write_prepared_messages(messages, callback), invoking the callback
+    when the messages have been written, is_writing(), which tells if its stream has data not yet
+    written, and evict(), which closes it.
+    """
+    def __init__(self, connection, stats, highWatermark, lowWatermark, overflowPolicy, evictAfterSec):
+        self.connection = connection
+        self.stats = stats
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.overflowPolicy = overflowPolicy
+        self.evictAfterSec = evictAfterSec
+        self.waitingMessages = collections.deque()
+        self.waitingBytes = 0
+        self.writingBytes = 0  # Size of the batch being written, 0 if none
+        self.writeCount = 0  # Identifies the batch being written
+        self.slowReaderSince = None  # Time the client became a slow reader, if it is one
+        self.closed = False
+        self.droppedCount = 0
+
+    def backlog(self):
+        return self.waitingBytes + self.writingBytes
+
+    def put(self, preparedMessage):
+        if self.closed:
+            return
+        if self.writingBytes and not self.connection.is_writing():
+            self._on_written(self.writeCount)  # Write callback was replaced by another write on the stream
+        size = len(preparedMessage.data)
+        if self.slowReaderSince is None and self.backlog() + size > self.highWatermark:
+            self.slowReaderSince = time.monotonic()
+            self.stats.slowReaderCount += 1
+        if self.slowReaderSince is not None:
+            if time.monotonic() - self.slowReaderSince >= self.evictAfterSec:
+                self._evict()
+                return
+            if self.overflowPolicy == DROP_NEW:
+                self._count_dropped()
+                return
+            while self.waitingMessages and self.backlog() + size > self.highWatermark:
+                self.waitingBytes -= len(self.waitingMessages.popleft().data)
+                self._count_dropped()
+            if self.backlog() + size > self.highWatermark:
+                self._count_dropped()  # Does not fit even without waiting messages
+                return
+        self.waitingMessages.append(preparedMessage)
+        self.waitingBytes += size
+        if not self.writingBytes:
+            self._write_waiting_messages()
+
+    def close(self):
+        """ Discards waiting messages. Called when the connection is closed
+        """
+        self.closed = True
+        self.waitingMessages.clear()
+        self.waitingBytes = 0
+
+    def _write_waiting_messages(self):
+        preparedMessages = list(self.waitingMessages)
+        self.waitingMessages.clear()
+        self.writingBytes = self.waitingBytes
+        self.waitingBytes = 0
+        self.writeCount += 1
+        writeCount = self.writeCount
+        self.stats.sentCount += len(preparedMessages)
+        self.connection.write_prepared_messages(preparedMessages, lambda: self._on_written(writeCount))
+
+    def _on_written(self, writeCount):
+        if writeCount != self.writeCount or self.closed:
+            return  # Stale callback of an earlier batch
+        self.writingBytes = 0
+        if self.slowReaderSince is not None and self.waitingBytes <= self.lowWatermark:
+            self.slowReaderSince = None
+        if self.waitingMessages:
+            self._write_waiting_messages()
+
+    def _count_dropped(self):
+        self.droppedCount += 1
+        self.stats.droppedCount += 1
+
+    def _evict(self):
+        self.stats.evictedCount += 1
+        self.close()
+        self.connection.evict()
@@ -0,0 +1,45 @@
+import logging
+import Pyro4.errors
+import config
+import wire_format
+
+
+log = logging.getLogger('outbox')
+
+
+class Outbox:
+    """ Coalesces messages for one remote mailbox into batches, so that a batch is
+    delivered with a single remote call instead of one remote call per message.
+    Batches are pickled by Pyro, or sent in the compact wire format, depending on configuration.
+    A batch that cannot be delivered is dropped, as single messages to an unreachable mailbox are.
+
+    Not thread-safe. An outbox is owned by the thread handling the messages of its message router.
+    """
+    def __init__(self, mailboxProxy, maxBatchSize, scheduleFlush):
+        self.mailboxProxy = mailboxProxy
+        self.maxBatchSize = maxBatchSize
+        self.scheduleFlush = scheduleFlush  # Invoked when the outbox gets its first pending message
+        self.pendingMessages = []
+
+    def put(self, msg):
+        """ Queues a message. Sends the batch right away if it is full
+        """
+        self.pendingMessages.append(msg)
+        if len(self.pendingMessages) >= self.maxBatchSize:
+            self.flush()
+        elif len(self.pendingMessages) == 1:
+            self.scheduleFlush()
+
+    def flush(self):
+        """ Sends all pending messages in one remote call
+        """
+        if self.pendingMessages:
+            msgs = self.pendingMessages
+            self.pendingMessages = []
+            try:
+                if config.MAILBOX_WIRE_FORMAT == 'compact':
+                    self.mailboxProxy.put_encoded(wire_format.encode_messages(msgs))
+                else:
+                    self.mailboxProxy.put_many(msgs)
+            except Pyro4.errors.CommunicationError as e:
+                log.warning('dropped batch of %d messages to unreachable mailbox: %s', len(msgs), e)
@@ -0,0 +1,137 @@
+""" Index of the users logged in anywhere in the system, and the message router hosting each of them.
+
+Message routers are given small integer ids when first seen, so each user costs one dict entry
+holding a shared small int, however many routers there are. For each router the index keeps a
+user count and a digest, the XOR of the CRC-32 of its user names, which is updated per user in
+O(1) and can be compared with the digest the router reports for its own users.
+
+Users are listed in pages from a sorted snapshot of the user names, which is taken on the first
+listing after a change, so that pages are cut by binary search and any number of listings between
+changes cost one sort.
+"""
+import bisect
+import zlib
+
+
+def user_digest(userName):
+    return zlib.crc32(userName.encode('utf-8'))
+
+
+class PresenceIndex:
+    """ Maps user names to router ids, and router ids to router mailbox uris
+    """
+    def __init__(self):
+        self.userToRouterId = {}
+        self.routerUriToId = {}
+        self.routerUris = []  # Indexed by router id. None for a removed router
+        self.routerUserCounts = []  # Indexed by router id
+        self.routerDigests = []  # Indexed by router id
+        self.version = 0  # Incremented on every change of users
+        self.sortedUsers = []  # Snapshot of the user names, sorted
+        self.sortedUsersVersion = 0
+
+    def __contains__(self, userName):
+        return userName in self.userToRouterId
+
+    def __len__(self):
+        return len(self.userToRouterId)
+
+    def users(self):
+        return self.userToRouterId.keys()
+
+    def get_router_id(self, routerUri):
+        """ Returns the id of a router, giving it the next id if it has none
+        """
+        routerId = self.routerUriToId.get(routerUri)
+        if routerId is None:
+            routerId = len(self.routerUris)
+            self.routerUriToId[routerUri] = routerId
+            self.routerUris.append(routerUri)
+            self.routerUserCounts.append(0)
+            self.routerDigests.append(0)
+        return routerId
+
+    def get_router_uri(self, userName):
+        """ Returns the mailbox uri of the router hosting a user, or None for an unknown user
+        """
+        routerId = self.userToRouterId.get(userName)
+        return None if routerId is None else self.routerUris[routerId]
+
+    def add_user(self, userName, routerId):
+        """ Returns False if the user is already present
+        """
+        if userName in self.userToRouterId:
+            return False
+        self.userToRouterId[userName] = routerId
+        self.version += 1
+        self.routerUserCounts[routerId] += 1
+        self.routerDigests[routerId] ^= user_digest(userName)
+        return True
+
+    def remove_user(self, userName):
+        """ Returns False if the user is not present
+        """
+        routerId = self.userToRouterId.pop(userName, None)
+        if routerId is None:
+            return False
+        self.version += 1
+        self.routerUserCounts[routerId] -= 1
+        self.routerDigests[routerId] ^= user_digest(userName)
+        return True
+
+    def get_digest(self, routerId):
+        """ Returns the user count and digest of a router's users
+        """
+        return self.routerUserCounts[routerId], self.routerDigests[routerId]
+
+    def get_user_page(self, prefix, cursor, pageSize):
+        """ Returns up to pageSize user names starting with prefix, following cursor in user name order,
+        and the cursor of the next page, or '' if there are no more users.
+        The cursor is the last user name of a page, so listing continues correctly across changes
+        """
+        if self.sortedUsersVersion != self.version:
+            self.sortedUsers = sorted(self.userToRouterId)
+            self.sortedUsersVersion = self.version
+        sortedUsers = self.sortedUsers
+        start = bisect.bisect_left(sortedUsers, prefix)
+        if cursor:
+            start = max(start, bisect.bisect_right(sortedUsers, cursor))
+        # Names starting with prefix are contiguous from start. Find the end of the page among them
+        low, high = start, min(start + pageSize + 1, len(sortedUsers))
+        while low < high:
+            middle = (low + high) // 2
+            if sortedUsers[middle].startswith(prefix):
+                low = middle + 1
+            else:
+                high = middle
+        end = min(low, start + pageSize)
+        page = sortedUsers[start:end]
+        return page, page[-1] if low > end else ''
+
+    def get_router_users(self, routerId):
+        """ Returns the users of a router. Scans all users
+        """
+        return [userName for userName, userRouterId in self.userToRouterId.items() if userRouterId == routerId]
+
+    def replace_router_users(self, routerId, userNames):
+        """ Makes userNames the users of a router, as after a full sync. Returns the lists of added and removed users.
+        Users present on another router are left there
+        """
+        newUsers = set(userNames)
+        removedUsers = [userName for userName in self.get_router_users(routerId) if userName not in newUsers]
+        for userName in removedUsers:
+            self.remove_user(userName)
+        addedUsers = [userName for userName in userNames if self.add_user(userName, routerId)]
+        return addedUsers, removedUsers
+
+    def remove_router(self, routerUri):
+        """ Removes a router and its users. Returns the removed users
+        """
+        routerId = self.routerUriToId.pop(routerUri, None)
+        if routerId is None:
+            return []
+        removedUsers = self.get_router_users(routerId)
+        for userName in removedUsers:
+            self.remove_user(userName)
+        self.routerUris[routerId] = None
+        return removedUsers
@@ -1,9 +1,14 @@
 import json
+import struct
+import sys
 
 
 class MessageType:
     """ Defines all client and server message types
 
+    Message types are small integers, which are cheap to store, hash and compare, and fit
+    in one byte on the wire. Clients see the lower case constant names, see to_name and from_name.
+
     TODO: Might add factory method for the different message types for
     making the messages' structure more explicit
     """
@@ -14,29 +19,29 @@ class MessageType:
     Server acknowledgment for successful login.
     Server expects 'senderUserName' field to be set.
     """
-    LOGIN = 'login'
+    LOGIN = 1
 
     """ Server notification to client regarding failed login.
     Client expects 'messageText' field to contain reason for failure
     """
-    LOGIN_FAILED = 'login_failed'
+    LOGIN_FAILED = 2
 
     """ Client request for logout.
     Server acknowledgment for successful logout
     Server expects 'senderUserName' field to be set.
     """
-    LOGOUT = 'logout'
+    LOGOUT = 3
 
     """ Server notification to client regarding failed logout.
     Client expects 'messageText' field to contain reason for failure
     """
-    LOGOUT_FAILED = 'logout_failed'
+    LOGOUT_FAILED = 4
 
     """ Client request to send message to all users logged in.
     Server notification to client about public message.
     Expects 'senderUserName' and 'messageText' fields to be set.
     """
-    PUBLIC_MESSAGE = 'public_message'
+    PUBLIC_MESSAGE = 5
 
     """ Client request to send message to specified user.
     Server notification about private message.
@@ -44,96 +49,316 @@ class MessageType:
 
     Both 'senderUserName' and 'receiverUserName' should receive server notification.
     """
-    PRIVATE_MESSAGE = 'private_message'
+    PRIVATE_MESSAGE = 6
+
+    """ Client request for users currently logged in, one page at a time in user name order.
+    Server response containing a page of the users logged in.
+    Client may set 'messageText' to a prefix the user names must start with, and 'cursor' to the
+    cursor of the previous page for requesting the next page.
+    Client expects 'allUsers' field to be set, and 'cursor' to be set unless it is the last page.
+    """
+    LIST_ALL_USERS = 7
+
+    """ Client request for joining a room, receiving the messages sent to the room.
+    Server acknowledgment for successful join.
+    Server expects 'senderUserName' and 'roomName' fields to be set.
+    """
+    JOIN_ROOM = 24
+
+    """ Client request for leaving a room.
+    Server acknowledgment for successful leave.
+    Server expects 'senderUserName' and 'roomName' fields to be set.
+    """
+    LEAVE_ROOM = 25
 
-    """ Client request for all users currently logged in.
-    Server response containing all users logged in.
-    Client expects 'allUsers' field to be set.
+    """ Client request to send message to all users in a room the sender has joined.
+    Server notification about room message.
+    Expects 'senderUserName', 'messageText' and 'roomName' fields to be set.
     """
-    LIST_ALL_USERS = 'list_all_users'
+    ROOM_MESSAGE = 26
 
     ### Server messages (between chat servers, load balancer and user registry) ###
 
     """ Request for registering a chat server at the load balancer
     """
-    REGISTER_CHAT_SERVER = 'register_chat_server'
+    REGISTER_CHAT_SERVER = 8
 
     """ Notification between message routers when a new chat server and
-    associated message router has been registered successfully
+    associated message router has been registered successfully, or a failed
+    one has been removed. Data is the mailbox uris of all message routers
     """
-    NEW_MESSAGE_ROUTER = 'new_message_router'
+    NEW_MESSAGE_ROUTER = 9
 
     """ Chat server request for looking up or creating a new user in global user registry.
     User registry response for whether request was successful or not
     """
-    USER_REGISTRY_NEW_USER = 'user_registry_new_user'
+    USER_REGISTRY_NEW_USER = 10
 
     """ Chat server request for removing/logging out user in global user registry.
     User registry response for whether request was successful or not
     """
-    USER_REGISTRY_REMOVE_USER = 'user_registry_remove_user'
+    USER_REGISTRY_REMOVE_USER = 11
 
     """ Notification between chat servers about successful user login
     """
-    NEW_USER = 'new_user'
+    NEW_USER = 12
 
     """ Notification between chat servers about successful logout
     """
-    REMOVE_USER = 'remove_user'
+    REMOVE_USER = 13
 
     """ Request to message router to forward attached message to all clients
     """
-    FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS = 'forward_message_to_all_clients'
+    FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS = 14
 
     """ Request to message router to forward attached message to a specified client
     """
-    FORWARD_PRIVATE_MESSAGE_TO_CLIENT = 'forward_message_to_client'
+    FORWARD_PRIVATE_MESSAGE_TO_CLIENT = 15
+
+    """ Periodic report from chat server to load balancer about its load.
+    Data is a tuple of http port, connection count, mailbox depth and router loop latency in seconds
+    """
+    CHAT_SERVER_LOAD_REPORT = 16
+
+    """ Notification from load balancer to user registry that a message router was removed after failing
+    health checks. Data is the router's mailbox uri. The users of the router are removed
+    """
+    USER_REGISTRY_REMOVE_MESSAGE_ROUTER = 17
+
+    """ Chat server request for registering a batch of users in global user registry, as a list of user names.
+    User registry response with a list of (user name, whether request was successful) tuples
+    """
+    USER_REGISTRY_NEW_USERS = 18
+
+    """ Chat server request for removing a batch of users in global user registry, as a list of user names.
+    User registry response with a list of (user name, whether request was successful) tuples
+    """
+    USER_REGISTRY_REMOVE_USERS = 19
+
+    """ Notification from message router to all other message routers about its users logged in and out since
+    its previous delta. Data is a tuple of the delta's sequence number, and lists of added and removed user names
+    """
+    PRESENCE_DELTA = 20
+
+    """ Periodic notification from message router to all other message routers for detecting lost deltas.
+    Data is a tuple of the sequence number of the router's last delta, and the count and digest of its users
+    """
+    PRESENCE_DIGEST = 21
+
+    """ Message router request for the full list of users of another message router, after detecting a lost delta
+    """
+    PRESENCE_SYNC_REQUEST = 22
+
+    """ Full list of users of a message router, sent to a new message router or on request.
+    Data is a tuple of the sequence number of the router's last delta, and the list of its user names
+    """
+    PRESENCE_SYNC = 23
+
+    """ Notification from message router to all other message routers about rooms that got their first
+    local user, or lost their last local user, since its previous notification, or about all rooms with
+    local users when a message router is new. Data is a tuple of lists of added and removed room names
+    """
+    ROOM_SUBSCRIPTIONS = 27
+
+    """ Request from message router to send attached room message to the users of this message router in the room.
+    Only sent to message routers with users in the room
+    """
+    FORWARD_ROOM_MESSAGE = 28
+
+    @staticmethod
+    def to_name(messageType):
+        """ Returns the name of a message type, as used in JSON messages to clients
+        """
+        return _MESSAGE_TYPE_NAMES.get(messageType, str(messageType))
+
+    @staticmethod
+    def from_name(name):
+        """ Returns the message type of a name, or None for an unknown name
+        """
+        return _MESSAGE_TYPE_CODES.get(name)
+
+
+_MESSAGE_TYPE_NAMES = {value: name.lower() for name, value in vars(MessageType).items() if name.isupper()}
+_MESSAGE_TYPE_CODES = {name: value for value, name in _MESSAGE_TYPE_NAMES.items()}
+
+# Shared by all client messages. Compact separators, and the default ASCII output, which is valid UTF-8
+# and safe for any string a client can send.
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+_JSON_DECODER = json.JSONDecoder()
+
+# Web socket subprotocol of clients exchanging client messages as binary frames, see ClientMessage.to_binary.
+# Other clients exchange JSON text frames.
+BINARY_SUBPROTOCOL = 'chat.binary'
+
+# Optional string fields of binary client messages, in encoding order, followed by the user list
+_BINARY_STRING_FIELDS = ('senderUserName', 'messageText', 'receiverUserName', 'cursor', 'roomName')
+_BINARY_ALL_USERS_BIT = 1 << len(_BINARY_STRING_FIELDS)
+
+_BINARY_HEADER = struct.Struct('>BB')  # Message type code, bitmask of fields present
+_SHORT_LENGTH = struct.Struct('>H')
+_LONG_LENGTH = struct.Struct('>I')
+_LONG_STRING_MARKER = 0xFFFF  # Short length of strings with a long length following
+
+# Separator of the user names of a binary user list. Lists are encoded and decoded with the separator character,
+# which is then replaced by the separator byte.
+_USER_NAME_SEPARATOR = b'\xff'
+_USER_NAME_SEPARATOR_CHAR = '\uffff'
+_ENCODED_USER_NAME_SEPARATOR_CHAR = _USER_NAME_SEPARATOR_CHAR.encode('utf-8')
 
 
 class Message:
     """ Base class for messages. All messages must have a message type.
     """
+    __slots__ = ('messageType', )
+
     def __init__(self, messsageType):
         self.messageType = messsageType  # Mandatory field for all messages
 
 
 class ClientMessage(Message):
-    """ Used between chat server and clients
+    """ Used between chat server and clients.
+
+    User names are interned, so the many messages from and to the same user share one string.
     """
-    def __init__(self, messageType, senderUserName='', messageText='', receiverUserName='', allUsers=[]):
+    __slots__ = ('senderUserName', 'messageText', 'receiverUserName', 'allUsers', 'cursor', 'roomName')
+
+    def __init__(self, messageType, senderUserName='', messageText='', receiverUserName='', allUsers=None,
+                 cursor='', roomName=''):
         super().__init__(messageType)
-        self.senderUserName = senderUserName
+        self.senderUserName = sys.intern(senderUserName)
         self.messageText = messageText
-        self.receiverUserName = receiverUserName  # Only used for private messages
+        self.receiverUserName = sys.intern(receiverUserName)  # Only used for private messages
         self.allUsers = allUsers  # Only used for listing of all users
+        self.cursor = cursor  # Only used for listing of all users, where to continue the listing
+        self.roomName = sys.intern(roomName)  # Only used for rooms
 
     @staticmethod
     def to_json(message):
-        return json.dumps(message.__dict__)
+        """ Encodes a client message to JSON, leaving out empty fields
+        """
+        fields = {'messageType': MessageType.to_name(message.messageType)}
+        if message.senderUserName:
+            fields['senderUserName'] = message.senderUserName
+        if message.messageText:
+            fields['messageText'] = message.messageText
+        if message.receiverUserName:
+            fields['receiverUserName'] = message.receiverUserName
+        if message.allUsers is not None:
+            fields['allUsers'] = message.allUsers
+        if message.cursor:
+            fields['cursor'] = message.cursor
+        if message.roomName:
+            fields['roomName'] = message.roomName
+        return _JSON_ENCODER.encode(fields)
+
+    @staticmethod
+    def to_json_bytes(message):
+        """ Encodes a client message to JSON as UTF-8 bytes, ready to be sent in a web socket frame
+        """
+        return ClientMessage.to_json(message).encode('ascii')  # The encoder escapes all non-ASCII characters
 
     @staticmethod
     def from_json(message):
-        dict = json.loads(message)
-        messageType = dict['messageType']
-        senderUserName = dict['senderUserName']
-        messageText = ''
-        receiverUserName = ''
-        listAllUsers = []
-        if 'messageText' in dict:
-            messageText = dict['messageText']
-        if 'receiverUserName' in dict:
-            receiverUserName = dict['receiverUserName']
-        if 'list_all_users' in dict:
-            listAllUsers = dict['receiverUserName']
-
-        return ClientMessage(messageType, senderUserName, messageText, receiverUserName, listAllUsers)
+        """ Decodes a client message from JSON, where any field but the message type may be left out
+        """
+        fields = _JSON_DECODER.decode(message)
+        return ClientMessage(MessageType.from_name(fields['messageType']),
+                             fields.get('senderUserName', ''),
+                             fields.get('messageText', ''),
+                             fields.get('receiverUserName', ''),
+                             fields.get('allUsers'),
+                             fields.get('cursor', ''),
+                             fields.get('roomName', ''))
+
+    @staticmethod
+    def to_binary(message):
+        """ Encodes a client message for clients of the binary subprotocol: the message type code, a bitmask of
+        the fields present, then the fields present. Strings are UTF-8 prefixed by their length, and empty strings
+        are left out. The user list is its length followed by one string of the user names separated by 0xFF,
+        which never occurs in UTF-8, so a whole list is encoded and decoded at once.
+        """
+        parts = [None]
+        presentFields = 0
+        for bit, field in enumerate(_BINARY_STRING_FIELDS):
+            value = getattr(message, field)
+            if value:
+                presentFields |= 1 << bit
+                _pack_binary_bytes(parts, value.encode('utf-8', 'surrogatepass'))
+        if message.allUsers is not None:
+            presentFields |= _BINARY_ALL_USERS_BIT
+            parts.append(_LONG_LENGTH.pack(len(message.allUsers)))
+            _pack_binary_bytes(parts, _encode_user_names(message.allUsers))
+        parts[0] = _BINARY_HEADER.pack(message.messageType, presentFields)
+        return b''.join(parts)
+
+    @staticmethod
+    def from_binary(data):
+        """ Decodes a client message encoded by to_binary
+        """
+        messageType, presentFields = _BINARY_HEADER.unpack_from(data)
+        offset = _BINARY_HEADER.size
+        fields = {}
+        for bit, field in enumerate(_BINARY_STRING_FIELDS):
+            if presentFields & (1 << bit):
+                encoded, offset = _unpack_binary_bytes(data, offset)
+                fields[field] = str(encoded, 'utf-8', 'surrogatepass')
+        if presentFields & _BINARY_ALL_USERS_BIT:
+            userCount, = _LONG_LENGTH.unpack_from(data, offset)
+            encoded, offset = _unpack_binary_bytes(data, offset + _LONG_LENGTH.size)
+            fields['allUsers'] = _decode_user_names(encoded, userCount)
+        return ClientMessage(messageType, **fields)
+
+
+def _pack_binary_bytes(parts, encoded):
+    if len(encoded) < _LONG_STRING_MARKER:
+        parts.append(_SHORT_LENGTH.pack(len(encoded)))
+    else:
+        parts.append(_SHORT_LENGTH.pack(_LONG_STRING_MARKER))
+        parts.append(_LONG_LENGTH.pack(len(encoded)))
+    parts.append(encoded)
+
+
+def _unpack_binary_bytes(data, offset):
+    """ Returns the bytes of the string at the offset, and the offset after it
+    """
+    length, = _SHORT_LENGTH.unpack_from(data, offset)
+    offset += _SHORT_LENGTH.size
+    if length == _LONG_STRING_MARKER:
+        length, = _LONG_LENGTH.unpack_from(data, offset)
+        offset += _LONG_LENGTH.size
+    if offset + length > len(data):
+        raise ValueError('binary client message truncated')
+    return data[offset:offset + length], offset + length
+
+
+def _encode_user_names(userNames):
+    # Lone surrogates are valid in JSON messages, so are passed through here too
+    encoded = _USER_NAME_SEPARATOR_CHAR.join(userNames).encode('utf-8', 'surrogatepass')
+    if encoded.count(_ENCODED_USER_NAME_SEPARATOR_CHAR) == max(len(userNames) - 1, 0):
+        return encoded.replace(_ENCODED_USER_NAME_SEPARATOR_CHAR, _USER_NAME_SEPARATOR)
+    # Some user name contains the separator character
+    return _USER_NAME_SEPARATOR.join([userName.encode('utf-8', 'surrogatepass') for userName in userNames])
+
+
+def _decode_user_names(encoded, userCount):
+    if userCount == 0:
+        return []
+    userNames = str(encoded.replace(_USER_NAME_SEPARATOR, _ENCODED_USER_NAME_SEPARATOR_CHAR), 'utf-8',
+                    'surrogatepass').split(_USER_NAME_SEPARATOR_CHAR)
+    if len(userNames) != userCount:
+        # Some user name contains the separator character
+        userNames = [str(userName, 'utf-8', 'surrogatepass') for userName in encoded.split(_USER_NAME_SEPARATOR)]
+        if len(userNames) != userCount:
+            raise ValueError('binary client message has %d user names, expected %d' % (len(userNames), userCount))
+    return userNames
 
 
 class ServerMessage(Message):
     """ Used between servers, chat servers, load balancer and user registry
     """
+    __slots__ = ('senderMailboxUri', 'data')
+
     def __init__(self, messageType, senderMailboxUri, data):
         super().__init__(messageType)
-        self.messageType = messageType
         self.senderMailboxUri = senderMailboxUri
         self.data = data
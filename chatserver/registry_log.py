@@ -0,0 +1,146 @@
+""" Append-only log of user registry operations, for recovering the registry after a crash.
+
+Operations are appended to a pending buffer and written with one write and one fsync per commit,
+so a whole batch of registrations costs a single disk flush (group commit). Every snapshotInterval
+records the full registry is written to a snapshot file, which atomically replaces the previous
+snapshot, and the log is truncated.
+
+Each record is protected by a CRC-32, and replay stops at the first torn or corrupt record, as left
+by a crash in the middle of a write. Replaying the log on top of a snapshot that already contains
+its operations gives the same registry, so a crash between writing a snapshot and truncating the
+log is harmless.
+"""
+import os
+import struct
+import zlib
+
+
+OP_REGISTER = 1
+OP_REMOVE = 2
+
+_CRC = struct.Struct('>I')
+_RECORD_HEADER = struct.Struct('>BII')  # Operation, user name length, router uri length
+
+
+def encode_record(op, userName, routerUri=''):
+    encodedUserName = userName.encode('utf-8')
+    encodedRouterUri = routerUri.encode('utf-8')
+    body = _RECORD_HEADER.pack(op, len(encodedUserName), len(encodedRouterUri)) + encodedUserName + encodedRouterUri
+    return _CRC.pack(zlib.crc32(body)) + body
+
+
+def decode_records(data):
+    """ Returns the list of (operation, user name, router uri) of the valid records in data, and the
+    length of the valid data
+    """
+    records = []
+    offset = 0
+    headerSize = _CRC.size + _RECORD_HEADER.size
+    while offset + headerSize <= len(data):
+        crc, = _CRC.unpack_from(data, offset)
+        op, userNameLength, routerUriLength = _RECORD_HEADER.unpack_from(data, offset + _CRC.size)
+        end = offset + headerSize + userNameLength + routerUriLength
+        if end > len(data) or zlib.crc32(data[offset + _CRC.size:end]) != crc:
+            break  # Torn or corrupt record
+        userNameEnd = offset + headerSize + userNameLength
+        records.append((op, str(data[offset + headerSize:userNameEnd], 'utf-8'), str(data[userNameEnd:end], 'utf-8')))
+        offset = end
+    return records, offset
+
+
+class RegistryLog:
+    """ Write-ahead log and snapshot of a user registry, stored as '<name>.log' and '<name>.snapshot'
+    in a directory. Not thread-safe, owned by the registry thread.
+
+    Usage: replay once on startup, then append operations and commit them before acknowledging them.
+    """
+    def __init__(self, directory, name, snapshotInterval):
+        self.directory = directory
+        self.logPath = os.path.join(directory, name + '.log')
+        self.snapshotPath = os.path.join(directory, name + '.snapshot')
+        self.snapshotInterval = snapshotInterval
+        self.logFile = None
+        self.pendingRecords = []
+        self.recordCount = 0  # Records in the log file since the last snapshot
+        self.commitCount = 0
+        self.snapshotCount = 0
+
+    def replay(self):
+        """ Returns the users recovered from the snapshot and the log, as a dict from user name to
+        router mailbox uri string, and opens the log for appending
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        users = {}
+        self._replay_file(self.snapshotPath, users)
+        self.recordCount, validLength = self._replay_file(self.logPath, users)
+        self.logFile = open(self.logPath, 'ab')
+        self.logFile.truncate(validLength)  # Drops a torn record, appends continue after the valid ones
+        return users
+
+    def append_register(self, userName, routerUri):
+        self.pendingRecords.append(encode_record(OP_REGISTER, userName, str(routerUri)))
+
+    def append_remove(self, userName):
+        self.pendingRecords.append(encode_record(OP_REMOVE, userName))
+
+    def commit(self, users):
+        """ Writes and flushes the pending records to disk in one go. Takes a snapshot of users,
+        which must include the committed operations, when one is due
+        """
+        if not self.pendingRecords:
+            return
+        self.logFile.write(b''.join(self.pendingRecords))
+        self.logFile.flush()
+        os.fsync(self.logFile.fileno())
+        self.recordCount += len(self.pendingRecords)
+        self.pendingRecords = []
+        self.commitCount += 1
+        if self.recordCount >= self.snapshotInterval:
+            self.snapshot(users)
+
+    def snapshot(self, users):
+        """ Replaces the snapshot with users, and empties the log
+        """
+        temporaryPath = self.snapshotPath + '.tmp'
+        with open(temporaryPath, 'wb') as snapshotFile:
+            snapshotFile.write(b''.join(encode_record(OP_REGISTER, userName, str(routerUri))
+                                        for userName, routerUri in users.items()))
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        os.replace(temporaryPath, self.snapshotPath)
+        self._fsync_directory()
+        self.logFile.truncate(0)
+        self.logFile.flush()
+        os.fsync(self.logFile.fileno())
+        self.recordCount = 0
+        self.snapshotCount += 1
+
+    def close(self):
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+
+    @staticmethod
+    def _replay_file(path, users):
+        """ Applies the records of a file to users. Returns the number of records and the length of the valid data
+        """
+        if not os.path.exists(path):
+            return 0, 0
+        with open(path, 'rb') as file:
+            data = file.read()
+        records, validLength = decode_records(data)
+        for op, userName, routerUri in records:
+            if op == OP_REGISTER:
+                users[userName] = routerUri
+            elif op == OP_REMOVE:
+                users.pop(userName, None)
+        return len(records), validLength
+
+    def _fsync_directory(self):
+        """ Makes the rename of the snapshot durable
+        """
+        directoryFd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directoryFd)
+        finally:
+            os.close(directoryFd)
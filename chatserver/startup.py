@@ -9,8 +9,9 @@ import time
 if __name__ == "__main__":
     """ Dispatches servers in correct order, as processes
     """
-    user_registry_process = Process(target=user_registry.main)
-    user_registry_process.start()
+    for shardIndex in range(config.USER_REGISTRY_SHARD_COUNT):
+        user_registry_process = Process(target=user_registry.main, args=(shardIndex, ))
+        user_registry_process.start()
     load_balancer_process = Process(target=load_balancer.main)
     load_balancer_process.start()
     time.sleep(1)  # Simple solution for avoiding race conditions towards Pyro name server
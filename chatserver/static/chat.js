@@ -7,32 +7,198 @@ var Protocol = {
     LOGOUT_FAILED: 'logout_failed',
     PUBLIC_MESSAGE: 'public_message',
     PRIVATE_MESSAGE: 'private_message',
-    LIST_ALL_USERS: 'list_all_users'
+    LIST_ALL_USERS: 'list_all_users',
+    JOIN_ROOM: 'join_room',
+    LEAVE_ROOM: 'leave_room',
+    ROOM_MESSAGE: 'room_message'
 };
 
-var Message = function(messageType, senderUserName, messageText, receiverUserName, allUsers) {
+var Message = function(messageType, senderUserName, messageText, receiverUserName, allUsers, cursor, roomName) {
     return {
         messageType: messageType,
         senderUserName: senderUserName,
         messageText: messageText,
         receiverUserName: receiverUserName,
-        allUsers: allUsers
+        allUsers: allUsers,
+        cursor: cursor,
+        roomName: roomName
     }
 };
 
+// The server leaves out empty fields
+var withDefaultFields = function(msg) {
+    msg.senderUserName = msg.senderUserName || '';
+    msg.messageText = msg.messageText || '';
+    msg.receiverUserName = msg.receiverUserName || '';
+    msg.allUsers = msg.allUsers || [];
+    msg.cursor = msg.cursor || '';
+    msg.roomName = msg.roomName || '';
+    return msg;
+};
+
+// Compact encoding of messages in binary frames, see ClientMessage.to_binary on the server side.
+// Used when the server accepts the SUBPROTOCOL offered when connecting, otherwise messages are JSON text.
+var BinaryProtocol = {
+    SUBPROTOCOL: 'chat.binary',
+    MESSAGE_TYPE_CODES: {
+        login: 1,
+        login_failed: 2,
+        logout: 3,
+        logout_failed: 4,
+        public_message: 5,
+        private_message: 6,
+        list_all_users: 7,
+        join_room: 24,
+        leave_room: 25,
+        room_message: 26
+    },
+    STRING_FIELDS: ['senderUserName', 'messageText', 'receiverUserName', 'cursor', 'roomName'],
+    ALL_USERS_BIT: 1 << 5,
+    LONG_STRING_MARKER: 0xFFFF,
+    USER_NAME_SEPARATOR: 0xFF, // Never occurs in UTF-8
+    textEncoder: new TextEncoder(),
+    textDecoder: new TextDecoder('utf-8'),
+
+    encode: function(msg) {
+        var self = this;
+        var presentFields = 0;
+        var fieldStrings = [];
+        self.STRING_FIELDS.forEach(function(field, bit) {
+            if (msg[field]) {
+                presentFields |= 1 << bit;
+                fieldStrings.push(self.textEncoder.encode(msg[field]));
+            }
+        });
+        var strings = fieldStrings;
+        if (msg.allUsers) {
+            presentFields |= self.ALL_USERS_BIT;
+            var userNames = self.encodeUserNames(msg.allUsers);
+            strings = fieldStrings.concat([userNames]);
+        }
+        var size = 2 + (msg.allUsers ? 4 : 0);
+        strings.forEach(function(bytes) {
+            size += (bytes.length < self.LONG_STRING_MARKER ? 2 : 6) + bytes.length;
+        });
+        var buffer = new ArrayBuffer(size);
+        var view = new DataView(buffer);
+        view.setUint8(0, self.MESSAGE_TYPE_CODES[msg.messageType]);
+        view.setUint8(1, presentFields);
+        var offset = 2;
+        var writeString = function(bytes) {
+            if (bytes.length < self.LONG_STRING_MARKER) {
+                view.setUint16(offset, bytes.length);
+                offset += 2;
+            }
+            else {
+                view.setUint16(offset, self.LONG_STRING_MARKER);
+                view.setUint32(offset + 2, bytes.length);
+                offset += 6;
+            }
+            new Uint8Array(buffer, offset, bytes.length).set(bytes);
+            offset += bytes.length;
+        };
+        fieldStrings.forEach(writeString);
+        if (msg.allUsers) {
+            view.setUint32(offset, msg.allUsers.length);
+            offset += 4;
+            writeString(userNames);
+        }
+        return buffer;
+    },
+
+    // The user names of a list are one string, separated by USER_NAME_SEPARATOR
+    encodeUserNames: function(userNames) {
+        var self = this;
+        var encodedNames = userNames.map(function(userName) {
+            return self.textEncoder.encode(userName);
+        });
+        var size = Math.max(encodedNames.length - 1, 0);
+        encodedNames.forEach(function(bytes) {
+            size += bytes.length;
+        });
+        var encoded = new Uint8Array(size);
+        var offset = 0;
+        encodedNames.forEach(function(bytes, i) {
+            if (i > 0) {
+                encoded[offset++] = self.USER_NAME_SEPARATOR;
+            }
+            encoded.set(bytes, offset);
+            offset += bytes.length;
+        });
+        return encoded;
+    },
+
+    decodeUserNames: function(encoded, userCount) {
+        var userNames = [];
+        var start = 0;
+        while (userNames.length < userCount) {
+            var end = encoded.indexOf(this.USER_NAME_SEPARATOR, start);
+            if (end < 0) {
+                end = encoded.length;
+            }
+            userNames.push(this.textDecoder.decode(encoded.subarray(start, end)));
+            start = end + 1;
+        }
+        return userNames;
+    },
+
+    decode: function(buffer) {
+        var self = this;
+        var view = new DataView(buffer);
+        var offset = 2;
+        var readBytes = function() {
+            var length = view.getUint16(offset);
+            offset += 2;
+            if (length == self.LONG_STRING_MARKER) {
+                length = view.getUint32(offset);
+                offset += 4;
+            }
+            var bytes = new Uint8Array(buffer, offset, length);
+            offset += length;
+            return bytes;
+        };
+        var msg = {messageType: self.MESSAGE_TYPE_NAMES[view.getUint8(0)]};
+        var presentFields = view.getUint8(1);
+        self.STRING_FIELDS.forEach(function(field, bit) {
+            if (presentFields & (1 << bit)) {
+                msg[field] = self.textDecoder.decode(readBytes());
+            }
+        });
+        if (presentFields & self.ALL_USERS_BIT) {
+            var userCount = view.getUint32(offset);
+            offset += 4;
+            msg.allUsers = self.decodeUserNames(readBytes(), userCount);
+        }
+        return msg;
+    }
+};
+
+BinaryProtocol.MESSAGE_TYPE_NAMES = {};
+for (var messageTypeName in BinaryProtocol.MESSAGE_TYPE_CODES) {
+    BinaryProtocol.MESSAGE_TYPE_NAMES[BinaryProtocol.MESSAGE_TYPE_CODES[messageTypeName]] = messageTypeName;
+}
+
 var ChatServer = function(chatView) {
     var self = this;
     self.wsConnection;
     self.chatView = chatView;
     self.userName = '';
     self.isLoggedIn = false;
+    self.userListPrefix = '';
 
     self.init = function() {
         var url = 'ws://' + location.host + '/websocket';
-        self.wsConnection = new WebSocket(url);
+        self.wsConnection = new WebSocket(url, [BinaryProtocol.SUBPROTOCOL]);
+        self.wsConnection.binaryType = 'arraybuffer';
 
         self.wsConnection.onmessage = function (event) {
-            self.handleMessageFromServer(JSON.parse(event.data));
+            if (typeof event.data === 'string') {
+                var msg = JSON.parse(event.data);
+            }
+            else {
+                var msg = BinaryProtocol.decode(event.data);
+            }
+            self.handleMessageFromServer(withDefaultFields(msg));
         };
     };
 
@@ -62,6 +228,19 @@ var ChatServer = function(chatView) {
                 break;
             case Protocol.LIST_ALL_USERS:
                 self.chatView.renderAllUsers(msg.allUsers);
+                if (msg.cursor) {
+                    // Users are listed a page at a time, request the next page
+                    self.send(new Message(Protocol.LIST_ALL_USERS, self.userName, self.userListPrefix, '', undefined, msg.cursor));
+                }
+                break;
+            case Protocol.JOIN_ROOM:
+                self.chatView.renderRoomJoin(msg.roomName);
+                break;
+            case Protocol.LEAVE_ROOM:
+                self.chatView.renderRoomLeave(msg.roomName);
+                break;
+            case Protocol.ROOM_MESSAGE:
+                self.chatView.renderRoomMessage(msg.roomName, msg.senderUserName, msg.messageText);
                 break;
             default: // unknown command
                 ;
@@ -74,7 +253,7 @@ var ChatServer = function(chatView) {
         if (!self.isLoggedIn) {
             if (messageType == 'login') {
                 self.userName = tokens[1];
-                self.sendAsText(new Message(Protocol.LOGIN, self.userName));
+                self.send(new Message(Protocol.LOGIN, self.userName));
             }
             else {
                 self.chatView.addAsListItem('not yet logged in');
@@ -85,19 +264,30 @@ var ChatServer = function(chatView) {
                 case 'login':
                     self.chatView.addAsListItem('already logged in');
                 case 'logout':
-                    self.sendAsText(new Message(Protocol.LOGOUT, self.userName));
+                    self.send(new Message(Protocol.LOGOUT, self.userName));
                     break;
                 case 'public':
                     var messageText = tokens.slice(1).join(' ');
-                    self.sendAsText(new Message(Protocol.PUBLIC_MESSAGE, self.userName, messageText));
+                    self.send(new Message(Protocol.PUBLIC_MESSAGE, self.userName, messageText));
                     break;
                 case 'private':
                     var receiver = tokens[1];
                     var messageText = tokens.slice(2).join(' ');
-                    self.sendAsText(new Message(Protocol.PRIVATE_MESSAGE, self.userName, messageText, receiver));
+                    self.send(new Message(Protocol.PRIVATE_MESSAGE, self.userName, messageText, receiver));
                     break;
                 case 'listall':
-                    self.sendAsText(new Message(Protocol.LIST_ALL_USERS, self.userName));
+                    self.userListPrefix = tokens[1] || '';
+                    self.send(new Message(Protocol.LIST_ALL_USERS, self.userName, self.userListPrefix));
+                    break;
+                case 'join':
+                    self.send(new Message(Protocol.JOIN_ROOM, self.userName, '', '', undefined, '', tokens[1]));
+                    break;
+                case 'leave':
+                    self.send(new Message(Protocol.LEAVE_ROOM, self.userName, '', '', undefined, '', tokens[1]));
+                    break;
+                case 'room':
+                    var messageText = tokens.slice(2).join(' ');
+                    self.send(new Message(Protocol.ROOM_MESSAGE, self.userName, messageText, '', undefined, '', tokens[1]));
                     break;
                 default: // unknown command
                     ;
@@ -105,8 +295,14 @@ var ChatServer = function(chatView) {
         }
     };
 
-    self.sendAsText = function(object) {
-        self.wsConnection.send(JSON.stringify(object));
+    // Sends in the protocol the server accepted when connecting
+    self.send = function(msg) {
+        if (self.wsConnection.protocol == BinaryProtocol.SUBPROTOCOL) {
+            self.wsConnection.send(BinaryProtocol.encode(msg));
+        }
+        else {
+            self.wsConnection.send(JSON.stringify(msg));
+        }
     };
 };
 
@@ -140,6 +336,15 @@ var ChatView = {
             var description = 'private message to ' + this.renderBold(receiverUserName);
         this.addAsListItem(description + ': '+ messageText)
     },
+    renderRoomJoin: function(roomName) {
+        this.addAsListItem('joined room ' + this.renderBold(roomName));
+    },
+    renderRoomLeave: function(roomName) {
+        this.addAsListItem('left room ' + this.renderBold(roomName));
+    },
+    renderRoomMessage: function(roomName, userName, messageText) {
+        this.addAsListItem('[' + this.renderBold(roomName) + '] ' + this.renderBold(userName) + ': ' + messageText);
+    },
     renderAllUsers: function(users) {
         var usersHtml = $.map(users, function(userName) {
             return ChatView.renderBold(userName)
@@ -153,7 +358,10 @@ var ChatView = {
         this.addAsListItem(this.renderBold('logout') + ': leaves the chat<br>');
         this.addAsListItem(this.renderBold('public &lt;message&gt;') + ': sends message to all users<br>');
         this.addAsListItem(this.renderBold('private &lt;receiver user name&gt &lt;message&gt;') + ': sends private message to specified user<br>');
-        this.addAsListItem(this.renderBold('listall') + ': lists all users<br>');
+        this.addAsListItem(this.renderBold('listall [&lt;prefix&gt;]') + ': lists all users, or the users whose name starts with prefix<br>');
+        this.addAsListItem(this.renderBold('join &lt;room&gt;') + ': joins a room<br>');
+        this.addAsListItem(this.renderBold('leave &lt;room&gt;') + ': leaves a room<br>');
+        this.addAsListItem(this.renderBold('room &lt;room&gt; &lt;message&gt;') + ': sends message to all users in a room<br>');
         this.addAsListItem('-------------------------------------------<br><br>');
     }
 };
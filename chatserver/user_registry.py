@@ -1,19 +1,45 @@
+import logging
 import sys
+import zlib
 import config
+from multiprocessing import Process
 from threading import Thread
 sys.path.insert(0, config.LIBRARY_ABSOLUTE_PATH)
+import Pyro4.errors
 from mailbox import Mailbox
-import queue
 from protocol import MessageType
+from registry_log import RegistryLog
+import logutil
+
+
+log = logging.getLogger('user_registry')
+
+
+def get_shard_name(userName):
+    """ Returns the mailbox name of the user registry shard holding a user.
+    Users are spread over config.USER_REGISTRY_SHARD_COUNT shards by a hash of the user name, stable across processes
+    """
+    return 'user_registry_%d' % (zlib.crc32(userName.encode('utf-8')) % config.USER_REGISTRY_SHARD_COUNT)
+
+
+def get_all_shard_names():
+    return ['user_registry_%d' % shardIndex for shardIndex in range(config.USER_REGISTRY_SHARD_COUNT)]
 
 
 class UserRegistry(Thread):
     """ Global registry for user date. Assumed to be running at all times.
-     TODO: store and fetch data about users. Add recovery mechanism if user registry crashes
+    Runs as one shard per process, each holding the users get_shard_name maps to it.
+
+    If given a registry log, users are recovered from it on creation, and every change is committed
+    to it before being acknowledged. Changes from all messages taken from the mailbox at once are
+    committed together.
     """
-    def __init__(self, mailbox, mailboxTimeoutSec):
+    def __init__(self, mailbox, mailboxTimeoutSec, registryLog=None):
         super().__init__()
-        self.userToRouterMailboxUri = {}  # Mailbox uri currently not used
+        self.userToRouterMailboxUri = {}  # Used for removing the users of a removed message router
+        self.registryLog = registryLog
+        if registryLog is not None:
+            self.userToRouterMailboxUri = registryLog.replay()  # Uris are recovered as strings
         self.mailbox = mailbox
         self.mailboxTimeoutSec = mailboxTimeoutSec
         self.running = True
@@ -23,44 +49,101 @@ class UserRegistry(Thread):
             return False
         else:
             self.userToRouterMailboxUri[userName] = messageRouterMailboxUri
+            if self.registryLog is not None:
+                self.registryLog.append_register(userName, messageRouterMailboxUri)
             return True
 
     def remove_user(self, userName):
         if userName in self.userToRouterMailboxUri:
             del self.userToRouterMailboxUri[userName]
+            if self.registryLog is not None:
+                self.registryLog.append_remove(userName)
             return True
         else:
             return False
 
+    def remove_message_router_users(self, messageRouterMailboxUri):
+        routerUri = str(messageRouterMailboxUri)
+        removedUsers = [userName for userName, uri in self.userToRouterMailboxUri.items() if str(uri) == routerUri]
+        for userName in removedUsers:
+            self.remove_user(userName)
+        return removedUsers
+
+    def remove_unreachable_message_routers(self):
+        """ Removes the users of message routers that do not answer a health check, such as
+        routers that were stopped together with the registry. Used after recovery
+        """
+        for routerUri in set(str(uri) for uri in self.userToRouterMailboxUri.values()):
+            healthCheckProxy = self.mailbox.get_health_check_proxy(routerUri)
+            try:
+                healthCheckProxy.ping()
+            except Pyro4.errors.CommunicationError:
+                removedUsers = self.remove_message_router_users(routerUri)
+                log.info('removed %d users of unreachable message router', len(removedUsers))
+            finally:
+                healthCheckProxy._pyroRelease()
+        self._commit()
+
     def stop(self):
         self.running = False
 
+    def _commit(self):
+        if self.registryLog is not None:
+            self.registryLog.commit(self.userToRouterMailboxUri)
+
     def _handle_message(self, msg):
-        userName = msg.data
+        """ Applies a message to the registry. Returns the response message and the mailbox to send it to, if any
+        """
+        if msg.messageType == MessageType.USER_REGISTRY_REMOVE_MESSAGE_ROUTER:
+            self.remove_message_router_users(msg.data)
+            return None
+        userName = msg.data  # A list of user names for batch requests
         mailboxProxy = self.mailbox.get_mailbox_proxy(msg.senderMailboxUri)
         if msg.messageType == MessageType.USER_REGISTRY_NEW_USER:
             isSuccess = self.register_new_user(userName, msg.senderMailboxUri)
             responseMsg = self.mailbox.create_message(MessageType.USER_REGISTRY_NEW_USER, (userName, isSuccess))
-            mailboxProxy.put(responseMsg)
+            return mailboxProxy, responseMsg
         elif msg.messageType == MessageType.USER_REGISTRY_REMOVE_USER:
             isSuccess = self.remove_user(userName)
             responseMsg = self.mailbox.create_message(MessageType.USER_REGISTRY_REMOVE_USER, (userName, isSuccess))
-            mailboxProxy.put(responseMsg)
+            return mailboxProxy, responseMsg
+        elif msg.messageType == MessageType.USER_REGISTRY_NEW_USERS:
+            results = [(userName, self.register_new_user(userName, msg.senderMailboxUri)) for userName in msg.data]
+            return mailboxProxy, self.mailbox.create_message(MessageType.USER_REGISTRY_NEW_USERS, results)
+        elif msg.messageType == MessageType.USER_REGISTRY_REMOVE_USERS:
+            results = [(userName, self.remove_user(userName)) for userName in msg.data]
+            return mailboxProxy, self.mailbox.create_message(MessageType.USER_REGISTRY_REMOVE_USERS, results)
+        return None
 
     def run(self):
         while self.running:
-            try:
-                msg = self.mailbox.get(timeout=self.mailboxTimeoutSec)
-                self._handle_message(msg)
-            except queue.Empty:
-                pass
+            msgs = self.mailbox.drain(config.MAILBOX_DRAIN_BATCH_SIZE, self.mailboxTimeoutSec)
+            responses = [self._handle_message(msg) for msg in msgs]
+            self._commit()  # Group commit, before any change is acknowledged
+            for response in responses:
+                if response is not None:
+                    mailboxProxy, responseMsg = response
+                    try:
+                        mailboxProxy.put(responseMsg)
+                    except Pyro4.errors.CommunicationError as e:
+                        log.warning('failed to send response to message router: %s', e)
+        if self.registryLog is not None:
+            self.registryLog.close()
 
 
-def main():
-    user_registry = UserRegistry(Mailbox.create_mailbox('user_registry'), 1)
+def main(shardIndex):
+    logutil.setup()
+    shardName = get_all_shard_names()[shardIndex]
+    registryLog = None
+    if config.USER_REGISTRY_LOG_DIRECTORY is not None:
+        registryLog = RegistryLog(config.USER_REGISTRY_LOG_DIRECTORY, shardName, config.USER_REGISTRY_SNAPSHOT_INTERVAL)
+    user_registry = UserRegistry(Mailbox.create_mailbox(shardName), 1, registryLog)
+    log.info('%s recovered %d users', shardName, len(user_registry.userToRouterMailboxUri))
+    user_registry.remove_unreachable_message_routers()
     user_registry.start()
     user_registry.join()
 
 
 if __name__ == "__main__":
-    main()
+    for shardIndex in range(config.USER_REGISTRY_SHARD_COUNT):
+        Process(target=main, args=(shardIndex, )).start()
@@ -0,0 +1,187 @@
+""" Compact binary encoding of server messages sent between mailboxes.
+
+A batch starts with a table of the distinct mailbox uris in the batch, so that messages refer
+to their sender, and other uris, by a small index instead of repeating the uri. Message types are encoded as one
+byte, and strings are length-prefixed UTF-8. Message data is encoded with a type tag, and
+client messages with a fixed field layout. Data of other types falls back to pickle.
+"""
+import pickle
+import struct
+import Pyro4.core
+from protocol import ClientMessage, ServerMessage
+
+
+FORMAT_VERSION = 3
+
+# Value tags
+_NONE, _FALSE, _TRUE, _INT, _STR, _TUPLE, _LIST, _CLIENT_MESSAGE, _URI, _PICKLE = range(10)
+
+# Optional client message fields, in encoding order. Empty fields are left out.
+_CLIENT_MESSAGE_STRING_FIELDS = ('senderUserName', 'messageText', 'receiverUserName', 'cursor', 'roomName')
+
+_BATCH_HEADER = struct.Struct('>BHI')  # Format version, uri count, message count
+_CLIENT_MESSAGE_HEADER = struct.Struct('>BB')  # Message type code, bitmask of fields present
+_TAG = struct.Struct('>B')
+_TAG_AND_LENGTH = struct.Struct('>BI')
+_TAG_AND_INDEX = struct.Struct('>BH')
+_INT64 = struct.Struct('>q')
+_SHORT_LENGTH = struct.Struct('>H')
+_LONG_LENGTH = struct.Struct('>I')
+_LONG_STRING_MARKER = 0xFFFF
+
+
+def encode_messages(msgs):
+    """ Encodes a list of server messages to bytes
+    """
+    encoder = _Encoder()
+    for msg in msgs:
+        encoder.message(msg)
+    header = [_BATCH_HEADER.pack(FORMAT_VERSION, len(encoder.uris), len(msgs))]
+    for uri in encoder.uris:
+        _pack_str(header, uri)
+    return b''.join(header + encoder.parts)
+
+
+def decode_messages(data):
+    """ Decodes bytes created by encode_messages to a list of server messages
+    """
+    return _Decoder(data).messages()
+
+
+def _pack_str(parts, value):
+    encoded = value.encode('utf-8')
+    if len(encoded) < _LONG_STRING_MARKER:
+        parts.append(_SHORT_LENGTH.pack(len(encoded)))
+    else:
+        parts.append(_SHORT_LENGTH.pack(_LONG_STRING_MARKER))
+        parts.append(_LONG_LENGTH.pack(len(encoded)))
+    parts.append(encoded)
+
+
+class _Encoder:
+    def __init__(self):
+        self.parts = []
+        self.uris = []
+        self.uriIndexes = {}  # Maps uri string to its index in the uri table
+
+    def message(self, msg):
+        self.parts.append(_TAG.pack(msg.messageType))
+        self.value(msg.senderMailboxUri)
+        self.value(msg.data)
+
+    def value(self, value):
+        parts = self.parts
+        valueType = type(value)
+        if valueType is str:
+            parts.append(_TAG.pack(_STR))
+            _pack_str(parts, value)
+        elif value is None:
+            parts.append(_TAG.pack(_NONE))
+        elif valueType is bool:
+            parts.append(_TAG.pack(_TRUE if value else _FALSE))
+        elif valueType is int and -2**63 <= value < 2**63:
+            parts.append(_TAG.pack(_INT))
+            parts.append(_INT64.pack(value))
+        elif valueType is ClientMessage:
+            self._client_message(value)
+        elif valueType is Pyro4.core.URI:
+            parts.append(_TAG_AND_INDEX.pack(_URI, self._uri_index(value)))
+        elif valueType is tuple or valueType is list:
+            parts.append(_TAG_AND_LENGTH.pack(_TUPLE if valueType is tuple else _LIST, len(value)))
+            for item in value:
+                self.value(item)
+        else:
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            parts.append(_TAG_AND_LENGTH.pack(_PICKLE, len(pickled)))
+            parts.append(pickled)
+
+    def _client_message(self, msg):
+        presentFields = 0
+        for bit, field in enumerate(_CLIENT_MESSAGE_STRING_FIELDS):
+            if getattr(msg, field):
+                presentFields |= 1 << bit
+        if msg.allUsers:
+            presentFields |= 1 << len(_CLIENT_MESSAGE_STRING_FIELDS)
+        self.parts.append(_TAG.pack(_CLIENT_MESSAGE))
+        self.parts.append(_CLIENT_MESSAGE_HEADER.pack(msg.messageType, presentFields))
+        for bit, field in enumerate(_CLIENT_MESSAGE_STRING_FIELDS):
+            if presentFields & (1 << bit):
+                _pack_str(self.parts, getattr(msg, field))
+        if msg.allUsers:
+            self.parts.append(_LONG_LENGTH.pack(len(msg.allUsers)))
+            for userName in msg.allUsers:
+                _pack_str(self.parts, userName)
+
+    def _uri_index(self, uri):
+        uri = str(uri)
+        if uri not in self.uriIndexes:
+            self.uriIndexes[uri] = len(self.uris)
+            self.uris.append(uri)
+        return self.uriIndexes[uri]
+
+
+class _Decoder:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+        self.uris = []
+
+    def messages(self):
+        version, uriCount, messageCount = self._unpack(_BATCH_HEADER)
+        if version != FORMAT_VERSION:
+            raise ValueError('unsupported wire format version: ' + str(version))
+        self.uris = [Pyro4.core.URI(self._str()) for _ in range(uriCount)]
+        msgs = []
+        for _ in range(messageCount):
+            messageType, = self._unpack(_TAG)
+            senderMailboxUri = self.value()
+            msgs.append(ServerMessage(messageType, senderMailboxUri, self.value()))
+        return msgs
+
+    def value(self):
+        tag, = self._unpack(_TAG)
+        if tag == _STR:
+            return self._str()
+        elif tag == _NONE:
+            return None
+        elif tag == _TRUE:
+            return True
+        elif tag == _FALSE:
+            return False
+        elif tag == _INT:
+            return self._unpack(_INT64)[0]
+        elif tag == _CLIENT_MESSAGE:
+            return self._client_message()
+        elif tag == _URI:
+            return self.uris[self._unpack(_SHORT_LENGTH)[0]]
+        elif tag == _TUPLE:
+            return tuple([self.value() for _ in range(self._unpack(_LONG_LENGTH)[0])])
+        elif tag == _LIST:
+            return [self.value() for _ in range(self._unpack(_LONG_LENGTH)[0])]
+        elif tag == _PICKLE:
+            length, = self._unpack(_LONG_LENGTH)
+            self.offset += length
+            return pickle.loads(self.data[self.offset - length:self.offset])
+        raise ValueError('unknown value tag: ' + str(tag))
+
+    def _client_message(self):
+        messageType, presentFields = self._unpack(_CLIENT_MESSAGE_HEADER)
+        fields = {}
+        for bit, field in enumerate(_CLIENT_MESSAGE_STRING_FIELDS):
+            if presentFields & (1 << bit):
+                fields[field] = self._str()
+        if presentFields & (1 << len(_CLIENT_MESSAGE_STRING_FIELDS)):
+            fields['allUsers'] = [self._str() for _ in range(self._unpack(_LONG_LENGTH)[0])]
+        return ClientMessage(messageType, **fields)
+
+    def _str(self):
+        length, = self._unpack(_SHORT_LENGTH)
+        if length == _LONG_STRING_MARKER:
+            length, = self._unpack(_LONG_LENGTH)
+        self.offset += length
+        return str(self.data[self.offset - length:self.offset], 'utf-8')
+
+    def _unpack(self, structure):
+        values = structure.unpack_from(self.data, self.offset)
+        self.offset += structure.size
+        return values
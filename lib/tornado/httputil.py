@@ -353,6 +353,8 @@ def _parse_header(line):
                 value = value[1:-1]
                 value = value.replace('\\\\', '\\').replace('\\"', '"')
             pdict[name] = value
+        elif p:
+            pdict[p.lower()] = None  # Parameter without a value
     return key, pdict
 
 
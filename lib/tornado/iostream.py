@@ -28,6 +28,7 @@ from __future__ import absolute_import, division, print_function, with_statement
 
 import collections
 import errno
+import itertools
 import numbers
 import os
 import socket
@@ -46,6 +47,23 @@ try:
 except ImportError:
     _set_nonblocking = None
 
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16  # The minimum allowed by POSIX
+
+# Buffers smaller than this are cheaper to join than to pass to the kernel
+# one by one in a vectored write.
+_VECTORED_WRITE_JOIN_SIZE = 1024
+
+# Largest buffer made by joining small ones.
+_VECTORED_WRITE_JOIN_MAX_BYTES = 128 * 1024
+
+# Data handed to one vectored write at most.  Not much more than a socket
+# buffer holds, since a full socket takes only part of it and the vector is
+# built again for the next write.
+_VECTORED_WRITE_MAX_BYTES = 256 * 1024
+
 
 class StreamClosedError(IOError):
     pass
@@ -62,7 +80,8 @@ class BaseIOStream(object):
     attribute contains the exception object.
 
     Subclasses must implement `fileno`, `close_fd`, `write_to_fd`,
-    `read_from_fd`, and optionally `get_fd_error`.
+    `read_from_fd`, and optionally `get_fd_error`, `supports_vectored_write`
+    and `write_vector_to_fd`.
     """
     def __init__(self, io_loop=None, max_buffer_size=104857600,
                  read_chunk_size=4096):
@@ -70,13 +89,17 @@ class BaseIOStream(object):
         self.max_buffer_size = max_buffer_size
         self.read_chunk_size = read_chunk_size
         self.error = None
-        self._read_buffer = collections.deque()
+        # Data read but not consumed yet is _read_buffer_size bytes of
+        # _read_buffer, starting at _read_buffer_pos.
+        self._read_buffer = bytearray()
+        self._read_buffer_pos = 0
         self._write_buffer = collections.deque()
         self._read_buffer_size = 0
         self._write_buffer_frozen = False
         self._read_delimiter = None
         self._read_regex = None
         self._read_bytes = None
+        self._read_partial = False
         self._read_until_close = False
         self._read_callback = None
         self._streaming_callback = None
@@ -107,13 +130,26 @@ class BaseIOStream(object):
         """
         raise NotImplementedError()
 
+    def supports_vectored_write(self):
+        """Returns true if `write_vector_to_fd` may be used."""
+        return False
+
+    def write_vector_to_fd(self, buffers):
+        """Attempts to write a list of buffers to the underlying file in
+        one call, without joining them first (scatter-gather I/O).
+
+        Returns the number of bytes written.
+        """
+        raise NotImplementedError()
+
     def read_from_fd(self):
         """Attempts to read from the underlying file.
 
         Returns ``None`` if there was nothing to read (the socket
         returned `~errno.EWOULDBLOCK` or equivalent), otherwise
         returns the data.  When possible, should return no more than
-        ``self.read_chunk_size`` bytes at a time.
+        ``self.read_chunk_size`` bytes at a time.  The data may be
+        returned as a memoryview that is only valid until the next read.
         """
         raise NotImplementedError()
 
@@ -147,17 +183,22 @@ class BaseIOStream(object):
         self._read_delimiter = delimiter
         self._try_inline_read()
 
-    def read_bytes(self, num_bytes, callback, streaming_callback=None):
+    def read_bytes(self, num_bytes, callback, streaming_callback=None,
+                   partial=False):
         """Run callback when we read the given number of bytes.
 
         If a ``streaming_callback`` is given, it will be called with chunks
         of data as they become available, and the argument to the final
         ``callback`` will be empty.  Otherwise, the ``callback`` gets
         the data as an argument.
+
+        If ``partial`` is true, the callback is run as soon as any data is
+        available, with all of the data read so far, up to ``num_bytes``.
         """
         self._set_read_callback(callback)
         assert isinstance(num_bytes, numbers.Integral)
         self._read_bytes = num_bytes
+        self._read_partial = partial
         self._streaming_callback = stack_context.wrap(streaming_callback)
         self._try_inline_read()
 
@@ -211,7 +252,11 @@ class BaseIOStream(object):
                 self._write_buffer.append(data)
         self._write_callback = stack_context.wrap(callback)
         if not self._connecting:
-            self._handle_write()
+            if not (self._state and self._state & self.io_loop.WRITE):
+                # Otherwise the socket was full on the last write, and
+                # the data waits for the IOLoop to write it together
+                # with the rest of the buffer.
+                self._handle_write()
             if self._write_buffer:
                 self._add_io_state(self.io_loop.WRITE)
             self._maybe_add_error_listener()
@@ -424,7 +469,7 @@ class BaseIOStream(object):
             raise
         if chunk is None:
             return 0
-        self._read_buffer.append(chunk)
+        self._read_buffer += chunk
         self._read_buffer_size += len(chunk)
         if self._read_buffer_size >= self.max_buffer_size:
             gen_log.error("Reached maximum read buffer size")
@@ -444,55 +489,49 @@ class BaseIOStream(object):
                 self._read_bytes -= bytes_to_consume
             self._run_callback(self._streaming_callback,
                                self._consume(bytes_to_consume))
-        if self._read_bytes is not None and self._read_buffer_size >= self._read_bytes:
-            num_bytes = self._read_bytes
+        if self._read_bytes is not None and (
+                self._read_buffer_size >= self._read_bytes or
+                (self._read_partial and self._read_buffer_size)):
+            num_bytes = min(self._read_bytes, self._read_buffer_size)
             callback = self._read_callback
             self._read_callback = None
             self._streaming_callback = None
             self._read_bytes = None
+            self._read_partial = False
             self._run_callback(callback, self._consume(num_bytes))
             return True
         elif self._read_delimiter is not None:
-            # Multi-byte delimiters (e.g. '\r\n') may straddle two
-            # chunks in the read buffer, so we can't easily find them
-            # without collapsing the buffer.  However, since protocols
-            # using delimited reads (as opposed to reads of a known
-            # length) tend to be "line" oriented, the delimiter is likely
-            # to be in the first few chunks.  Merge the buffer gradually
-            # since large merges are relatively expensive and get undone in
-            # consume().
-            if self._read_buffer:
-                while True:
-                    loc = self._read_buffer[0].find(self._read_delimiter)
-                    if loc != -1:
-                        callback = self._read_callback
-                        delimiter_len = len(self._read_delimiter)
-                        self._read_callback = None
-                        self._streaming_callback = None
-                        self._read_delimiter = None
-                        self._run_callback(callback,
-                                           self._consume(loc + delimiter_len))
-                        return True
-                    if len(self._read_buffer) == 1:
-                        break
-                    _double_prefix(self._read_buffer)
+            if self._read_buffer_size:
+                loc = self._read_buffer.find(self._read_delimiter,
+                                             self._read_buffer_pos)
+                if loc != -1:
+                    callback = self._read_callback
+                    delimiter_len = len(self._read_delimiter)
+                    self._read_callback = None
+                    self._streaming_callback = None
+                    self._read_delimiter = None
+                    self._run_callback(callback, self._consume(
+                        loc - self._read_buffer_pos + delimiter_len))
+                    return True
         elif self._read_regex is not None:
-            if self._read_buffer:
-                while True:
-                    m = self._read_regex.search(self._read_buffer[0])
-                    if m is not None:
-                        callback = self._read_callback
-                        self._read_callback = None
-                        self._streaming_callback = None
-                        self._read_regex = None
-                        self._run_callback(callback, self._consume(m.end()))
-                        return True
-                    if len(self._read_buffer) == 1:
-                        break
-                    _double_prefix(self._read_buffer)
+            if self._read_buffer_size:
+                # The regex may be anchored at the start of the data, so
+                # the consumed data is removed from the buffer first.
+                self._compact_read_buffer()
+                m = self._read_regex.search(self._read_buffer)
+                if m is not None:
+                    callback = self._read_callback
+                    self._read_callback = None
+                    self._streaming_callback = None
+                    self._read_regex = None
+                    self._run_callback(callback, self._consume(m.end()))
+                    return True
         return False
 
     def _handle_write(self):
+        if self.supports_vectored_write():
+            self._handle_write_vectored()
+            return
         while self._write_buffer:
             try:
                 if not self._write_buffer_frozen:
@@ -531,12 +570,106 @@ class BaseIOStream(object):
             self._write_callback = None
             self._run_callback(callback)
 
+    def _handle_write_vectored(self):
+        """Writes the buffered data without merging it into one string.
+
+        Large buffers are handed to `write_vector_to_fd` as they are, and
+        a partially written buffer is replaced by a memoryview of its
+        remaining bytes, so they are not copied before they reach the
+        kernel.  Runs of small buffers are still joined.
+        """
+        while self._write_buffer:
+            try:
+                if len(self._write_buffer) == 1:
+                    num_bytes = self.write_to_fd(self._write_buffer[0])
+                else:
+                    buffers = self._get_write_vector()
+                    if len(buffers) == 1:
+                        num_bytes = self.write_to_fd(buffers[0])
+                    else:
+                        num_bytes = self.write_vector_to_fd(buffers)
+            except (socket.error, IOError, OSError) as e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                else:
+                    gen_log.warning("Write error on %d: %s",
+                                    self.fileno(), e)
+                    self.close(exc_info=True)
+                    return
+            if num_bytes == 0:
+                break
+            while num_bytes:
+                first = self._write_buffer[0]
+                if len(first) <= num_bytes:
+                    num_bytes -= len(first)
+                    self._write_buffer.popleft()
+                else:
+                    self._write_buffer[0] = memoryview(first)[num_bytes:]
+                    break
+        if not self._write_buffer and self._write_callback:
+            callback = self._write_callback
+            self._write_callback = None
+            self._run_callback(callback)
+
+    def _get_write_vector(self):
+        """Returns the buffers for the next vectored write, taken from
+        the head of the write buffer.
+
+        Runs of small buffers are joined into buffers of up to
+        ``_VECTORED_WRITE_JOIN_MAX_BYTES``, which replace them in the write
+        buffer, so data left after a partial write is not joined again.
+        """
+        buffers = []
+        small_buffers = []
+        small_size = 0
+        size = 0
+        count = 0  # Buffers taken from the write buffer
+        joined = False
+        for data in itertools.islice(self._write_buffer, _IOV_MAX):
+            # A pending run of small buffers takes one more entry
+            if (len(buffers) >= _IOV_MAX - 1 or
+                    size >= _VECTORED_WRITE_MAX_BYTES):
+                break
+            count += 1
+            size += len(data)
+            if len(data) >= _VECTORED_WRITE_JOIN_SIZE:
+                if small_buffers:
+                    joined |= _append_joined(buffers, small_buffers)
+                    small_buffers = []
+                    small_size = 0
+                buffers.append(data)
+                continue
+            small_buffers.append(data)
+            small_size += len(data)
+            if small_size >= _VECTORED_WRITE_JOIN_MAX_BYTES:
+                joined |= _append_joined(buffers, small_buffers)
+                small_buffers = []
+                small_size = 0
+        if small_buffers:
+            joined |= _append_joined(buffers, small_buffers)
+        if joined:
+            for i in range(count):
+                self._write_buffer.popleft()
+            self._write_buffer.extendleft(reversed(buffers))
+        return buffers
+
     def _consume(self, loc):
         if loc == 0:
             return b""
-        _merge_prefix(self._read_buffer, loc)
+        pos = self._read_buffer_pos
+        data = memoryview(self._read_buffer)[pos:pos + loc].tobytes()
+        self._read_buffer_pos += loc
         self._read_buffer_size -= loc
-        return self._read_buffer.popleft()
+        # Removing the consumed data costs no more than copying the rest,
+        # which keeps consuming many small reads linear in the data read.
+        if self._read_buffer_pos > self._read_buffer_size:
+            self._compact_read_buffer()
+        return data
+
+    def _compact_read_buffer(self):
+        if self._read_buffer_pos:
+            del self._read_buffer[:self._read_buffer_pos]
+            self._read_buffer_pos = 0
 
     def _check_closed(self):
         if self.closed():
@@ -628,6 +761,7 @@ class IOStream(BaseIOStream):
         self.socket = socket
         self.socket.setblocking(False)
         super(IOStream, self).__init__(*args, **kwargs)
+        self._read_chunk = bytearray(self.read_chunk_size)
 
     def fileno(self):
         return self.socket.fileno()
@@ -643,20 +777,28 @@ class IOStream(BaseIOStream):
 
     def read_from_fd(self):
         try:
-            chunk = self.socket.recv(self.read_chunk_size)
+            # Received into the same buffer every time, instead of a new
+            # string per read.
+            num_bytes = self.socket.recv_into(self._read_chunk)
         except socket.error as e:
             if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return None
             else:
                 raise
-        if not chunk:
+        if not num_bytes:
             self.close()
             return None
-        return chunk
+        return memoryview(self._read_chunk)[:num_bytes]
 
     def write_to_fd(self, data):
         return self.socket.send(data)
 
+    def supports_vectored_write(self):
+        return hasattr(self.socket, 'sendmsg')
+
+    def write_vector_to_fd(self, buffers):
+        return self.socket.sendmsg(buffers)
+
     def connect(self, address, callback=None, server_hostname=None):
         """Connects the socket to a remote address without blocking.
 
@@ -822,6 +964,11 @@ class SSLIOStream(IOStream):
             return
         super(SSLIOStream, self)._handle_write()
 
+    def supports_vectored_write(self):
+        # OpenSSL needs the same buffer again after an incomplete write,
+        # which the frozen write buffer of the plain path takes care of.
+        return False
+
     def connect(self, address, callback=None, server_hostname=None):
         # Save the user's callback and run it after the ssl handshake
         # has completed.
@@ -894,6 +1041,12 @@ class PipeIOStream(BaseIOStream):
     def write_to_fd(self, data):
         return os.write(self.fd, data)
 
+    def supports_vectored_write(self):
+        return hasattr(os, 'writev')
+
+    def write_vector_to_fd(self, buffers):
+        return os.writev(self.fd, buffers)
+
     def read_from_fd(self):
         try:
             chunk = os.read(self.fd, self.read_chunk_size)
@@ -913,13 +1066,14 @@ class PipeIOStream(BaseIOStream):
         return chunk
 
 
-def _double_prefix(deque):
-    """Grow by doubling, but don't split the second chunk just because the
-    first one is small.
-    """
-    new_len = max(len(deque[0]) * 2,
-                  (len(deque[0]) + len(deque[1])))
-    _merge_prefix(deque, new_len)
+def _append_joined(buffers, small_buffers):
+    """Appends ``small_buffers`` to ``buffers`` as one buffer, and returns
+    whether they had to be joined."""
+    if len(small_buffers) == 1:
+        buffers.append(small_buffers[0])
+        return False
+    buffers.append(b"".join(small_buffers))
+    return True
 
 
 def _merge_prefix(deque, size):
@@ -3,6 +3,7 @@
 
 from __future__ import absolute_import, division, print_function, with_statement
 from tornado.httputil import url_concat, parse_multipart_form_data, HTTPHeaders, format_timestamp
+from tornado.httputil import _parse_header
 from tornado.escape import utf8
 from tornado.log import gen_log
 from tornado.testing import ExpectLog
@@ -229,6 +230,15 @@ Foo: even
                           ("Foo", "even more lines")])
 
 
+class ParseHeaderTest(unittest.TestCase):
+    def test_parameters_without_values(self):
+        self.assertEqual(
+            _parse_header('permessage-deflate; client_max_window_bits; '
+                          'server_max_window_bits=10;'),
+            ('permessage-deflate', {'client_max_window_bits': None,
+                                    'server_max_window_bits': '10'}))
+
+
 class FormatTimestampTest(unittest.TestCase):
     # Make sure that all the input types are supported.
     TIMESTAMP = 1359312200.503611
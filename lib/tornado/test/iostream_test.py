@@ -14,6 +14,7 @@ import os
 import platform
 import socket
 import ssl
+import struct
 import sys
 
 
@@ -174,6 +175,23 @@ class TestIOStreamMixin(object):
         server.close()
         client.close()
 
+    def test_many_small_writes_and_a_large_write(self):
+        # More buffers than fit in one vectored write, and a write too
+        # large for the socket buffer, so some writes are partial.
+        server, client = self.make_iostream_pair()
+        small = [("%d," % i).encode() for i in range(5000)]
+        large = b"x" * (4 * 1024 * 1024)
+        expected = b"".join(small) + large
+        for data in small:
+            server.write(data)
+        server.write(large, callback=self.stop)
+        client.read_bytes(len(expected), self.stop)
+        results = [self.wait(), self.wait()]
+        self.assertIn(expected, results)
+        self.assertFalse(server.writing())
+        server.close()
+        client.close()
+
     def test_connection_refused(self):
         # When a connection is refused, the connect callback should not
         # be run.  (The kqueue IOLoop used to behave differently from the
@@ -331,6 +349,41 @@ class TestIOStreamMixin(object):
             server.close()
             client.close()
 
+    def test_read_small_pieces_across_chunks(self):
+        # Lengths and delimiters straddle the chunks read from the socket.
+        server, client = self.make_iostream_pair(read_chunk_size=7)
+        try:
+            messages = [("message %d" % i).encode() for i in range(100)]
+            for message in messages:
+                server.write(struct.pack("!H", len(message)) + message +
+                             b"\r\n")
+            received = []
+
+            def read_length():
+                client.read_bytes(2, read_message)
+
+            def read_message(data):
+                client.read_bytes(struct.unpack("!H", data)[0],
+                                  read_delimiter)
+
+            def read_delimiter(data):
+                received.append(data)
+                client.read_until(b"\r\n", next_message)
+
+            def next_message(data):
+                self.assertEqual(b"\r\n", data)
+                if len(received) < len(messages):
+                    read_length()
+                else:
+                    self.stop()
+            read_length()
+            self.wait()
+            self.assertEqual(messages, received)
+            self.assertEqual(0, client._read_buffer_size)
+        finally:
+            server.close()
+            client.close()
+
     def test_read_until_close_after_close(self):
         # Similar to test_delayed_close_callback, but read_until_close takes
         # a separate code path so test it separately.
@@ -474,6 +527,34 @@ class TestIOStream(TestIOStreamMixin, AsyncTestCase):
     def _make_client_iostream(self, connection, **kwargs):
         return IOStream(connection, **kwargs)
 
+    def test_small_writes_are_joined_once(self):
+        # The other end is not read until the write buffer is checked
+        server_socket, client_socket = socket.socketpair()
+        server = IOStream(server_socket, io_loop=self.io_loop)
+        if not server.supports_vectored_write():
+            server.close()
+            client_socket.close()
+            raise unittest.SkipTest("vectored writes not supported")
+        frames = [("%07d," % i).encode() * 10 for i in range(50000)]
+        for frame in frames:
+            server.write(frame)
+        # Let the stream fill the socket buffers
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.stop)
+        self.wait()
+        self.assertTrue(server.writing())
+        buffers = server._get_write_vector()
+        self.assertTrue(all(len(data) <= 128 * 1024 + 80 for data in buffers))
+        self.assertGreater(max(len(data) for data in buffers), 64 * 1024)
+        # The joined buffers replaced the frames in the write buffer
+        self.assertTrue(all(a is b for a, b in
+                            zip(buffers, server._get_write_vector())))
+        client = IOStream(client_socket, io_loop=self.io_loop)
+        expected = b"".join(frames)
+        client.read_bytes(len(expected), self.stop)
+        self.assertEqual(self.wait(), expected)
+        server.close()
+        client.close()
+
 
 class TestIOStreamSSL(TestIOStreamMixin, AsyncTestCase):
     def _make_server_iostream(self, connection, **kwargs):
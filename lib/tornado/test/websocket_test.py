@@ -1,14 +1,43 @@
+import struct
+import zlib
+
 from tornado.httpclient import HTTPError
 from tornado.log import gen_log
 from tornado.testing import AsyncHTTPTestCase, gen_test, bind_unused_port, ExpectLog
+from tornado.test.util import unittest
 from tornado.web import Application, RequestHandler
-from tornado.websocket import WebSocketHandler, websocket_connect, WebSocketError
+from tornado.websocket import WebSocketHandler, websocket_connect, WebSocketError, PreparedMessage
+from tornado.websocket import WebSocketProtocol13
+from tornado.websocket import _websocket_mask_array, _websocket_mask_int
 
 
 class EchoHandler(WebSocketHandler):
     def on_message(self, message):
         self.write_message(message, isinstance(message, bytes))
 
+class PreparedEchoHandler(WebSocketHandler):
+    def on_message(self, message):
+        self.write_prepared_message(
+            PreparedMessage(message, isinstance(message, bytes)))
+
+class PreparedBatchEchoHandler(WebSocketHandler):
+    def on_message(self, message):
+        self.write_prepared_messages(
+            [PreparedMessage(message), PreparedMessage(message.upper())],
+            callback=lambda: self.write_message('written'))
+
+class BatchEchoHandler(WebSocketHandler):
+    def on_message_batch(self, messages):
+        self.write_message('|'.join(messages))
+
+class CompressedEchoHandler(EchoHandler):
+    def get_compression_options(self):
+        return self.settings['compression_options']
+
+class CompressedPreparedEchoHandler(PreparedEchoHandler):
+    def get_compression_options(self):
+        return {'no_context_takeover': True}
+
 class NonWebSocketHandler(RequestHandler):
     def get(self):
         self.write('ok')
@@ -18,8 +47,13 @@ class WebSocketTest(AsyncHTTPTestCase):
     def get_app(self):
         return Application([
             ('/echo', EchoHandler),
+            ('/prepared_echo', PreparedEchoHandler),
+            ('/prepared_batch_echo', PreparedBatchEchoHandler),
+            ('/batch_echo', BatchEchoHandler),
+            ('/compressed_echo', CompressedEchoHandler),
+            ('/compressed_prepared_echo', CompressedPreparedEchoHandler),
             ('/non_ws', NonWebSocketHandler),
-        ])
+        ], compression_options={})
 
     @gen_test
     def test_websocket_gen(self):
@@ -40,6 +74,94 @@ class WebSocketTest(AsyncHTTPTestCase):
         response = self.wait().result()
         self.assertEqual(response, 'hello')
 
+    @gen_test
+    def test_prepared_message(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/prepared_echo' % self.get_http_port(),
+            io_loop=self.io_loop)
+        ws.write_message('hello')
+        response = yield ws.read_message()
+        self.assertEqual(response, 'hello')
+        ws.write_message(b'\x00\xff' * 100, binary=True)
+        response = yield ws.read_message()
+        self.assertEqual(response, b'\x00\xff' * 100)
+
+    @gen_test
+    def test_prepared_messages_batch(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/prepared_batch_echo' % self.get_http_port(),
+            io_loop=self.io_loop)
+        ws.write_message('hello')
+        responses = []
+        for i in range(3):
+            response = yield ws.read_message()
+            responses.append(response)
+        self.assertEqual(responses, ['hello', 'HELLO', 'written'])
+
+    @gen_test
+    def test_frames_read_together_are_one_batch(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/batch_echo' % self.get_http_port(),
+            io_loop=self.io_loop)
+        messages = ['a', 'b' * 200, 'c']
+        ws.stream.write(b''.join(
+            WebSocketProtocol13._build_frame(True, 0x1, message.encode(), True)
+            for message in messages))
+        response = yield ws.read_message()
+        self.assertEqual(response, '|'.join(messages))
+        ws.write_message('d')
+        response = yield ws.read_message()
+        self.assertEqual(response, 'd')
+
+    @gen_test
+    def test_compressed_messages(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/compressed_echo' % self.get_http_port(),
+            io_loop=self.io_loop, compression_options={})
+        self.assertTrue(ws.protocol._compressor.persistent)
+        for message in ['hello' * 100, 'hello' * 100, u'\u00e9', '']:
+            ws.write_message(message)
+            response = yield ws.read_message()
+            self.assertEqual(response, message)
+        ws.write_message(b'\x00\xff' * 100, binary=True)
+        response = yield ws.read_message()
+        self.assertEqual(response, b'\x00\xff' * 100)
+
+    @gen_test
+    def test_compression_not_offered(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/compressed_echo' % self.get_http_port(),
+            io_loop=self.io_loop)
+        self.assertIsNone(ws.protocol._compressor)
+        ws.write_message('hello')
+        response = yield ws.read_message()
+        self.assertEqual(response, 'hello')
+
+    @gen_test
+    def test_compressed_prepared_message(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/compressed_prepared_echo' % self.get_http_port(),
+            io_loop=self.io_loop, compression_options={})
+        self.assertFalse(ws.protocol._decompressor._decompressor)
+        for i in range(2):
+            ws.write_message('hello' * 100)
+            response = yield ws.read_message()
+            self.assertEqual(response, 'hello' * 100)
+
+    def test_compressed_frame_is_shared(self):
+        prepared = PreparedMessage('hello' * 100)
+        frame = prepared.compressed_frame()
+        self.assertEqual(0xc1, ord(frame[0:1]))  # FIN and RSV1
+        self.assertLess(len(frame), len(prepared.frame))
+        self.assertIs(frame, prepared.compressed_frame())
+        self.assertIsNot(frame, prepared.compressed_frame(10))
+
+    def test_prepared_message_frame_is_shared(self):
+        prepared = PreparedMessage({'a': 1})
+        self.assertEqual(prepared.data, b'{"a": 1}')
+        self.assertEqual(prepared.frame, b'\x81\x08{"a": 1}')
+        self.assertIs(prepared.frame, prepared.frame)
+
     @gen_test
     def test_websocket_http_fail(self):
         with self.assertRaises(HTTPError) as cm:
@@ -66,3 +188,108 @@ class WebSocketTest(AsyncHTTPTestCase):
                     io_loop=self.io_loop,
                     connect_timeout=0.01)
         self.assertEqual(cm.exception.code, 599)
+
+
+class MaxMessageSizeTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return Application([
+            ('/echo', EchoHandler),
+            ('/compressed_echo', CompressedEchoHandler),
+        ], websocket_max_message_size=1024, compression_options={})
+
+    @gen_test
+    def test_message_at_limit(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/echo' % self.get_http_port(),
+            io_loop=self.io_loop)
+        ws.write_message('a' * 1024)
+        response = yield ws.read_message()
+        self.assertEqual(response, 'a' * 1024)
+
+    @gen_test
+    def test_message_over_limit_closes_connection(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/echo' % self.get_http_port(),
+            io_loop=self.io_loop)
+        ws.write_message('a' * 1025)
+        response = yield ws.read_message()
+        self.assertIsNone(response)
+
+    @gen_test
+    def test_frame_length_over_limit_closes_connection(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/echo' % self.get_http_port(),
+            io_loop=self.io_loop)
+        # Only the header of a huge frame is sent
+        ws.stream.write(b'\x82\xff' + struct.pack('!Q', 2 ** 40) + b'mask')
+        response = yield ws.read_message()
+        self.assertIsNone(response)
+
+    @gen_test
+    def test_fragmented_message_over_limit_closes_connection(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/echo' % self.get_http_port(),
+            io_loop=self.io_loop)
+        ws.stream.write(
+            WebSocketProtocol13._build_frame(False, 0x1, b'a' * 600, True) +
+            WebSocketProtocol13._build_frame(True, 0x0, b'a' * 600, True))
+        response = yield ws.read_message()
+        self.assertIsNone(response)
+
+    @gen_test
+    def test_compressed_message_at_limit(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/compressed_echo' % self.get_http_port(),
+            io_loop=self.io_loop, compression_options={})
+        for i in range(2):
+            ws.write_message('a' * 1024)
+            response = yield ws.read_message()
+            self.assertEqual(response, 'a' * 1024)
+
+    @gen_test
+    def test_compressed_message_over_limit_closes_connection(self):
+        ws = yield websocket_connect(
+            'ws://localhost:%d/compressed_echo' % self.get_http_port(),
+            io_loop=self.io_loop, compression_options={})
+        # A frame of a few hundred bytes that inflates past the limit
+        ws.write_message('a' * 100000)
+        self.assertLess(len(zlib.compress(b'a' * 100000)), 1024)
+        response = yield ws.read_message()
+        self.assertIsNone(response)
+
+
+class MaskFunctionMixin(object):
+    # Subclasses should define self.mask(mask, data)
+    def test_mask(self):
+        self.assertEqual(self.mask(b'abcd', b''), b'')
+        self.assertEqual(self.mask(b'abcd', b'b'), b'\x03')
+        self.assertEqual(self.mask(b'abcd', b'54321'), b'TVPVP')
+        self.assertEqual(self.mask(b'ZXCV', b'98765432'), b'c`t`olpd')
+        # Include test cases with \x00 bytes and bytes with the high bit
+        # set, and payloads starting or ending with zero bytes, which a
+        # conversion to integers must preserve.
+        self.assertEqual(self.mask(b'\x00\x01\x02\x03',
+                                   b'\xff\xfb\xfd\xfc\xfe\xfa'),
+                         b'\xff\xfa\xff\xff\xfe\xfb')
+        self.assertEqual(self.mask(b'\xff\xfb\xfd\xfc',
+                                   b'\x00\x01\x02\x03\x04\x05'),
+                         b'\xff\xfa\xff\xff\xfb\xfe')
+        self.assertEqual(self.mask(b'\x00\x00\x00\x00', b'\x00\x00ab\x00\x00'),
+                         b'\x00\x00ab\x00\x00')
+
+    def test_mask_is_own_inverse(self):
+        data = bytes(bytearray(range(256))) * 17 + b'xyz'
+        self.assertEqual(self.mask(b'\x12\x34\x56\x78',
+                                   self.mask(b'\x12\x34\x56\x78', data)),
+                         data)
+
+
+class ArrayMaskFunctionTest(MaskFunctionMixin, unittest.TestCase):
+    def mask(self, mask, data):
+        return _websocket_mask_array(mask, data)
+
+
+@unittest.skipIf(not hasattr(int, 'from_bytes'), 'int.from_bytes not available')
+class IntMaskFunctionTest(MaskFunctionMixin, unittest.TestCase):
+    def mask(self, mask, data):
+        return _websocket_mask_int(mask, data)
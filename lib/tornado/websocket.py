@@ -30,10 +30,12 @@ import struct
 import time
 import tornado.escape
 import tornado.web
+import zlib
 
 from tornado.concurrent import Future
 from tornado.escape import utf8, native_str
 from tornado import httpclient
+from tornado import httputil
 from tornado.ioloop import IOLoop
 from tornado.log import gen_log, app_log
 from tornado.netutil import Resolver
@@ -45,6 +47,104 @@ try:
 except NameError:
     xrange = range  # py3
 
+# Largest message received, unless the handler or client sets another limit
+_default_max_message_size = 10 * 1024 * 1024
+
+
+def _websocket_mask_array(mask, data):
+    """XORs ``data`` with the repeated 4-byte ``mask``, one byte at a time."""
+    mask = array.array("B", mask)
+    unmasked = array.array("B", data)
+    for i in xrange(len(data)):
+        unmasked[i] = unmasked[i] ^ mask[i % 4]
+    if hasattr(unmasked, 'tobytes'):
+        # tostring was deprecated in py32.  It hasn't been removed,
+        # but since we turn on deprecation warnings in our tests
+        # we need to use the right one.
+        return unmasked.tobytes()
+    else:
+        return unmasked.tostring()
+
+
+def _websocket_mask_int(mask, data):
+    """XORs ``data`` with the repeated 4-byte ``mask`` as two large integers.
+
+    The XOR of the whole payload is done by a single big integer
+    operation in C, instead of a Python loop over the bytes.
+    """
+    length = len(data)
+    repeated_mask = (mask * (length // 4 + 1))[:length]
+    unmasked = int.from_bytes(data, 'little') ^ int.from_bytes(repeated_mask, 'little')
+    return unmasked.to_bytes(length, 'little')
+
+
+if hasattr(int, 'from_bytes'):
+    _websocket_mask = _websocket_mask_int
+else:
+    _websocket_mask = _websocket_mask_array  # py2
+
+
+def _create_deflate_compressor(compression_level, max_wbits):
+    # zlib does not support raw deflate streams with a window of 8 bits
+    return zlib.compressobj(compression_level, zlib.DEFLATED,
+                            -max(max_wbits, 9))
+
+
+def _deflate_message(compressor, data):
+    """Compresses a message as RFC 7692 requires: flushed to a byte
+    boundary, without the empty block that ends the flush."""
+    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    assert data.endswith(b"\x00\x00\xff\xff")
+    return data[:-4]
+
+
+class _PerMessageDeflateCompressor(object):
+    """Compresses the messages sent on one connection.
+
+    A persistent compressor keeps the LZ77 window of earlier messages
+    (context takeover); otherwise each message is compressed on its own.
+    """
+    def __init__(self, persistent, max_wbits, compression_level):
+        self.persistent = persistent
+        self.max_wbits = max_wbits
+        self.compression_level = compression_level
+        if persistent:
+            self._compressor = _create_deflate_compressor(compression_level,
+                                                          max_wbits)
+        else:
+            self._compressor = None
+
+    def compress(self, data):
+        compressor = self._compressor or _create_deflate_compressor(
+            self.compression_level, self.max_wbits)
+        return _deflate_message(compressor, data)
+
+
+class _DecompressTooLargeError(Exception):
+    pass
+
+
+class _PerMessageDeflateDecompressor(object):
+    """Decompresses the messages received on one connection.
+
+    Decompression stops at ``max_message_size`` bytes, so a small message
+    cannot inflate to an unbounded one.
+    """
+    def __init__(self, persistent, max_message_size):
+        self._max_message_size = max_message_size
+        if persistent:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            self._decompressor = None
+
+    def decompress(self, data):
+        decompressor = self._decompressor or zlib.decompressobj(-zlib.MAX_WBITS)
+        result = decompressor.decompress(data + b"\x00\x00\xff\xff",
+                                         self._max_message_size)
+        if decompressor.unconsumed_tail:
+            raise _DecompressTooLargeError()
+        return result
+
 
 class WebSocketError(Exception):
     pass
@@ -139,7 +239,8 @@ class WebSocketHandler(tornado.web.RequestHandler):
         # client sends a "Sec-Websocket-Origin" header and in 13 it's
         # simply "Origin".
         if self.request.headers.get("Sec-WebSocket-Version") in ("7", "8", "13"):
-            self.ws_connection = WebSocketProtocol13(self)
+            self.ws_connection = WebSocketProtocol13(
+                self, compression_options=self.get_compression_options())
             self.ws_connection.accept_connection()
         elif (self.allow_draft76() and
               "Sec-WebSocket-Version" not in self.request.headers):
@@ -163,6 +264,24 @@ class WebSocketHandler(tornado.web.RequestHandler):
             message = tornado.escape.json_encode(message)
         self.ws_connection.write_message(message, binary=binary)
 
+    def write_prepared_message(self, prepared):
+        """Sends a `PreparedMessage` to the client of this Web Socket.
+
+        Use this instead of `write_message` when the same message goes to
+        many clients: the message is encoded and framed once, and the
+        resulting bytes are shared by every connection.
+        """
+        self.ws_connection.write_prepared_message(prepared)
+
+    def write_prepared_messages(self, prepared, callback=None):
+        """Sends a list of `PreparedMessage` objects in a single write.
+
+        If ``callback`` is given, it is called when all data buffered on
+        the stream, including these messages, has been written to the
+        socket.
+        """
+        self.ws_connection.write_prepared_messages(prepared, callback)
+
     def select_subprotocol(self, subprotocols):
         """Invoked when a new WebSocket requests specific subprotocols.
 
@@ -176,6 +295,35 @@ class WebSocketHandler(tornado.web.RequestHandler):
         """
         return None
 
+    @property
+    def max_message_size(self):
+        """Largest message received, in bytes.
+
+        The connection is closed when a client sends a longer message or
+        frame.  Set by the ``websocket_max_message_size`` application
+        setting, 10 MiB by default.
+        """
+        return self.settings.get('websocket_max_message_size',
+                                 _default_max_message_size)
+
+    def get_compression_options(self):
+        """Override to return the compression options of the connection.
+
+        If this method returns None (the default), messages are not
+        compressed.  If it returns a dict (even an empty one), the
+        permessage-deflate extension of RFC 7692 is accepted when the
+        client offers it.  The dict may contain:
+
+        * ``compression_level``: the zlib compression level of messages sent.
+        * ``max_window_bits``: the largest LZ77 window of messages sent,
+          from 9 to 15 (the default).
+        * ``no_context_takeover``: if true, every message sent is compressed
+          on its own.  This costs some compression, but saves the memory of
+          a compressor per connection, and lets a `PreparedMessage` be
+          compressed once for all connections.
+        """
+        return None
+
     def open(self):
         """Invoked when a new WebSocket is opened.
 
@@ -192,6 +340,17 @@ class WebSocketHandler(tornado.web.RequestHandler):
         """
         raise NotImplementedError
 
+    def on_message_batch(self, messages):
+        """Handle a list of incoming messages received together.
+
+        All complete messages found in one read from the connection are
+        passed to this method at once.  The default implementation calls
+        `on_message` for each of them; override it to handle them as a
+        batch.
+        """
+        for message in messages:
+            self.on_message(message)
+
     def ping(self, data):
         """Send ping frame to the remote end."""
         self.ws_connection.write_ping(data)
@@ -261,6 +420,60 @@ for method in ["write", "redirect", "set_header", "send_error", "set_cookie",
     setattr(WebSocketHandler, method, WebSocketHandler._not_supported)
 
 
+class PreparedMessage(object):
+    """A message that is encoded once and then sent to many WebSocket clients.
+
+    The message may be either a string or a dict (which will be encoded
+    as json), just like for `WebSocketHandler.write_message`.  The frame
+    is built on first use and the same immutable byte string is written
+    to the stream of every connection it is sent to with
+    `WebSocketHandler.write_prepared_message`.
+    """
+    def __init__(self, message, binary=False):
+        if isinstance(message, dict):
+            message = tornado.escape.json_encode(message)
+        self.binary = binary
+        self.data = tornado.escape.utf8(message)
+        assert isinstance(self.data, bytes_type)
+        self._frame = None
+        self._compressed_frames = {}
+
+    @property
+    def frame(self):
+        """The unmasked RFC 6455 frame holding this message."""
+        if self._frame is None:
+            if self.binary:
+                opcode = 0x2
+            else:
+                opcode = 0x1
+            self._frame = WebSocketProtocol13._build_frame(True, opcode,
+                                                           self.data)
+        return self._frame
+
+    def compressed_frame(self, max_wbits=zlib.MAX_WBITS,
+                         compression_level=zlib.Z_DEFAULT_COMPRESSION):
+        """The unmasked frame holding this message compressed on its own
+        with permessage-deflate.
+
+        Only connections that compress without context takeover can send
+        it, as the messages they compress do not depend on earlier ones.
+        """
+        key = (max_wbits, compression_level)
+        frame = self._compressed_frames.get(key)
+        if frame is None:
+            if self.binary:
+                opcode = 0x2
+            else:
+                opcode = 0x1
+            data = _deflate_message(
+                _create_deflate_compressor(compression_level, max_wbits),
+                self.data)
+            frame = WebSocketProtocol13._build_frame(True, opcode, data,
+                                                     flags=0x40)
+            self._compressed_frames[key] = frame
+        return frame
+
+
 class WebSocketProtocol(object):
     """Base class for WebSocket protocol versions.
     """
@@ -292,6 +505,12 @@ class WebSocketProtocol(object):
     def on_connection_close(self):
         self._abort()
 
+    def write_prepared_messages(self, prepared, callback=None):
+        """Sends a list of `PreparedMessage` objects to the client of this Web Socket."""
+        for message in prepared:
+            self.write_prepared_message(message)
+        self.stream.write(b"", callback)
+
     def _abort(self):
         """Instantly aborts the WebSocket connection by closing the socket"""
         self.client_terminated = True
@@ -448,6 +667,10 @@ class WebSocketProtocol76(WebSocketProtocol):
         assert isinstance(message, bytes_type)
         self.stream.write(b"\x00" + message + b"\xff")
 
+    def write_prepared_message(self, prepared):
+        """Sends a `PreparedMessage` to the client of this Web Socket."""
+        self.write_message(prepared.data, binary=prepared.binary)
+
     def write_ping(self, data):
         """Send ping frame."""
         raise ValueError("Ping messages not supported by this version of websockets")
@@ -474,14 +697,22 @@ class WebSocketProtocol13(WebSocketProtocol):
     This class supports versions 7 and 8 of the protocol in addition to the
     final version 13.
     """
-    def __init__(self, handler, mask_outgoing=False):
+    # Most data asked from the stream in one read of frames
+    FRAME_READ_SIZE = 64 * 1024
+
+    def __init__(self, handler, mask_outgoing=False,
+                 compression_options=None):
         WebSocketProtocol.__init__(self, handler)
         self.mask_outgoing = mask_outgoing
+        self._compression_options = compression_options
+        self._compressor = None
+        self._decompressor = None
+        self._frame_compressed = False
+        self._message_compressed = False
         self._final_frame = False
         self._frame_opcode = None
-        self._masked_frame = None
-        self._frame_mask = None
-        self._frame_length = None
+        self._frame_buffer = bytearray()  # Data of frames not complete yet
+        self._received_messages = []
         self._fragmented_message_buffer = None
         self._fragmented_message_opcode = None
         self._waiting = None
@@ -529,25 +760,93 @@ class WebSocketProtocol13(WebSocketProtocol):
                 assert selected in subprotocols
                 subprotocol_header = "Sec-WebSocket-Protocol: %s\r\n" % selected
 
+        extension_header = ''
+        if self._compression_options is not None:
+            extensions = self.request.headers.get("Sec-WebSocket-Extensions", '')
+            for extension in extensions.split(','):
+                name, offer = httputil._parse_header(extension.strip())
+                if name != 'permessage-deflate':
+                    continue
+                agreed = self._accept_deflate_offer(offer)
+                if agreed is not None:
+                    self._create_compressors('server', agreed)
+                    extension_header = "Sec-WebSocket-Extensions: %s\r\n" % (
+                        '; '.join([name] + [
+                            key if value is None else '%s=%s' % (key, value)
+                            for key, value in sorted(agreed.items())]))
+                    break
+
         self.stream.write(tornado.escape.utf8(
             "HTTP/1.1 101 Switching Protocols\r\n"
             "Upgrade: websocket\r\n"
             "Connection: Upgrade\r\n"
             "Sec-WebSocket-Accept: %s\r\n"
-            "%s"
-            "\r\n" % (self._challenge_response(), subprotocol_header)))
+            "%s%s"
+            "\r\n" % (self._challenge_response(), subprotocol_header,
+                       extension_header)))
 
         self.async_callback(self.handler.open)(*self.handler.open_args, **self.handler.open_kwargs)
         self._receive_frame()
 
-    def _write_frame(self, fin, opcode, data):
+    def _accept_deflate_offer(self, offer):
+        """Returns the parameters of the response to a permessage-deflate
+        offer of the client, or None to decline the offer.
+        """
+        agreed = {}
+        max_wbits = self._compression_options.get('max_window_bits',
+                                                  zlib.MAX_WBITS)
+        for name, value in offer.items():
+            if name in ('server_no_context_takeover',
+                        'client_no_context_takeover'):
+                if value is not None:
+                    return None
+                agreed[name] = None
+            elif name == 'server_max_window_bits':
+                try:
+                    offered_wbits = int(value)
+                except (TypeError, ValueError):
+                    return None
+                if not 9 <= offered_wbits <= zlib.MAX_WBITS:
+                    return None
+                max_wbits = min(max_wbits, offered_wbits)
+            elif name != 'client_max_window_bits':
+                # Messages received are decompressed with the largest
+                # window, whatever window the client compresses them with.
+                return None
+        if max_wbits < zlib.MAX_WBITS:
+            agreed['server_max_window_bits'] = str(max_wbits)
+        if self._compression_options.get('no_context_takeover'):
+            agreed['server_no_context_takeover'] = None
+        return agreed
+
+    def _create_compressors(self, side, agreed_parameters):
+        """Starts compressing messages with the permessage-deflate
+        parameters agreed on.  ``side`` is ``'server'`` or ``'client'``.
+        """
+        if side == 'server':
+            other_side = 'client'
+        else:
+            other_side = 'server'
+        options = self._compression_options or {}
+        self._compressor = _PerMessageDeflateCompressor(
+            persistent=side + '_no_context_takeover' not in agreed_parameters,
+            max_wbits=int(agreed_parameters.get(side + '_max_window_bits') or
+                          zlib.MAX_WBITS),
+            compression_level=options.get('compression_level',
+                                          zlib.Z_DEFAULT_COMPRESSION))
+        self._decompressor = _PerMessageDeflateDecompressor(
+            persistent=other_side + '_no_context_takeover' not in agreed_parameters,
+            max_message_size=self.handler.max_message_size)
+
+    @staticmethod
+    def _build_frame(fin, opcode, data, mask_outgoing=False, flags=0):
         if fin:
             finbit = 0x80
         else:
             finbit = 0
-        frame = struct.pack("B", finbit | opcode)
+        frame = struct.pack("B", finbit | flags | opcode)
         l = len(data)
-        if self.mask_outgoing:
+        if mask_outgoing:
             mask_bit = 0x80
         else:
             mask_bit = 0
@@ -557,21 +856,55 @@ class WebSocketProtocol13(WebSocketProtocol):
             frame += struct.pack("!BH", 126 | mask_bit, l)
         else:
             frame += struct.pack("!BQ", 127 | mask_bit, l)
-        if self.mask_outgoing:
+        if mask_outgoing:
             mask = os.urandom(4)
-            data = mask + self._apply_mask(mask, data)
+            data = mask + WebSocketProtocol13._apply_mask(mask, data)
         frame += data
-        self.stream.write(frame)
+        return frame
 
-    def write_message(self, message, binary=False):
-        """Sends the given message to the client of this Web Socket."""
+    def _write_frame(self, fin, opcode, data):
+        self.stream.write(self._build_frame(fin, opcode, data,
+                                            self.mask_outgoing))
+
+    def _message_frame(self, data, binary):
         if binary:
             opcode = 0x2
         else:
             opcode = 0x1
+        flags = 0
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+            flags = 0x40  # RSV1 marks compressed messages
+        return self._build_frame(True, opcode, data, self.mask_outgoing,
+                                 flags)
+
+    def write_message(self, message, binary=False):
+        """Sends the given message to the client of this Web Socket."""
         message = tornado.escape.utf8(message)
         assert isinstance(message, bytes_type)
-        self._write_frame(True, opcode, message)
+        self.stream.write(self._message_frame(message, binary))
+
+    def _prepared_frame(self, prepared):
+        if self.mask_outgoing or (self._compressor is not None and
+                                  self._compressor.persistent):
+            # Masked frames need a fresh masking key, and messages
+            # compressed with the context of earlier messages only fit
+            # this connection, so they can't be shared
+            return self._message_frame(prepared.data, prepared.binary)
+        elif self._compressor is not None:
+            return prepared.compressed_frame(self._compressor.max_wbits,
+                                             self._compressor.compression_level)
+        else:
+            return prepared.frame
+
+    def write_prepared_message(self, prepared):
+        """Sends a `PreparedMessage` to the client of this Web Socket."""
+        self.stream.write(self._prepared_frame(prepared))
+
+    def write_prepared_messages(self, prepared, callback=None):
+        """Sends a list of `PreparedMessage` objects to the client of this Web Socket."""
+        self.stream.write(b"".join(self._prepared_frame(message)
+                                   for message in prepared), callback)
 
     def write_ping(self, data):
         """Send ping frame."""
@@ -579,68 +912,76 @@ class WebSocketProtocol13(WebSocketProtocol):
         self._write_frame(True, 0x9, data)
 
     def _receive_frame(self):
-        self.stream.read_bytes(2, self._on_frame_start)
-
-    def _on_frame_start(self, data):
-        header, payloadlen = struct.unpack("BB", data)
-        self._final_frame = header & 0x80
-        reserved_bits = header & 0x70
-        self._frame_opcode = header & 0xf
-        self._frame_opcode_is_control = self._frame_opcode & 0x8
-        if reserved_bits:
-            # client is using as-yet-undefined extensions; abort
-            self._abort()
-            return
-        self._masked_frame = bool(payloadlen & 0x80)
-        payloadlen = payloadlen & 0x7f
-        if self._frame_opcode_is_control and payloadlen >= 126:
-            # control frames must have payload < 126
-            self._abort()
-            return
-        if payloadlen < 126:
-            self._frame_length = payloadlen
-            if self._masked_frame:
-                self.stream.read_bytes(4, self._on_masking_key)
+        # Everything the stream has read so far is taken at once, so all
+        # complete frames in it are decoded in one pass.
+        self.stream.read_bytes(self.FRAME_READ_SIZE, self._on_frame_bytes,
+                               partial=True)
+
+    def _on_frame_bytes(self, data):
+        buf = self._frame_buffer
+        buf += data
+        pos = 0
+        while not self.client_terminated:
+            if len(buf) - pos < 2:
+                break
+            header = buf[pos]
+            payloadlen = buf[pos + 1]
+            self._final_frame = header & 0x80
+            reserved_bits = header & 0x70
+            self._frame_opcode = header & 0xf
+            self._frame_opcode_is_control = self._frame_opcode & 0x8
+            # RSV1 marks the first frame of a compressed message
+            self._frame_compressed = (reserved_bits & 0x40 and
+                                      self._decompressor is not None and
+                                      self._frame_opcode in (0x1, 0x2))
+            if self._frame_compressed:
+                reserved_bits &= ~0x40
+            if reserved_bits:
+                # client is using as-yet-undefined extensions; abort
+                self._abort()
+                break
+            masked_frame = payloadlen & 0x80
+            payloadlen = payloadlen & 0x7f
+            if self._frame_opcode_is_control and payloadlen >= 126:
+                # control frames must have payload < 126
+                self._abort()
+                break
+            if payloadlen < 126:
+                header_len = 2
+            elif payloadlen == 126:
+                header_len = 4
             else:
-                self.stream.read_bytes(self._frame_length, self._on_frame_data)
-        elif payloadlen == 126:
-            self.stream.read_bytes(2, self._on_frame_length_16)
-        elif payloadlen == 127:
-            self.stream.read_bytes(8, self._on_frame_length_64)
-
-    def _on_frame_length_16(self, data):
-        self._frame_length = struct.unpack("!H", data)[0]
-        if self._masked_frame:
-            self.stream.read_bytes(4, self._on_masking_key)
-        else:
-            self.stream.read_bytes(self._frame_length, self._on_frame_data)
-
-    def _on_frame_length_64(self, data):
-        self._frame_length = struct.unpack("!Q", data)[0]
-        if self._masked_frame:
-            self.stream.read_bytes(4, self._on_masking_key)
-        else:
-            self.stream.read_bytes(self._frame_length, self._on_frame_data)
-
-    def _on_masking_key(self, data):
-        self._frame_mask = data
-        self.stream.read_bytes(self._frame_length, self._on_masked_frame_data)
-
-    def _apply_mask(self, mask, data):
-        mask = array.array("B", mask)
-        unmasked = array.array("B", data)
-        for i in xrange(len(data)):
-            unmasked[i] = unmasked[i] ^ mask[i % 4]
-        if hasattr(unmasked, 'tobytes'):
-            # tostring was deprecated in py32.  It hasn't been removed,
-            # but since we turn on deprecation warnings in our tests
-            # we need to use the right one.
-            return unmasked.tobytes()
-        else:
-            return unmasked.tostring()
+                header_len = 10
+            if masked_frame:
+                header_len += 4
+            if len(buf) - pos < header_len:
+                break
+            if payloadlen == 126:
+                payloadlen = struct.unpack_from("!H", buf, pos + 2)[0]
+            elif payloadlen == 127:
+                payloadlen = struct.unpack_from("!Q", buf, pos + 2)[0]
+            if payloadlen > self.handler.max_message_size:
+                # Checked before any of the frame is buffered
+                self._abort()
+                break
+            data_start = pos + header_len
+            frame_end = data_start + payloadlen
+            if len(buf) < frame_end:
+                break
+            data = memoryview(buf)[data_start:frame_end].tobytes()
+            if masked_frame:
+                data = self._apply_mask(bytes(buf[data_start - 4:data_start]),
+                                        data)
+            pos = frame_end
+            self._on_frame_data(data)
+        del buf[:pos]
+        self._deliver_received_messages()
+        if not self.client_terminated:
+            self._receive_frame()
 
-    def _on_masked_frame_data(self, data):
-        self._on_frame_data(self._apply_mask(self._frame_mask, data))
+    @staticmethod
+    def _apply_mask(mask, data):
+        return _websocket_mask(mask, data)
 
     def _on_frame_data(self, data):
         if self._frame_opcode_is_control:
@@ -657,6 +998,10 @@ class WebSocketProtocol13(WebSocketProtocol):
                 # nothing to continue
                 self._abort()
                 return
+            if (len(self._fragmented_message_buffer) + len(data) >
+                    self.handler.max_message_size):
+                self._abort()
+                return
             self._fragmented_message_buffer += data
             if self._final_frame:
                 opcode = self._fragmented_message_opcode
@@ -667,6 +1012,7 @@ class WebSocketProtocol13(WebSocketProtocol):
                 # can't start new message until the old one is finished
                 self._abort()
                 return
+            self._message_compressed = self._frame_compressed
             if self._final_frame:
                 opcode = self._frame_opcode
             else:
@@ -674,10 +1020,19 @@ class WebSocketProtocol13(WebSocketProtocol):
                 self._fragmented_message_buffer = data
 
         if self._final_frame:
+            if self._message_compressed and not self._frame_opcode_is_control:
+                try:
+                    data = self._decompressor.decompress(data)
+                except (zlib.error, _DecompressTooLargeError):
+                    self._abort()
+                    return
             self._handle_message(opcode, data)
 
-        if not self.client_terminated:
-            self._receive_frame()
+    def _deliver_received_messages(self):
+        if self._received_messages:
+            messages = self._received_messages
+            self._received_messages = []
+            self.async_callback(self.handler.on_message_batch)(messages)
 
     def _handle_message(self, opcode, data):
         if self.client_terminated:
@@ -690,11 +1045,17 @@ class WebSocketProtocol13(WebSocketProtocol):
             except UnicodeDecodeError:
                 self._abort()
                 return
-            self.async_callback(self.handler.on_message)(decoded)
+            self._received_messages.append(decoded)
+            return
         elif opcode == 0x2:
             # Binary data
-            self.async_callback(self.handler.on_message)(data)
-        elif opcode == 0x8:
+            self._received_messages.append(data)
+            return
+        # Messages received before a control frame are handled before it
+        self._deliver_received_messages()
+        if self.client_terminated:
+            return
+        if opcode == 0x8:
             # Close
             self.client_terminated = True
             self.close()
@@ -727,7 +1088,10 @@ class WebSocketProtocol13(WebSocketProtocol):
 
 class WebSocketClientConnection(simple_httpclient._HTTPConnection):
     """WebSocket client connection."""
-    def __init__(self, io_loop, request):
+    def __init__(self, io_loop, request, compression_options=None,
+                 max_message_size=_default_max_message_size):
+        self.compression_options = compression_options
+        self.max_message_size = max_message_size
         self.connect_future = Future()
         self.read_future = None
         self.read_queue = collections.deque()
@@ -742,6 +1106,10 @@ class WebSocketClientConnection(simple_httpclient._HTTPConnection):
             'Sec-WebSocket-Key': self.key,
             'Sec-WebSocket-Version': '13',
         })
+        if compression_options is not None:
+            # Any window is accepted for the messages received
+            request.headers['Sec-WebSocket-Extensions'] = (
+                'permessage-deflate; client_max_window_bits')
 
         super(WebSocketClientConnection, self).__init__(
             io_loop, None, request, lambda: None, self._on_http_response,
@@ -765,7 +1133,16 @@ class WebSocketClientConnection(simple_httpclient._HTTPConnection):
         accept = WebSocketProtocol13.compute_accept_value(self.key)
         assert self.headers['Sec-Websocket-Accept'] == accept
 
-        self.protocol = WebSocketProtocol13(self, mask_outgoing=True)
+        self.protocol = WebSocketProtocol13(
+            self, mask_outgoing=True,
+            compression_options=self.compression_options)
+        extensions = self.headers.get('Sec-WebSocket-Extensions', '')
+        for extension in extensions.split(','):
+            name, params = httputil._parse_header(extension.strip())
+            if name == 'permessage-deflate' and self.compression_options is not None:
+                self.protocol._create_compressors('client', params)
+            elif name:
+                raise ValueError("Unsupported extension %r" % name)
         self.protocol._receive_frame()
 
         if self._timeout is not None:
@@ -803,22 +1180,36 @@ class WebSocketClientConnection(simple_httpclient._HTTPConnection):
         else:
             self.read_queue.append(message)
 
+    def on_message_batch(self, messages):
+        for message in messages:
+            self.on_message(message)
+
     def on_pong(self, data):
         pass
 
 
-def websocket_connect(url, io_loop=None, callback=None, connect_timeout=None):
+def websocket_connect(url, io_loop=None, callback=None, connect_timeout=None,
+                      compression_options=None,
+                      max_message_size=_default_max_message_size):
     """Client-side websocket support.
 
     Takes a url and returns a Future whose result is a
     `WebSocketClientConnection`.
+
+    If ``compression_options`` is not None, the permessage-deflate
+    extension is offered to the server.  Its ``compression_level`` is the
+    zlib compression level of messages sent.
+
+    The connection is closed when the server sends a message or frame
+    longer than ``max_message_size`` bytes.
     """
     if io_loop is None:
         io_loop = IOLoop.current()
     request = httpclient.HTTPRequest(url, connect_timeout=connect_timeout)
     request = httpclient._RequestProxy(
         request, httpclient.HTTPRequest._DEFAULTS)
-    conn = WebSocketClientConnection(io_loop, request)
+    conn = WebSocketClientConnection(io_loop, request, compression_options,
+                                     max_message_size)
     if callback is not None:
         io_loop.add_future(conn.connect_future, callback)
     return conn.connect_future
@@ -0,0 +1,204 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import threading
+import unittest
+import Pyro4.errors
+import config
+from load_balancer import LoadBalancer
+import mailbox
+from protocol import MessageType, ServerMessage
+
+
+class MailboxMock(mailbox.Mailbox):
+    def __init__(self, proxyMock=None):
+        super().__init__()
+        self.proxyMock = proxyMock
+
+    def get_mailbox_proxy(self, nameOrUri):
+        return self.proxyMock
+
+
+class HealthCheckMailboxMock(MailboxMock):
+    """ Answers health checks for the message routers that are up. Messages to the routers
+    that are unreachable fail
+    """
+    def __init__(self, proxyMock=None):
+        super().__init__(proxyMock)
+        self.routersUp = set()
+        self.routersUnreachable = set()
+
+    def get_mailbox_proxy(self, nameOrUri):
+        if nameOrUri in self.routersUnreachable:
+            return UnreachableProxyMock()
+        return self.proxyMock
+
+    def get_health_check_proxy(self, uri):
+        return HealthCheckProxyMock(self.routersUp, uri)
+
+
+class UnreachableProxyMock:
+    def put(self, msg):
+        raise Pyro4.errors.CommunicationError('cannot connect')
+
+
+class RegisteringProxyMock:
+    """ Records the router lists sent. While the first list is sent, registers a chat server from
+    another thread, and gives that registration time to run
+    """
+    def __init__(self, register):
+        self.register = register
+        self.routerLists = []
+
+    def put(self, msg):
+        if msg.messageType != MessageType.NEW_MESSAGE_ROUTER:
+            return
+        self.routerLists.append(msg.data)
+        if len(self.routerLists) == 1:
+            thread = threading.Thread(target=self.register)
+            thread.start()
+            thread.join(0.2)
+            self.registeringThread = thread
+
+
+class HealthCheckProxyMock:
+    def __init__(self, routersUp, uri):
+        self.routersUp = routersUp
+        self.uri = uri
+
+    def ping(self):
+        if self.uri not in self.routersUp:
+            raise Pyro4.errors.TimeoutError('receiving: timeout')
+        return True
+
+
+class TestLoadBalancer(unittest.TestCase):
+    """ Tests server selection by calling the load balancer's message handlers directly
+    """
+    def setUp(self):
+        self.routerMailboxMock = MailboxMock()
+        self.loadBalancerMailbox = MailboxMock(proxyMock=self.routerMailboxMock)
+
+    def register_chat_servers(self, loadBalancer, httpPorts):
+        for httpPort in httpPorts:
+            msg = ServerMessage(MessageType.REGISTER_CHAT_SERVER, 'router_%d' % httpPort, httpPort)
+            loadBalancer.register_chat_server(msg)
+
+    def report_load(self, loadBalancer, httpPort, connectionCount, mailboxDepth=0, loopLatencySec=0.0):
+        msg = ServerMessage(MessageType.CHAT_SERVER_LOAD_REPORT, 'router_%d' % httpPort,
+                             (httpPort, connectionCount, mailboxDepth, loopLatencySec))
+        loadBalancer.update_chat_server_load(msg)
+
+    def test_no_server_registered(self):
+        self.assertIsNone(LoadBalancer(self.loadBalancerMailbox).get_next_server_address())
+
+    def test_round_robin(self):
+        loadBalancer = LoadBalancer(self.loadBalancerMailbox, LoadBalancer.POLICY_ROUND_ROBIN)
+        self.register_chat_servers(loadBalancer, [8001, 8002, 8003])
+        addresses = [loadBalancer.get_next_server_address() for _ in range(6)]
+        self.assertEqual(['http://localhost:8001', 'http://localhost:8002', 'http://localhost:8003'] * 2, addresses)
+
+    def test_power_of_two_choices_picks_less_loaded_server(self):
+        loadBalancer = LoadBalancer(self.loadBalancerMailbox, LoadBalancer.POLICY_POWER_OF_TWO_CHOICES)
+        self.register_chat_servers(loadBalancer, [8001, 8002])
+        self.report_load(loadBalancer, 8001, 100)
+        self.report_load(loadBalancer, 8002, 90)
+        addresses = [loadBalancer.get_next_server_address() for _ in range(20)]
+
+        # Clients sent since the last report count as load, so the servers end up even
+        self.assertEqual(['http://localhost:8002'] * 10, addresses[:10])
+        self.assertEqual(5, addresses[10:].count('http://localhost:8001'))
+
+    def test_load_includes_mailbox_depth_and_loop_latency(self):
+        loadBalancer = LoadBalancer(self.loadBalancerMailbox, LoadBalancer.POLICY_POWER_OF_TWO_CHOICES)
+        self.register_chat_servers(loadBalancer, [8001, 8002])
+        self.report_load(loadBalancer, 8001, 10, loopLatencySec=0.5)
+        self.report_load(loadBalancer, 8002, 50)
+        self.assertEqual('http://localhost:8002', loadBalancer.get_next_server_address())
+
+    def test_routers_are_notified_on_registration(self):
+        loadBalancer = LoadBalancer(self.loadBalancerMailbox)
+        self.register_chat_servers(loadBalancer, [8001, 8002])
+        self.assertEqual(['router_8001'], self.routerMailboxMock.get().data)
+        self.assertEqual(['router_8001', 'router_8002'], self.routerMailboxMock.get().data)
+
+    def test_failed_chat_server_is_removed(self):
+        healthCheckMailbox = HealthCheckMailboxMock(proxyMock=self.routerMailboxMock)
+        healthCheckMailbox.routersUp.update(['router_8001', 'router_8002'])
+        loadBalancer = LoadBalancer(healthCheckMailbox, LoadBalancer.POLICY_ROUND_ROBIN)
+        self.register_chat_servers(loadBalancer, [8001, 8002])
+        self.routerMailboxMock.drain(10)
+
+        healthCheckMailbox.routersUp.remove('router_8002')
+        for _ in range(config.HEALTH_CHECK_MAX_MISSES - 1):
+            loadBalancer.check_chat_servers()
+        self.assertEqual(2, len(loadBalancer.serverList))
+        self.assertTrue(self.routerMailboxMock.empty())
+
+        loadBalancer.check_chat_servers()
+        addresses = [loadBalancer.get_next_server_address() for _ in range(2)]
+        self.assertEqual(['http://localhost:8001'] * 2, addresses)
+
+        # Every user registry shard, then the remaining router is notified
+        msgs = self.routerMailboxMock.drain(10)
+        registryMsgs, routersMsg = msgs[:-1], msgs[-1]
+        self.assertEqual(config.USER_REGISTRY_SHARD_COUNT, len(registryMsgs))
+        for registryMsg in registryMsgs:
+            self.assertEqual((MessageType.USER_REGISTRY_REMOVE_MESSAGE_ROUTER, 'router_8002'),
+                             (registryMsg.messageType, registryMsg.data))
+        self.assertEqual((MessageType.NEW_MESSAGE_ROUTER, ['router_8001']), (routersMsg.messageType, routersMsg.data))
+
+    def test_unreachable_router_does_not_stop_notifications(self):
+        healthCheckMailbox = HealthCheckMailboxMock(proxyMock=self.routerMailboxMock)
+        healthCheckMailbox.routersUp.update(['router_8001', 'router_8003'])
+        loadBalancer = LoadBalancer(healthCheckMailbox)
+        self.register_chat_servers(loadBalancer, [8001, 8002, 8003])
+        self.routerMailboxMock.drain(10)
+        for _ in range(config.HEALTH_CHECK_MAX_MISSES - 1):
+            loadBalancer.check_chat_servers()
+
+        # 8001 fails too, and is not removed yet when 8002 is removed
+        healthCheckMailbox.routersUp.remove('router_8001')
+        healthCheckMailbox.routersUnreachable.add('router_8001')
+        loadBalancer.check_chat_servers()
+        self.assertEqual(['router_8001', 'router_8003'], self.routerMailboxMock.drain(10)[-1].data)
+
+        self.register_chat_servers(loadBalancer, [8004])
+        self.assertEqual(['router_8001', 'router_8003', 'router_8004'], self.routerMailboxMock.get().data)
+
+        for _ in range(config.HEALTH_CHECK_MAX_MISSES - 1):
+            loadBalancer.check_chat_servers()
+        self.assertEqual(['router_8003', 'router_8004'], self.routerMailboxMock.drain(10)[-1].data)
+
+    def test_router_lists_are_sent_in_order_of_changes(self):
+        healthCheckMailbox = HealthCheckMailboxMock(proxyMock=self.routerMailboxMock)
+        healthCheckMailbox.routersUp.update(['router_8001', 'router_8003'])
+        loadBalancer = LoadBalancer(healthCheckMailbox)
+        self.register_chat_servers(loadBalancer, [8001, 8002, 8003])
+
+        # Registers 8004 while the list without 8002 is being sent. Had a router received the older list
+        # last, it would add back the removed router.
+        proxyMock = RegisteringProxyMock(lambda: self.register_chat_servers(loadBalancer, [8004]))
+        healthCheckMailbox.proxyMock = proxyMock
+        for _ in range(config.HEALTH_CHECK_MAX_MISSES):
+            loadBalancer.check_chat_servers()
+        proxyMock.registeringThread.join()
+        self.assertEqual([['router_8001', 'router_8003']] * 2 + [['router_8001', 'router_8003', 'router_8004']] * 3,
+                         proxyMock.routerLists)
+
+    def test_missed_health_checks_are_reset_on_success(self):
+        healthCheckMailbox = HealthCheckMailboxMock(proxyMock=self.routerMailboxMock)
+        loadBalancer = LoadBalancer(healthCheckMailbox)
+        self.register_chat_servers(loadBalancer, [8001])
+        for _ in range(config.HEALTH_CHECK_MAX_MISSES - 1):
+            loadBalancer.check_chat_servers()
+        healthCheckMailbox.routersUp.add('router_8001')
+        loadBalancer.check_chat_servers()
+        healthCheckMailbox.routersUp.remove('router_8001')
+        loadBalancer.check_chat_servers()
+        self.assertEqual(1, len(loadBalancer.serverList))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import logging
+import queue
+import unittest
+import logutil
+
+
+class TestSamplingFilter(unittest.TestCase):
+    def test_passes_one_of_every_interval(self):
+        samplingFilter = logutil.SamplingFilter(10)
+        record = logging.makeLogRecord({'msg': 'message'})
+        passed = [i for i in range(35) if samplingFilter.filter(record)]
+        self.assertEqual([0, 10, 20, 30], passed)
+
+    def test_interval_of_one_passes_all(self):
+        samplingFilter = logutil.SamplingFilter(1)
+        record = logging.makeLogRecord({'msg': 'message'})
+        self.assertTrue(all(samplingFilter.filter(record) for _ in range(5)))
+
+
+class TestDroppingQueueHandler(unittest.TestCase):
+    def test_drops_records_when_queue_is_full(self):
+        recordQueue = queue.Queue(2)
+        handler = logutil.DroppingQueueHandler(recordQueue)
+        logger = logging.Logger('test_logger')
+        logger.addHandler(handler)
+        for i in range(5):
+            logger.warning('message %d', i)
+        self.assertEqual(3, handler.droppedCount)
+        self.assertEqual('message 0', recordQueue.get_nowait().getMessage())
+
+
+if __name__ == '__main__':
+    unittest.main()
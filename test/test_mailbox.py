@@ -0,0 +1,105 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import threading
+import unittest
+from mailbox import Mailbox, MailboxProxyCache
+from protocol import MessageType
+import queue
+
+
+class TestMailbox(unittest.TestCase):
+    def test_drain_returns_batch_in_order(self):
+        mailbox = Mailbox()
+        mailbox.put_many(range(5))
+        self.assertEqual([0, 1, 2], mailbox.drain(3))
+        self.assertEqual([3, 4], mailbox.drain(3))
+        self.assertEqual([], mailbox.drain(3, timeout=0.01))
+
+    def test_get_times_out_when_empty(self):
+        self.assertRaises(queue.Empty, Mailbox().get, timeout=0.01)
+
+    def test_drop_oldest_when_full(self):
+        mailbox = Mailbox(3, Mailbox.OVERFLOW_DROP_OLDEST)
+        mailbox.put_many(range(5))
+        self.assertEqual([2, 3, 4], mailbox.drain(5))
+        self.assertEqual(2, mailbox.stats()['dropped'])
+
+    def test_reject_when_full(self):
+        mailbox = Mailbox(3, Mailbox.OVERFLOW_REJECT)
+        mailbox.put_many(range(3))
+        self.assertFalse(mailbox.put(3))
+        self.assertEqual([0, 1, 2], mailbox.drain(5))
+        self.assertEqual(1, mailbox.stats()['rejected'])
+
+    def test_block_when_full_until_drained(self):
+        mailbox = Mailbox(3, Mailbox.OVERFLOW_BLOCK)
+        producer = threading.Thread(target=mailbox.put_many, args=(range(10), ))
+        producer.start()
+        received = []
+        while len(received) < 10:
+            received += mailbox.drain(2, timeout=1)
+        producer.join()
+        self.assertEqual(list(range(10)), received)
+        self.assertTrue(mailbox.stats()['blocked'] > 0)
+
+
+class TestRemoteMailbox(unittest.TestCase):
+    """ Tests a mailbox wrapped as a remote object, accessed through a proxy by uri
+    """
+    def setUp(self):
+        self.mailbox = Mailbox.create_mailbox()
+        self.mailboxProxy = self.mailbox.get_mailbox_proxy(self.mailbox.uri)
+
+    def tearDown(self):
+        self.mailboxProxy._pyroRelease()
+        self.mailbox.daemon.shutdown()
+
+    def test_oneway_put_keeps_order(self):
+        try:
+            for i in range(100):
+                self.mailboxProxy.put(self.mailbox.create_message(MessageType.NEW_USER, i))
+            for i in range(100):
+                msg = self.mailbox.get(timeout=1)
+                self.assertEqual(MessageType.NEW_USER, msg.messageType)
+                self.assertEqual(i, msg.data)
+        except queue.Empty:
+            self.fail('mailbox did not receive messages in time')
+
+
+    def test_reconnect_after_connection_loss(self):
+        self.mailboxProxy.put(self.mailbox.create_message(MessageType.NEW_USER, 'first'))
+        self.mailboxProxy._pyroConnection.sock.close()  # Simulate a broken connection
+        self.mailboxProxy.put(self.mailbox.create_message(MessageType.NEW_USER, 'second'))
+        self.assertEqual('first', self.mailbox.get(timeout=1).data)
+        self.assertEqual('second', self.mailbox.get(timeout=1).data)
+
+    def test_health_check_ping(self):
+        healthCheckProxy = self.mailbox.get_health_check_proxy(self.mailbox.uri)
+        try:
+            self.assertTrue(healthCheckProxy.ping())
+            self.assertIsNot(self.mailboxProxy, healthCheckProxy)
+        finally:
+            healthCheckProxy._pyroRelease()
+
+
+class TestMailboxProxyCache(unittest.TestCase):
+    def test_proxy_is_reused(self):
+        cache = MailboxProxyCache(2)
+        proxy = cache.get('mailbox_1')
+        self.assertIs(proxy, cache.get('mailbox_1'))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0}, cache.stats())
+
+    def test_least_recently_used_proxy_is_evicted(self):
+        cache = MailboxProxyCache(2)
+        first = cache.get('mailbox_1')
+        cache.get('mailbox_2')
+        cache.get('mailbox_1')
+        cache.get('mailbox_3')  # Evicts mailbox_2
+        self.assertIs(first, cache.get('mailbox_1'))
+        self.assertEqual({'size': 2, 'hits': 2, 'misses': 3, 'evictions': 1}, cache.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
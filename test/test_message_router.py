@@ -0,0 +1,430 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import threading
+import time
+import unittest
+import Pyro4.errors
+from tornado.testing import AsyncTestCase
+import config
+from chat_server import MessageRouter
+import mailbox
+from protocol import ClientMessage, MessageType, ServerMessage
+import user_registry
+
+
+class MailboxMock(mailbox.Mailbox):
+    def __init__(self, proxyMock=None):
+        super().__init__()
+        self.proxyMock = proxyMock
+
+    def get_mailbox_proxy(self, nameOrUri):
+        return self.proxyMock
+
+
+class RecordingMailboxMock(MailboxMock):
+    """ Records batches delivered to the mailbox
+    """
+    def __init__(self, onPutMany=None):
+        super().__init__()
+        self.putManyBatches = []
+        self.onPutMany = onPutMany
+
+    def put_many(self, msgs):
+        self.putManyBatches.append(msgs)
+        super().put_many(msgs)
+        if self.onPutMany:
+            self.onPutMany()
+
+
+class UnreachableMailboxMock:
+    def put(self, msg):
+        raise Pyro4.errors.CommunicationError('cannot connect')
+
+    def put_many(self, msgs):
+        raise Pyro4.errors.CommunicationError('cannot connect')
+
+    def put_encoded(self, data):
+        raise Pyro4.errors.CommunicationError('cannot connect')
+
+
+class ConnectionMock:
+    """ Records messages sent to a web socket connection, and the thread they were sent from
+    """
+    def __init__(self, onSend=None):
+        self.sentMessages = []
+        self.sendingThreads = []
+        self.onSend = onSend
+
+    def send_message(self, message):
+        self.sentMessages.append(message)
+        self.sendingThreads.append(threading.current_thread())
+        if self.onSend:
+            self.onSend()
+
+    def send_prepared_message(self, preparedMessage):
+        self.send_message(ClientMessage.from_json(preparedMessage.json_message().data.decode('utf-8')))
+
+
+class TestMessageRouterOnIOLoop(AsyncTestCase):
+    """ Tests that a message router given an IOLoop handles all messages on the IOLoop thread
+    """
+    def setUp(self):
+        super().setUp()
+        self.peerMailboxMock = MailboxMock()
+        self.routerMailbox = MailboxMock(proxyMock=self.peerMailboxMock)
+        self.messageRouter = MessageRouter(self.routerMailbox, 8001, self.io_loop, 0.01)
+        self.messageRouter.start()
+
+    def tearDown(self):
+        self.messageRouter.stop()
+        self.messageRouter.join()
+        super().tearDown()
+
+    def test_server_message_handled_on_ioloop_thread(self):
+        connection = ConnectionMock(onSend=self.stop)
+        self.messageRouter.userToWebSocketConnection['local_user'] = connection
+
+        # Delivered by another thread, as a remote put would be
+        msg = self.peerMailboxMock.create_message(MessageType.NEW_USER, 'remote_user')
+        threading.Thread(target=self.routerMailbox.put, args=(msg, )).start()
+        self.wait()
+
+        self.assertEqual(MessageType.LOGIN, connection.sentMessages[0].messageType)
+        self.assertEqual('remote_user', connection.sentMessages[0].senderUserName)
+        self.assertIs(threading.current_thread(), connection.sendingThreads[0])
+
+    def test_client_message_handled_without_mailbox_hop(self):
+        connection = ConnectionMock()
+        self.messageRouter.receive_client_message(ClientMessage(MessageType.LIST_ALL_USERS, 'user'), connection)
+        self.assertEqual(MessageType.LIST_ALL_USERS, connection.sentMessages[0].messageType)
+        self.assertTrue(self.routerMailbox.empty())
+
+    def test_client_message_batch_handled_without_mailbox_hop(self):
+        connection = ConnectionMock()
+        msgs = [ClientMessage(MessageType.LIST_ALL_USERS, 'user', 'a'),
+                ClientMessage(MessageType.LIST_ALL_USERS, 'user', 'b')]
+        self.messageRouter.receive_client_messages(msgs, connection)
+        self.assertEqual(2, len(connection.sentMessages))
+        self.assertTrue(self.routerMailbox.empty())
+
+    def test_load_report(self):
+        self.messageRouter.stop()  # Keeps delivered messages queued
+        self.messageRouter.join()
+        self.messageRouter.running = True
+        self.messageRouter.userToWebSocketConnection['local_user'] = ConnectionMock()
+        self.routerMailbox.put(self.peerMailboxMock.create_message(MessageType.NEW_USER, 'queued_user'))
+        self.messageRouter._report_load()
+
+        registerMsg, loadReportMsg = self.peerMailboxMock.drain(2)
+        self.assertEqual(MessageType.REGISTER_CHAT_SERVER, registerMsg.messageType)
+        self.assertEqual(MessageType.CHAT_SERVER_LOAD_REPORT, loadReportMsg.messageType)
+        httpPort, connectionCount, mailboxDepth, loopLatencySec = loadReportMsg.data
+        self.assertEqual((8001, 1, 1), (httpPort, connectionCount, mailboxDepth))
+        self.assertGreaterEqual(loopLatencySec, 0.0)
+
+
+class TestMessageRouterOutbox(AsyncTestCase):
+    """ Tests batching of messages sent to other message routers
+    """
+    def setUp(self):
+        super().setUp()
+        self.peerMailboxMock = RecordingMailboxMock(onPutMany=self.stop)
+        self.routerMailbox = MailboxMock(proxyMock=self.peerMailboxMock)
+        self.messageRouter = MessageRouter(self.routerMailbox, 8001, self.io_loop)
+        routersMsg = self.peerMailboxMock.create_message(MessageType.NEW_MESSAGE_ROUTER, ['peer_router_uri'])
+        self.messageRouter.handle_server_message(routersMsg)
+
+    def test_messages_within_interval_are_batched(self):
+        for i in range(3):
+            clientMsg = ClientMessage(MessageType.PUBLIC_MESSAGE, 'user', 'message %d' % i)
+            self.messageRouter.receive_client_message(clientMsg, ConnectionMock())
+        self.wait()
+
+        self.assertEqual(1, len(self.peerMailboxMock.putManyBatches))
+        batch = self.peerMailboxMock.putManyBatches[0]
+        self.assertEqual(['message 0', 'message 1', 'message 2'], [msg.data.messageText for msg in batch])
+
+    def test_users_of_removed_router_are_logged_out(self):
+        connection = ConnectionMock()
+        self.messageRouter.userToWebSocketConnection['local_user'] = connection
+        for userName, routerUri in [('user_1', 'peer_router_uri'), ('user_2', 'failed_router_uri')]:
+            self.messageRouter.handle_server_message(ServerMessage(MessageType.NEW_USER, routerUri, userName))
+        routersMsg = ServerMessage(MessageType.NEW_MESSAGE_ROUTER, None, ['peer_router_uri', 'failed_router_uri'])
+        self.messageRouter.handle_server_message(routersMsg)
+
+        routersMsg = ServerMessage(MessageType.NEW_MESSAGE_ROUTER, None, ['peer_router_uri'])
+        self.messageRouter.handle_server_message(routersMsg)
+        self.assertEqual(['user_1'], list(self.messageRouter.presence.users()))
+        self.assertEqual(['peer_router_uri'], list(self.messageRouter.routerOutboxes))
+        self.assertEqual((MessageType.LOGOUT, 'user_2'),
+                         (connection.sentMessages[-1].messageType, connection.sentMessages[-1].senderUserName))
+
+    def test_batches_in_compact_wire_format(self):
+        wireFormat = config.MAILBOX_WIRE_FORMAT
+        config.MAILBOX_WIRE_FORMAT = 'compact'
+        try:
+            self.test_messages_within_interval_are_batched()
+        finally:
+            config.MAILBOX_WIRE_FORMAT = wireFormat
+
+    def test_unreachable_router_does_not_stop_flush(self):
+        routerMailbox = MailboxMock(proxyMock=self.peerMailboxMock)
+        failedUris = ('failed_router_uri', user_registry.get_shard_name('failed_user'))
+        routerMailbox.get_mailbox_proxy = lambda uri: (UnreachableMailboxMock() if uri in failedUris
+                                                       else self.peerMailboxMock)
+        messageRouter = MessageRouter(routerMailbox, 8002, self.io_loop)
+        routersMsg = ServerMessage(MessageType.NEW_MESSAGE_ROUTER, None, ['failed_router_uri', 'peer_router_uri'])
+        messageRouter.handle_server_message(routersMsg)
+        self.peerMailboxMock.drain(10, 0)
+
+        for i in range(2):
+            messageRouter.handle_client_message(ClientMessage(MessageType.PUBLIC_MESSAGE, 'user', 'message %d' % i),
+                                                ConnectionMock())
+            messageRouter.receive_client_message(ClientMessage(MessageType.LOGIN, 'user_%d' % i), ConnectionMock())
+            messageRouter._flush_outboxes()
+
+            msgs = self.peerMailboxMock.drain(10, 0)
+            self.assertEqual([MessageType.FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS, MessageType.USER_REGISTRY_NEW_USERS],
+                             [msg.messageType for msg in msgs])
+            self.assertEqual('message %d' % i, msgs[0].data.messageText)
+
+        # Login sent to an unreachable registry shard is answered, and no longer pending
+        connection = ConnectionMock()
+        messageRouter.receive_client_message(ClientMessage(MessageType.LOGIN, 'failed_user'), connection)
+        messageRouter._flush_outboxes()
+        self.assertEqual([MessageType.LOGIN_FAILED], [msg.messageType for msg in connection.sentMessages])
+        self.assertNotIn('failed_user', messageRouter.pendingUserLoginToWebSocketConnection)
+
+    def test_full_batch_is_sent_at_once(self):
+        outbox = self.messageRouter.messageRouterMailboxes[0]
+        for i in range(outbox.maxBatchSize):
+            outbox.put(self.routerMailbox.create_message(MessageType.NEW_USER, 'user %d' % i))
+        self.assertEqual(1, len(self.peerMailboxMock.putManyBatches))
+        self.assertEqual(outbox.maxBatchSize, len(self.peerMailboxMock.putManyBatches[0]))
+
+    def test_user_pages_are_cached_until_users_change(self):
+        connection = ConnectionMock()
+        listMsg = ClientMessage(MessageType.LIST_ALL_USERS, 'user')
+        for userName in ['user_1', 'user_2']:
+            self.messageRouter.handle_server_message(ServerMessage(MessageType.NEW_USER, 'peer_router_uri', userName))
+        self.messageRouter.handle_client_message(listMsg, connection)
+        self.messageRouter.handle_client_message(listMsg, connection)
+        self.assertEqual(1, len(self.messageRouter.userPageCache))
+        self.assertEqual(['user_1', 'user_2'], connection.sentMessages[-1].allUsers)
+
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.REMOVE_USER, 'peer_router_uri', 'user_1'))
+        self.messageRouter.handle_client_message(listMsg, connection)
+        self.assertEqual(['user_2'], connection.sentMessages[-1].allUsers)
+        self.assertEqual('', connection.sentMessages[-1].cursor)
+
+
+class TestMessageRouterRegistryBatching(AsyncTestCase):
+    """ Tests batching of login requests to the user registry shards
+    """
+    def setUp(self):
+        super().setUp()
+        self.registryMailboxMock = MailboxMock()
+        self.routerMailbox = MailboxMock(proxyMock=self.registryMailboxMock)
+        self.messageRouter = MessageRouter(self.routerMailbox, 8001, self.io_loop)
+        self.registryMailboxMock.drain(10)  # Registration at load balancer
+
+    def test_logins_within_interval_are_batched(self):
+        connections = {}
+        for i in range(10):
+            connections['user_%d' % i] = ConnectionMock()
+            clientMsg = ClientMessage(MessageType.LOGIN, 'user_%d' % i)
+            self.messageRouter.receive_client_message(clientMsg, connections['user_%d' % i])
+        self.io_loop.add_timeout(time.time() + 0.05, self.stop)
+        self.wait()
+
+        requestMsgs = self.registryMailboxMock.drain(100)
+        self.assertLessEqual(len(requestMsgs), config.USER_REGISTRY_SHARD_COUNT)  # At most one request per shard
+        self.assertEqual(sorted(connections), sorted(name for msg in requestMsgs for name in msg.data))
+        for msg in requestMsgs:
+            self.assertEqual(MessageType.USER_REGISTRY_NEW_USERS, msg.messageType)
+
+        results = [(userName, userName != 'user_0') for userName in sorted(connections)]
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, None, results))
+        self.assertEqual(sorted(connections)[1:], sorted(self.messageRouter.userToWebSocketConnection))
+        self.assertEqual(MessageType.LOGIN_FAILED, connections['user_0'].sentMessages[0].messageType)
+        self.assertEqual({}, self.messageRouter.pendingUserLoginToWebSocketConnection)
+
+    def test_duplicate_login_in_batch(self):
+        connections = [ConnectionMock(), ConnectionMock(), ConnectionMock()]
+        for userName, connection in zip(['bob', 'bob', 'zed'], connections):
+            self.messageRouter.receive_client_message(ClientMessage(MessageType.LOGIN, userName), connection)
+        self.assertEqual([MessageType.LOGIN_FAILED], [msg.messageType for msg in connections[1].sentMessages])
+        self.messageRouter._flush_outboxes()
+        self.assertEqual(['bob', 'zed'], sorted(name for msg in self.registryMailboxMock.drain(10, 0) for name in msg.data))
+
+        # A response for a login that is no longer pending is discarded, without losing the rest of the batch
+        results = [('bob', True), ('bob', False), ('zed', True)]
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, None, results))
+        self.assertEqual({'bob': connections[0], 'zed': connections[2]}, self.messageRouter.userToWebSocketConnection)
+        self.assertEqual({}, self.messageRouter.pendingUserLoginToWebSocketConnection)
+
+    def test_user_of_closed_connection_is_logged_out(self):
+        connection = ConnectionMock()
+        self.messageRouter.pendingUserLoginToWebSocketConnection['user'] = connection
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, None, [('user', True)]))
+        self.messageRouter.receive_connection_closed(connection)
+        self.messageRouter.receive_connection_closed(ConnectionMock())  # Not logged in
+        self.messageRouter._flush_outboxes()
+
+        requestMsg, = self.registryMailboxMock.drain(10, 0)
+        self.assertEqual((MessageType.USER_REGISTRY_REMOVE_USERS, ['user']), (requestMsg.messageType, requestMsg.data))
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.USER_REGISTRY_REMOVE_USERS, None,
+                                                               [('user', True)]))
+        self.assertEqual({}, self.messageRouter.webSocketConnectionToUser)
+
+
+    def test_connection_closed_during_pending_login(self):
+        connection = ConnectionMock()
+        self.messageRouter.receive_client_message(ClientMessage(MessageType.LOGIN, 'user'), connection)
+        self.messageRouter.receive_connection_closed(connection)
+        self.messageRouter._flush_outboxes()
+        requestMsg, = self.registryMailboxMock.drain(10, 0)
+        self.assertEqual((MessageType.USER_REGISTRY_NEW_USERS, ['user']), (requestMsg.messageType, requestMsg.data))
+
+        # Registered name of the closed connection is released, instead of being held by the dead connection
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, None, [('user', True)]))
+        self.assertEqual({}, self.messageRouter.userToWebSocketConnection)
+        self.assertEqual({}, self.messageRouter.webSocketConnectionToUser)
+        self.assertIsNone(self.messageRouter.presence.get_router_uri('user'))
+        self.messageRouter._flush_outboxes()
+        requestMsg, = self.registryMailboxMock.drain(10, 0)
+        self.assertEqual((MessageType.USER_REGISTRY_REMOVE_USERS, ['user']), (requestMsg.messageType, requestMsg.data))
+
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.USER_REGISTRY_REMOVE_USERS, None,
+                                                               [('user', True)]))
+        self.assertEqual([], connection.sentMessages)
+        self.assertEqual({}, self.messageRouter.pendingUserLoginToWebSocketConnection)
+        self.assertEqual(set(), self.messageRouter.closedPendingLogins)
+
+
+class TestMessageRouterPresence(unittest.TestCase):
+    """ Tests replication of users between message routers by presence deltas, digests and syncs
+    """
+    def setUp(self):
+        self.peerMailboxMock = MailboxMock()
+        self.routerMailbox = MailboxMock(proxyMock=self.peerMailboxMock)
+        self.messageRouter = MessageRouter(self.routerMailbox, 8001)
+        routersMsg = ServerMessage(MessageType.NEW_MESSAGE_ROUTER, None, ['peer_router_uri'])
+        self.messageRouter.handle_server_message(routersMsg)
+        self.connection = ConnectionMock()
+        self.messageRouter.userToWebSocketConnection['local_user'] = self.connection
+        self.peerMailboxMock.drain(10)  # Registration at load balancer
+
+    def send_from_peer(self, messageType, data):
+        self.messageRouter.handle_server_message(ServerMessage(messageType, 'peer_router_uri', data))
+        self.messageRouter._flush_outboxes()
+        return self.peerMailboxMock.drain(10, 0)
+
+    def test_logins_are_sent_in_one_delta(self):
+        for userName in ['user_1', 'user_2']:
+            self.messageRouter.pendingUserLoginToWebSocketConnection[userName] = ConnectionMock()
+        results = [('user_1', True), ('user_2', True)]
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, None, results))
+        self.messageRouter._flush_outboxes()
+
+        deltaMsg, = self.peerMailboxMock.drain(10, 0)
+        self.assertEqual(MessageType.PRESENCE_DELTA, deltaMsg.messageType)
+        self.assertEqual((1, ['user_1', 'user_2'], []), tuple(deltaMsg.data))
+        self.assertEqual(['user_1', 'user_2'], [msg.senderUserName for msg in self.connection.sentMessages])
+
+    def test_lost_delta_requests_sync(self):
+        self.assertEqual([], self.send_from_peer(MessageType.PRESENCE_DELTA, (1, ['user_1', 'user_2'], [])))
+        requestMsgs = self.send_from_peer(MessageType.PRESENCE_DELTA, (3, ['user_3'], []))
+        self.assertEqual([MessageType.PRESENCE_SYNC_REQUEST], [msg.messageType for msg in requestMsgs])
+        self.assertEqual('peer_router_uri', self.messageRouter.presence.get_router_uri('user_3'))
+
+        self.send_from_peer(MessageType.PRESENCE_SYNC, (3, ['user_1', 'user_3', 'user_4']))
+        self.assertEqual(['user_1', 'user_3', 'user_4'], sorted(self.messageRouter.presence.users()))
+        self.assertEqual((MessageType.LOGOUT, 'user_2'),
+                         (self.connection.sentMessages[-1].messageType, self.connection.sentMessages[-1].senderUserName))
+        self.assertEqual([], self.send_from_peer(MessageType.PRESENCE_DELTA, (4, [], ['user_4'])))
+
+    def test_digest_mismatch_requests_sync(self):
+        self.send_from_peer(MessageType.PRESENCE_DELTA, (1, ['user_1', 'user_2'], []))
+        userCount, digest = self.messageRouter.presence.get_digest(self.messageRouter.presence.get_router_id('peer_router_uri'))
+        self.assertEqual([], self.send_from_peer(MessageType.PRESENCE_DIGEST, (1, userCount, digest)))
+
+        requestMsgs = self.send_from_peer(MessageType.PRESENCE_DIGEST, (1, userCount, digest + 1))
+        self.assertEqual([MessageType.PRESENCE_SYNC_REQUEST], [msg.messageType for msg in requestMsgs])
+
+    def test_sync_request_is_answered_with_local_users(self):
+        syncMsg, = self.send_from_peer(MessageType.PRESENCE_SYNC_REQUEST, None)
+        self.assertEqual(MessageType.PRESENCE_SYNC, syncMsg.messageType)
+        self.assertEqual((0, ['local_user']), tuple(syncMsg.data))
+
+
+class TestMessageRouterRooms(unittest.TestCase):
+    """ Tests that room messages only reach the users and message routers with users in the room
+    """
+    def setUp(self):
+        self.peerMailboxMock = MailboxMock()
+        self.routerMailbox = MailboxMock(proxyMock=self.peerMailboxMock)
+        self.messageRouter = MessageRouter(self.routerMailbox, 8001)
+        routersMsg = ServerMessage(MessageType.NEW_MESSAGE_ROUTER, None, ['peer_router_uri'])
+        self.messageRouter.handle_server_message(routersMsg)
+        self.connections = {}
+        for userName in ['user_1', 'user_2', 'user_3']:
+            self.connections[userName] = ConnectionMock()
+            self.messageRouter.userToWebSocketConnection[userName] = self.connections[userName]
+        self.peerMailboxMock.drain(10)  # Registration at load balancer
+
+    def handle_client_message(self, messageType, userName, roomName, messageText=''):
+        clientMsg = ClientMessage(messageType, userName, messageText, roomName=roomName)
+        self.messageRouter.handle_client_message(clientMsg, self.connections[userName])
+        self.messageRouter._flush_outboxes()
+        return self.peerMailboxMock.drain(10, 0)
+
+    def handle_peer_message(self, messageType, data):
+        self.messageRouter.handle_server_message(ServerMessage(messageType, 'peer_router_uri', data))
+
+    def test_first_and_last_local_user_change_subscription(self):
+        subscriptionMsg, = self.handle_client_message(MessageType.JOIN_ROOM, 'user_1', 'room')
+        self.assertEqual((MessageType.ROOM_SUBSCRIPTIONS, (['room'], [])),
+                         (subscriptionMsg.messageType, tuple(subscriptionMsg.data)))
+        self.assertEqual([], self.handle_client_message(MessageType.JOIN_ROOM, 'user_2', 'room'))
+        self.assertEqual(MessageType.JOIN_ROOM, self.connections['user_2'].sentMessages[-1].messageType)
+
+        self.assertEqual([], self.handle_client_message(MessageType.LEAVE_ROOM, 'user_1', 'room'))
+        self.messageRouter.handle_server_message(ServerMessage(MessageType.USER_REGISTRY_REMOVE_USERS, None,
+                                                               [('user_2', True)]))
+        self.messageRouter._flush_outboxes()
+        msgs = self.peerMailboxMock.drain(10, 0)
+        self.assertEqual(([], ['room']), tuple(msgs[-1].data))
+        self.assertEqual({}, self.messageRouter.roomToLocalUsers)
+        self.assertEqual({}, self.messageRouter.userToRooms)
+
+    def test_room_message_only_reaches_routers_and_users_in_room(self):
+        self.handle_client_message(MessageType.JOIN_ROOM, 'user_1', 'room')
+        self.handle_client_message(MessageType.JOIN_ROOM, 'user_2', 'room')
+        self.assertEqual([], self.handle_client_message(MessageType.ROOM_MESSAGE, 'user_1', 'room', 'hello'))
+        self.assertEqual(('room', 'hello'), (self.connections['user_2'].sentMessages[-1].roomName,
+                                             self.connections['user_2'].sentMessages[-1].messageText))
+        self.assertEqual([], self.connections['user_3'].sentMessages)
+
+        self.handle_peer_message(MessageType.ROOM_SUBSCRIPTIONS, (['room'], []))
+        forwardMsg, = self.handle_client_message(MessageType.ROOM_MESSAGE, 'user_1', 'room', 'hello')
+        self.assertEqual(MessageType.FORWARD_ROOM_MESSAGE, forwardMsg.messageType)
+        self.handle_peer_message(MessageType.ROOM_SUBSCRIPTIONS, ([], ['room']))
+        self.assertEqual([], self.handle_client_message(MessageType.ROOM_MESSAGE, 'user_1', 'room', 'hello'))
+
+    def test_forwarded_room_message_reaches_local_users_in_room(self):
+        self.handle_client_message(MessageType.JOIN_ROOM, 'user_1', 'room')
+        self.handle_peer_message(MessageType.FORWARD_ROOM_MESSAGE,
+                                 ClientMessage(MessageType.ROOM_MESSAGE, 'remote_user', 'hello', roomName='room'))
+        self.assertEqual('remote_user', self.connections['user_1'].sentMessages[-1].senderUserName)
+        self.assertEqual([], self.connections['user_2'].sentMessages)
+
+    def test_message_from_user_not_in_room_is_dropped(self):
+        self.handle_peer_message(MessageType.ROOM_SUBSCRIPTIONS, (['room'], []))
+        self.assertEqual([], self.handle_client_message(MessageType.ROOM_MESSAGE, 'user_1', 'room', 'hello'))
+
+
+if __name__ == '__main__':
+    unittest.main()
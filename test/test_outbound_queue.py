@@ -0,0 +1,103 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import unittest
+from tornado.websocket import PreparedMessage
+import outbound_queue
+from outbound_queue import OutboundQueue, OutboundQueueStats
+
+
+class ConnectionStub:
+    """ Records the batches written, and lets the test decide when a batch has been written
+    """
+    def __init__(self):
+        self.batches = []
+        self.callbacks = []
+        self.writing = False
+        self.evicted = False
+
+    def write_prepared_messages(self, preparedMessages, callback):
+        self.batches.append([preparedMessage.data for preparedMessage in preparedMessages])
+        self.callbacks.append(callback)
+        self.writing = True
+
+    def complete_write(self):
+        self.writing = False
+        self.callbacks[-1]()
+
+    def is_writing(self):
+        return self.writing
+
+    def evict(self):
+        self.evicted = True
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def setUp(self):
+        self.connection = ConnectionStub()
+        self.stats = OutboundQueueStats()
+
+    def create_queue(self, overflowPolicy=outbound_queue.DROP_OLDEST, evictAfterSec=60):
+        return OutboundQueue(self.connection, self.stats, 10, 4, overflowPolicy, evictAfterSec)
+
+    def put(self, queue, *datas):
+        for data in datas:
+            queue.put(PreparedMessage(data))
+
+    def test_waiting_messages_are_written_in_one_batch(self):
+        queue = self.create_queue()
+        self.put(queue, b'a', b'b', b'c')
+        self.assertEqual([[b'a']], self.connection.batches)
+        self.connection.complete_write()
+        self.assertEqual([[b'a'], [b'b', b'c']], self.connection.batches)
+        self.connection.complete_write()
+        self.assertEqual(0, queue.backlog())
+        self.assertEqual(3, self.stats.sentCount)
+
+    def test_drop_oldest(self):
+        queue = self.create_queue()
+        self.put(queue, b'aaaa', b'bbb', b'ccc', b'ddd')  # 'aaaa' is being written
+        self.assertEqual([[b'aaaa']], self.connection.batches)
+        self.assertEqual(1, self.stats.droppedCount)
+        self.assertEqual(1, self.stats.slowReaderCount)
+        self.connection.complete_write()
+        self.assertEqual([b'ccc', b'ddd'], self.connection.batches[-1])
+
+    def test_drop_new(self):
+        queue = self.create_queue(outbound_queue.DROP_NEW)
+        self.put(queue, b'aaaa', b'bbb', b'ccc', b'ddd')
+        self.connection.complete_write()
+        self.assertEqual([b'bbb', b'ccc'], self.connection.batches[-1])
+        self.put(queue, b'eee')  # Slow reader, backlog is above the low watermark
+        self.assertEqual(2, queue.droppedCount)
+
+    def test_slow_reader_recovers_below_low_watermark(self):
+        queue = self.create_queue(outbound_queue.DROP_NEW)
+        self.put(queue, b'aaaa', b'bbb', b'ccc', b'ddd')
+        self.connection.complete_write()
+        self.connection.complete_write()
+        self.assertIsNone(queue.slowReaderSince)
+        self.put(queue, b'eee')
+        self.assertEqual([b'eee'], self.connection.batches[-1])
+
+    def test_slow_reader_is_evicted(self):
+        queue = self.create_queue(evictAfterSec=0)
+        self.put(queue, b'aaaa', b'bbbbbbb', b'c')
+        self.assertTrue(self.connection.evicted)
+        self.assertEqual(1, self.stats.evictedCount)
+        self.put(queue, b'd')
+        self.assertEqual([[b'aaaa']], self.connection.batches)
+
+    def test_replaced_write_callback(self):
+        queue = self.create_queue()
+        self.put(queue, b'a')
+        self.connection.writing = False  # Written, but the callback was replaced by another write
+        self.put(queue, b'b')
+        self.assertEqual([[b'a'], [b'b']], self.connection.batches)
+        self.connection.callbacks[0]()  # Stale
+        self.assertEqual(1, queue.backlog())
+
+
+if __name__ == '__main__':
+    unittest.main()
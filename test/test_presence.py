@@ -0,0 +1,87 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import unittest
+from presence import PresenceIndex
+
+
+class TestPresenceIndex(unittest.TestCase):
+    def setUp(self):
+        self.presence = PresenceIndex()
+        self.routerId1 = self.presence.get_router_id('router_1')
+        self.routerId2 = self.presence.get_router_id('router_2')
+
+    def test_router_ids(self):
+        self.assertEqual((0, 1), (self.routerId1, self.routerId2))
+        self.assertEqual(self.routerId1, self.presence.get_router_id('router_1'))
+
+    def test_add_and_remove_user(self):
+        self.assertTrue(self.presence.add_user('user_1', self.routerId1))
+        self.assertFalse(self.presence.add_user('user_1', self.routerId2))
+        self.assertEqual('router_1', self.presence.get_router_uri('user_1'))
+        self.assertIn('user_1', self.presence)
+
+        self.assertTrue(self.presence.remove_user('user_1'))
+        self.assertFalse(self.presence.remove_user('user_1'))
+        self.assertIsNone(self.presence.get_router_uri('user_1'))
+        self.assertEqual(0, len(self.presence))
+
+    def test_digest_depends_only_on_users(self):
+        for userName in ['user_1', 'user_2', 'user_3']:
+            self.presence.add_user(userName, self.routerId1)
+        self.presence.remove_user('user_2')
+        for userName in ['user_3', 'user_1']:
+            self.presence.add_user(userName, self.routerId2)  # Already present, ignored
+
+        other = PresenceIndex()
+        otherRouterId = other.get_router_id('router_1')
+        for userName in ['user_3', 'user_1']:
+            other.add_user(userName, otherRouterId)
+        self.assertEqual(other.get_digest(otherRouterId), self.presence.get_digest(self.routerId1))
+        self.assertEqual(2, self.presence.get_digest(self.routerId1)[0])
+        self.assertEqual((0, 0), self.presence.get_digest(self.routerId2))
+
+    def test_replace_router_users(self):
+        for userName in ['user_1', 'user_2']:
+            self.presence.add_user(userName, self.routerId1)
+        self.presence.add_user('user_3', self.routerId2)
+
+        addedUsers, removedUsers = self.presence.replace_router_users(self.routerId1, ['user_2', 'user_3', 'user_4'])
+        self.assertEqual((['user_4'], ['user_1']), (addedUsers, removedUsers))
+        self.assertEqual(['user_2', 'user_4'], sorted(self.presence.get_router_users(self.routerId1)))
+        self.assertEqual('router_2', self.presence.get_router_uri('user_3'))
+
+    def test_remove_router(self):
+        self.presence.add_user('user_1', self.routerId1)
+        self.presence.add_user('user_2', self.routerId2)
+        self.assertEqual(['user_1'], self.presence.remove_router('router_1'))
+        self.assertEqual([], self.presence.remove_router('router_1'))
+        self.assertEqual(['user_2'], list(self.presence.users()))
+        self.assertNotEqual(self.routerId1, self.presence.get_router_id('router_1'))  # Ids are not reused
+
+    def test_user_pages(self):
+        for i in range(5):
+            self.presence.add_user('user_%d' % i, self.routerId1)
+        self.presence.add_user('other', self.routerId2)
+
+        self.assertEqual((['other', 'user_0'], 'user_0'), self.presence.get_user_page('', '', 2))
+        self.assertEqual((['user_1', 'user_2'], 'user_2'), self.presence.get_user_page('', 'user_0', 2))
+        self.assertEqual((['user_3', 'user_4'], ''), self.presence.get_user_page('', 'user_2', 2))
+        self.assertEqual((['user_0', 'user_1', 'user_2'], 'user_2'), self.presence.get_user_page('user', '', 3))
+        self.assertEqual((['user_3', 'user_4'], ''), self.presence.get_user_page('user', 'user_2', 3))
+        self.assertEqual((['other'], ''), self.presence.get_user_page('o', '', 3))
+        self.assertEqual(([], ''), self.presence.get_user_page('x', '', 3))
+
+    def test_user_pages_follow_changes(self):
+        for i in range(4):
+            self.presence.add_user('user_%d' % i, self.routerId1)
+        page, cursor = self.presence.get_user_page('', '', 2)
+        self.presence.remove_user('user_1')  # Listed already
+        self.presence.add_user('user_00', self.routerId2)  # Before the cursor
+        self.presence.add_user('user_4', self.routerId2)
+        self.assertEqual((['user_2', 'user_3'], 'user_3'), self.presence.get_user_page('', cursor, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import json
+import unittest
+from protocol import ClientMessage, MessageType, ServerMessage
+
+
+class TestClientMessage(unittest.TestCase):
+    def test_json_uses_message_type_names(self):
+        msg = ClientMessage(MessageType.PRIVATE_MESSAGE, 'sender', 'hello', 'receiver')
+        self.assertEqual('private_message', json.loads(ClientMessage.to_json(msg))['messageType'])
+
+        decodedMsg = ClientMessage.from_json(ClientMessage.to_json(msg))
+        self.assertEqual(MessageType.PRIVATE_MESSAGE, decodedMsg.messageType)
+        self.assertEqual(('sender', 'hello', 'receiver'),
+                         (decodedMsg.senderUserName, decodedMsg.messageText, decodedMsg.receiverUserName))
+
+    def test_empty_fields_are_left_out(self):
+        msg = ClientMessage(MessageType.PUBLIC_MESSAGE, 'sender', 'hello')
+        self.assertEqual(b'{"messageType":"public_message","senderUserName":"sender","messageText":"hello"}',
+                         ClientMessage.to_json_bytes(msg))
+
+        decodedMsg = ClientMessage.from_json('{"messageType":"list_all_users"}')
+        self.assertEqual(('', '', '', None), (decodedMsg.senderUserName, decodedMsg.messageText,
+                                              decodedMsg.receiverUserName, decodedMsg.allUsers))
+
+    def test_empty_user_list_is_kept(self):
+        msg = ClientMessage(MessageType.LIST_ALL_USERS, allUsers=[])
+        self.assertEqual([], json.loads(ClientMessage.to_json(msg))['allUsers'])
+
+    def test_non_ascii_text(self):
+        msg = ClientMessage(MessageType.PUBLIC_MESSAGE, 'sender', 'bl\u00e5b\u00e6r \U0001f600 \ud800')
+        decodedMsg = ClientMessage.from_json(ClientMessage.to_json_bytes(msg).decode('utf-8'))
+        self.assertEqual(msg.messageText, decodedMsg.messageText)
+
+    def test_unknown_message_type_name(self):
+        msg = ClientMessage.from_json('{"messageType": "no_such_type", "senderUserName": "user"}')
+        self.assertIsNone(msg.messageType)
+
+    def test_user_names_are_interned(self):
+        msg = ClientMessage.from_json('{"messageType": "login", "senderUserName": "user_%d"}' % 1)
+        otherMsg = ClientMessage.from_json('{"messageType": "login", "senderUserName": "user_%d"}' % 1)
+        self.assertIs(msg.senderUserName, otherMsg.senderUserName)
+
+    def test_messages_have_no_instance_dict(self):
+        self.assertFalse(hasattr(ClientMessage(MessageType.LOGIN, 'user'), '__dict__'))
+        self.assertFalse(hasattr(ServerMessage(MessageType.NEW_USER, None, 'user'), '__dict__'))
+
+    def test_binary_round_trip(self):
+        msg = ClientMessage(MessageType.ROOM_MESSAGE, 'sender', 'hello', roomName='room')
+        self.assertEqual(b'\x1a\x13\x00\x06sender\x00\x05hello\x00\x04room', ClientMessage.to_binary(msg))
+
+        decodedMsg = ClientMessage.from_binary(ClientMessage.to_binary(msg))
+        self.assertEqual(MessageType.ROOM_MESSAGE, decodedMsg.messageType)
+        self.assertEqual(('sender', 'hello', '', '', 'room', None),
+                         (decodedMsg.senderUserName, decodedMsg.messageText, decodedMsg.receiverUserName,
+                          decodedMsg.cursor, decodedMsg.roomName, decodedMsg.allUsers))
+
+    def test_binary_user_list(self):
+        for allUsers in ([], [''], ['user_1', 'user_2'],
+                         ['bl\u00e5b\u00e6r \ud800', 'separator \uffff in name', '']):
+            msg = ClientMessage(MessageType.LIST_ALL_USERS, allUsers=allUsers, cursor='user_2')
+            decodedMsg = ClientMessage.from_binary(ClientMessage.to_binary(msg))
+            self.assertEqual(allUsers, decodedMsg.allUsers)
+            self.assertEqual('user_2', decodedMsg.cursor)
+
+    def test_binary_non_ascii_and_long_text(self):
+        for text in ('bl\u00e5b\u00e6r \U0001f600 \ud800', 'x' * 70000):
+            msg = ClientMessage(MessageType.PUBLIC_MESSAGE, 'sender', text)
+            self.assertEqual(text, ClientMessage.from_binary(ClientMessage.to_binary(msg)).messageText)
+
+    def test_truncated_binary_message(self):
+        data = ClientMessage.to_binary(ClientMessage(MessageType.PUBLIC_MESSAGE, 'sender', 'hello'))
+        self.assertRaises(ValueError, ClientMessage.from_binary, data[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import queue
+import shutil
+import tempfile
+import unittest
+import mailbox
+from protocol import MessageType, ServerMessage
+from registry_log import RegistryLog
+from user_registry import UserRegistry
+
+
+class MailboxMock(mailbox.Mailbox):
+    def __init__(self, proxyMock=None):
+        super().__init__()
+        self.proxyMock = proxyMock
+
+    def get_mailbox_proxy(self, nameOrUri):
+        return self.proxyMock
+
+
+class TestRegistryLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_log(self, snapshotInterval=1000):
+        return RegistryLog(self.directory, 'user_registry_0', snapshotInterval)
+
+    def recover(self):
+        """ Returns the users recovered by a new log, and the number of records replayed from the log file
+        """
+        registryLog = self.create_log()
+        users = registryLog.replay()
+        registryLog.close()
+        return users, registryLog.recordCount
+
+    def test_replay_committed_operations(self):
+        registryLog = self.create_log()
+        self.assertEqual({}, registryLog.replay())
+        users = {'user_1': 'router_1', 'user_2': 'router_2'}
+        registryLog.append_register('user_1', 'router_1')
+        registryLog.append_register('user_2', 'router_2')
+        registryLog.append_register('user_3', 'router_1')
+        registryLog.append_remove('user_3')
+        registryLog.commit(users)
+        registryLog.append_register('user_4', 'router_1')  # Never committed
+        registryLog.close()
+
+        self.assertEqual((users, 4), self.recover())
+
+    def test_snapshot_empties_log(self):
+        registryLog = self.create_log(snapshotInterval=3)
+        registryLog.replay()
+        users = {}
+        for i in range(4):
+            users['user_%d' % i] = 'router_1'
+            registryLog.append_register('user_%d' % i, 'router_1')
+            registryLog.commit(users)
+        del users['user_0']
+        registryLog.append_remove('user_0')
+        registryLog.commit(users)
+        registryLog.close()
+
+        self.assertEqual(1, registryLog.snapshotCount)
+        self.assertEqual((users, 2), self.recover())  # Two records logged after the snapshot
+
+    def test_torn_record_is_dropped(self):
+        registryLog = self.create_log()
+        registryLog.replay()
+        registryLog.append_register('user_1', 'router_1')
+        registryLog.append_register('user_2', 'router_1')
+        registryLog.commit({})
+        registryLog.close()
+        with open(registryLog.logPath, 'r+b') as logFile:
+            logFile.truncate(os.path.getsize(registryLog.logPath) - 1)  # Crash in the middle of a write
+
+        registryLog = self.create_log()
+        self.assertEqual({'user_1': 'router_1'}, registryLog.replay())  # Dropped from the file
+        registryLog.append_register('user_3', 'router_1')
+        registryLog.commit({})
+        registryLog.close()
+        self.assertEqual(({'user_1': 'router_1', 'user_3': 'router_1'}, 2), self.recover())
+
+
+class TestUserRegistryRecovery(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.senderMailboxMock = MailboxMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_registry(self, requests):
+        userRegistryMailbox = MailboxMock(proxyMock=self.senderMailboxMock)
+        userRegistry = UserRegistry(userRegistryMailbox, 0.01, RegistryLog(self.directory, 'user_registry_0', 1000))
+        userRegistry.start()
+        try:
+            responses = []
+            for messageType, userName in requests:
+                userRegistryMailbox.put(ServerMessage(messageType, 'router_1', userName))
+                responses.append(self.senderMailboxMock.get(timeout=1).data)
+            return responses
+        except queue.Empty:
+            self.fail('user registry did not respond in time')
+        finally:
+            userRegistry.stop()
+            userRegistry.join()
+
+    def test_users_are_recovered_after_restart(self):
+        self.run_registry([(MessageType.USER_REGISTRY_NEW_USER, 'user_1'),
+                           (MessageType.USER_REGISTRY_NEW_USER, 'user_2'),
+                           (MessageType.USER_REGISTRY_REMOVE_USER, 'user_2')])
+        responses = self.run_registry([(MessageType.USER_REGISTRY_NEW_USER, 'user_1'),
+                                       (MessageType.USER_REGISTRY_NEW_USER, 'user_2')])
+        self.assertEqual([('user_1', False), ('user_2', True)], responses)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,11 @@ import sys
 sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
 sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
 import unittest
-from user_registry import UserRegistry
+import config
+from user_registry import UserRegistry, get_shard_name, get_all_shard_names
 import mailbox
-from protocol import MessageType
+import Pyro4.errors
+from protocol import MessageType, ServerMessage
 import queue
 
 
@@ -18,6 +20,20 @@ class MailboxMock(mailbox.Mailbox):
         return self.proxyMock
 
 
+class UnreachableMailboxMock:
+    def put(self, msg):
+        raise Pyro4.errors.CommunicationError('mailbox unreachable')
+
+
+class RoutingMailboxMock(mailbox.Mailbox):
+    def __init__(self, proxyMocks):
+        super().__init__()
+        self.proxyMocks = proxyMocks
+
+    def get_mailbox_proxy(self, nameOrUri):
+        return self.proxyMocks[nameOrUri]
+
+
 class TestUserRegistry(unittest.TestCase):
     """ Tests user registry by setting up the registry and sending messages.
     Alternatively, methods of registry could be tested separately.
@@ -54,6 +70,82 @@ class TestUserRegistry(unittest.TestCase):
         except queue.Empty:
             self.fail('user registry did not respond in time')
 
+    def register_user(self, userName, routerUri):
+        self.userRegistryMailbox.put(ServerMessage(MessageType.USER_REGISTRY_NEW_USER, routerUri, userName))
+        userName, isSuccess = self.senderMailboxMock.get(timeout=1).data
+        return isSuccess
+
+    def test_batch_requests(self):
+        try:
+            self.assertTrue(self.register_user('user_1', 'router_1'))
+            requestMsg = ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, 'router_1', ['user_1', 'user_2', 'user_3'])
+            self.userRegistryMailbox.put(requestMsg)
+            responseMsg = self.senderMailboxMock.get(timeout=1)
+            self.assertEqual(MessageType.USER_REGISTRY_NEW_USERS, responseMsg.messageType)
+            self.assertEqual([('user_1', False), ('user_2', True), ('user_3', True)], responseMsg.data)
+
+            requestMsg = ServerMessage(MessageType.USER_REGISTRY_REMOVE_USERS, 'router_1', ['user_2', 'user_4'])
+            self.userRegistryMailbox.put(requestMsg)
+            responseMsg = self.senderMailboxMock.get(timeout=1)
+            self.assertEqual(MessageType.USER_REGISTRY_REMOVE_USERS, responseMsg.messageType)
+            self.assertEqual([('user_2', True), ('user_4', False)], responseMsg.data)
+        except queue.Empty:
+            self.fail('user registry did not respond in time')
+
+    def test_remove_message_router_users(self):
+        try:
+            self.assertTrue(self.register_user('user_1', 'router_1'))
+            self.assertTrue(self.register_user('user_2', 'router_2'))
+
+            # Users of the removed router can log in again, on another router
+            self.userRegistryMailbox.put(ServerMessage(MessageType.USER_REGISTRY_REMOVE_MESSAGE_ROUTER, None, 'router_1'))
+            self.assertTrue(self.register_user('user_1', 'router_2'))
+            self.assertFalse(self.register_user('user_2', 'router_2'))
+        except queue.Empty:
+            self.fail('user registry did not respond in time')
+
+
+class TestUserRegistryUnreachableRouter(unittest.TestCase):
+    def setUp(self):
+        self.senderMailboxMock = MailboxMock()
+        self.userRegistryMailbox = RoutingMailboxMock({'failed_router': UnreachableMailboxMock(),
+                                                       'router_1': self.senderMailboxMock})
+        self.userRegistry = UserRegistry(self.userRegistryMailbox, 0.01)
+
+    def tearDown(self):
+        self.userRegistry.stop()
+        self.userRegistry.join()
+
+    def test_unreachable_router_does_not_stop_responses(self):
+        # Queued before start, so that the responses are sent in one batch
+        self.userRegistryMailbox.put(ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, 'failed_router', ['user_1']))
+        self.userRegistryMailbox.put(ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, 'router_1', ['user_2']))
+        self.userRegistry.start()
+        try:
+            self.assertEqual([('user_2', True)], self.senderMailboxMock.get(timeout=1).data)
+
+            # Registry keeps draining its mailbox
+            self.userRegistryMailbox.put(ServerMessage(MessageType.USER_REGISTRY_NEW_USERS, 'router_1', ['user_3']))
+            self.assertEqual([('user_3', True)], self.senderMailboxMock.get(timeout=1).data)
+        except queue.Empty:
+            self.fail('user registry did not respond in time')
+        self.assertTrue(self.userRegistry.is_alive())
+
+
+class TestUserRegistrySharding(unittest.TestCase):
+    def test_users_are_spread_over_all_shards(self):
+        userCounts = {shardName: 0 for shardName in get_all_shard_names()}
+        for i in range(1000):
+            userCounts[get_shard_name('user_%d' % i)] += 1
+        self.assertEqual(config.USER_REGISTRY_SHARD_COUNT, len(userCounts))
+        for userCount in userCounts.values():
+            self.assertGreater(userCount, 1000 / config.USER_REGISTRY_SHARD_COUNT / 2)
+
+    def test_shard_is_stable(self):
+        self.assertEqual(get_shard_name('some_user'), get_shard_name('some_user'))
+        expectedShard = 0x8220bb2a % config.USER_REGISTRY_SHARD_COUNT  # zlib.crc32(b'some_user')
+        self.assertEqual('user_registry_%d' % expectedShard, get_shard_name('some_user'))
+
 
 if __name__ == '__main__':
     unittest.main()
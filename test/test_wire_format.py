@@ -0,0 +1,52 @@
+import os
+import sys
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'lib')
+sys.path.insert(0, os.getcwd() + os.sep + os.pardir + os.sep + 'chatserver')
+import unittest
+import Pyro4.core
+import wire_format
+from protocol import ClientMessage, MessageType, ServerMessage
+
+
+class TestWireFormat(unittest.TestCase):
+    def setUp(self):
+        self.routerUri = Pyro4.core.URI('PYRO:obj_a@localhost:40001')
+        self.otherRouterUri = Pyro4.core.URI('PYRO:obj_b@localhost:40002')
+
+    def assertRoundTrip(self, msgs):
+        decodedMsgs = wire_format.decode_messages(wire_format.encode_messages(msgs))
+        self.assertEqual(len(msgs), len(decodedMsgs))
+        for msg, decodedMsg in zip(msgs, decodedMsgs):
+            self.assertEqual(msg.messageType, decodedMsg.messageType)
+            self.assertEqual(msg.senderMailboxUri, decodedMsg.senderMailboxUri)
+            if isinstance(msg.data, ClientMessage):
+                self.assertEqual(ClientMessage.to_json(msg.data), ClientMessage.to_json(decodedMsg.data))
+            else:
+                self.assertEqual(msg.data, decodedMsg.data)
+
+    def test_round_trip(self):
+        self.assertRoundTrip([
+            ServerMessage(MessageType.NEW_USER, self.routerUri, 'user'),
+            ServerMessage(MessageType.USER_REGISTRY_NEW_USER, self.routerUri, ('user', True)),
+            ServerMessage(MessageType.REGISTER_CHAT_SERVER, None, 8001),
+            ServerMessage(MessageType.NEW_MESSAGE_ROUTER, None, [self.routerUri, self.otherRouterUri]),
+            ServerMessage(MessageType.FORWARD_PRIVATE_MESSAGE_TO_CLIENT, self.routerUri,
+                          ClientMessage(MessageType.PRIVATE_MESSAGE, 'sender', 'héllo', 'receiver')),
+            ServerMessage(MessageType.FORWARD_PUBLIC_MESSAGE_TO_ALL_CLIENTS, self.routerUri,
+                          ClientMessage(MessageType.PUBLIC_MESSAGE, 'sender', 'x' * 70000)),
+            ServerMessage(MessageType.FORWARD_PRIVATE_MESSAGE_TO_CLIENT, self.routerUri,
+                          ClientMessage(MessageType.LIST_ALL_USERS, allUsers=['user_1', 'user_2'], cursor='user_2')),
+            ServerMessage(MessageType.FORWARD_ROOM_MESSAGE, self.routerUri,
+                          ClientMessage(MessageType.ROOM_MESSAGE, 'sender', 'hello', roomName='room')),
+            ServerMessage(MessageType.NEW_USER, 'not a uri', {'falls back': 'to pickle'})
+        ])
+
+    def test_uris_are_sent_once_per_batch(self):
+        msg = ServerMessage(MessageType.NEW_USER, self.routerUri, 'user')
+        oneMessageSize = len(wire_format.encode_messages([msg]))
+        tenMessagesSize = len(wire_format.encode_messages([msg] * 10))
+        self.assertLess(tenMessagesSize - oneMessageSize, 9 * (len(str(self.routerUri)) + len('user')))
+
+
+if __name__ == '__main__':
+    unittest.main()